@@ -5,43 +5,162 @@ SecureLocal Chat using working broadcast + TCP/E2EE
 
 import sys
 import os
+import time
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import uuid
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
 
-from security import SecurityManager
-from database import DatabaseManager
-from network import NetworkManager
+import startup
+
+with startup.timed('import', 'flask'):
+    from flask import Flask, Response, g, render_template, request, jsonify, session, redirect, url_for, flash, send_from_directory
+
+import logs
+import metrics
+import profiling
+
+with startup.timed('import', 'security'):
+    from security import SecurityManager
+with startup.timed('import', 'database'):
+    from database import DatabaseManager, new_message_id
+with startup.timed('import', 'network'):
+    from network import NetworkManager
 
 # ----------------- Flask Setup -----------------
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
 # ----------------- Global Instances -----------------
+# Created on first use by the get_*() accessors below
 security: SecurityManager = None
 database: DatabaseManager = None
 network: NetworkManager = None
 
+_init_lock = threading.RLock()
+discovery_mode = 'both'  # set from --discovery
+message_cache_mb = 8     # set from --message-cache-mb
+network_socket = None    # set from --network-socket: use a network daemon at this path
+metrics_public = False   # set from --metrics-public: serve /api/metrics without a login
+
+log = logging.getLogger('securelocal.app')
+
 # ----------------- App Initialization -----------------
+def get_data_path():
+    data_path = Path.home() / '.securelocalchat' if sys.platform != 'win32' else Path(os.environ.get('APPDATA', '')) / 'SecureLocalChat'
+    data_path.mkdir(parents=True, exist_ok=True)
+    return data_path
+
+def get_database():
+    global database
+    if database is None:
+        with _init_lock:
+            if database is None:
+                with startup.timed('init', 'database'):
+                    database = DatabaseManager(get_data_path() / 'chat.db',
+                                               cache_bytes=int(message_cache_mb * 1024 * 1024))
+    return database
+
+def get_security():
+    global security
+    if security is None:
+        with _init_lock:
+            if security is None:
+                with startup.timed('init', 'security'):
+                    security = SecurityManager(get_data_path())
+    return security
+
+def get_network():
+    global network
+    if network is None:
+        with _init_lock:
+            if network is None:
+                if network_socket:
+                    from network_daemon import NetworkClient
+                    network = NetworkClient(network_socket)
+                    network.subscribe()
+                else:
+                    db = get_database()
+                    with startup.timed('init', 'network'):
+                        network = NetworkManager(db, downloads_dir=get_data_path() / 'downloads',
+                                                 keys_dir=get_data_path() / 'keys',
+                                                 discovery=discovery_mode)
+                network.message_callbacks.append(_track_transfer)
+    return network
+
 def initialize_app():
-    global security, database, network
+    """Eagerly create every component (normally they are created on first use)."""
     try:
-        # Create app data directory
-        data_path = Path.home() / '.securelocalchat' if sys.platform != 'win32' else Path(os.environ.get('APPDATA', '')) / 'SecureLocalChat'
-        data_path.mkdir(parents=True, exist_ok=True)
-
-        # Initialize core components
-        database = DatabaseManager(data_path / 'chat.db')
-        security = SecurityManager(data_path)
-        network = NetworkManager(database)
+        get_database()
+        get_security()
+        get_network()
 
-        print("[APP] Initialization successful")
+        log.info("Initialization successful")
         return True
     except Exception as e:
-        print(f"[APP] Initialization failed: {e}")
+        log.exception("Initialization failed: %s", e)
         return False
 
-if not initialize_app():
-    print("WARNING: Failed to initialize app")
+def profile_startup():
+    """Force every lazy component into existence and print what each one cost."""
+    initialize_app()
+    with startup.timed('import', 'e2e_encryption'):
+        import e2e_encryption  # noqa: F401 - pulls in pycryptodome
+    with startup.timed('init', 'network.local_ip'):
+        network.local_ip
+    startup.report()
+
+# ----------------- Request Metrics -----------------
+HTTP_SECONDS = metrics.histogram(
+    "securelocal_http_request_seconds",
+    "HTTP request latency by route",
+    ["route", "method"]
+)
+HTTP_REQUESTS = metrics.counter(
+    "securelocal_http_requests_total",
+    "HTTP requests by route and status",
+    ["route", "method", "status"]
+)
+
+# Requests the UI repeats every few seconds; access_log counts and samples these
+POLL_ROUTES = [
+    ('GET', '/api/users'),
+    ('GET', '/api/messages'),
+    ('GET', '/api/groups'),
+    ('GET', '/api/transfers'),
+    ('GET', '/api/get_typing'),
+    ('GET', '/api/metrics'),
+    ('POST', '/api/typing'),
+    ('POST', '/api/update_status'),
+    ('POST', '/api/sync'),
+]
+access_log = logs.AccessLog(POLL_ROUTES)  # replaced from --access-sample/--slow-ms in main()
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    g.trace = profiling.PROFILER.begin('http', route, start=g.request_start)
+
+@app.after_request
+def _record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # Label by URL rule, not path, so query strings and ids don't explode the series
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        elapsed = time.perf_counter() - start
+        HTTP_SECONDS.labels(route, request.method).observe(elapsed)
+        HTTP_REQUESTS.labels(route, request.method, response.status_code).inc()
+        access_log.record(request.method, route, request.full_path.rstrip('?'),
+                          response.status_code, elapsed, request.remote_addr)
+    return response
+
+@app.teardown_request
+def _end_trace(exc):
+    profiling.PROFILER.end(g.pop('trace', None))
 
 # ----------------- Web Routes -----------------
 @app.route('/')
@@ -63,11 +182,12 @@ def login():
             flash('Please enter username and password', 'error')
             return render_template('login.html')
 
-        if security.verify_user(username, password):
+        if get_security().verify_user(username, password):
             session['username'] = username
-            if network:
-                network.set_username(username)
-                network.start()
+            network = get_network()
+            network.set_username(username)
+            network.start()
+            database = get_database()
             if not database.user_exists(username):
                 database.add_user(username)
             flash('Welcome back!', 'success')
@@ -93,7 +213,7 @@ def register():
             errors.append('Username required')
         elif len(username) < 3:
             errors.append('Username must be at least 3 characters')
-        elif security.user_exists(username):
+        elif get_security().user_exists(username):
             errors.append('Username already exists')
 
         if not password:
@@ -108,7 +228,8 @@ def register():
                 flash(error, 'error')
             return render_template('register.html')
 
-        if security.create_user(username, password):
+        if get_security().create_user(username, password):
+            database = get_database()
             database.initialize_database()
             database.add_user(username)
             flash('Account created successfully! Please login.', 'success')
@@ -137,72 +258,392 @@ def api_get_users():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     try:
-        return jsonify({'users': network.get_online_users() if network else []})
+        return jsonify({'users': get_network().get_online_users()})
     except Exception:
         return jsonify({'users': []})
 
+@app.route('/api/peers/<username>/trust', methods=['POST'])
+def api_trust_peer(username):
+    """Accept the new identity key a known peer came back with."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    if not get_network().trust_new_key(username):
+        return jsonify({'error': 'No changed key for this user'}), 404
+    return jsonify({'success': True})
+
+MESSAGE_PAGE_MAX = 200
+
 @app.route('/api/messages', methods=['GET', 'POST'])
 def api_messages():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     current_user = session['username']
+    database = get_database()
 
     if request.method == "POST":
         data = request.json
         recipient = data.get("recipient", "").strip()
+        group_id = data.get("group_id", "").strip()
         message = data.get("message", "").strip()
 
+        if group_id and message:
+            return _send_group_message(current_user, group_id, message)
         if not recipient or not message:
             return jsonify({"error": "Recipient and message required"}), 400
 
+        uid = new_message_id()
         msg_id = database.save_message(
-            current_user, recipient, message, is_encrypted=False
+            current_user, recipient, message, is_encrypted=False, uid=uid
         )
 
-        if network:
+        network = get_network()
+        if network.running:
             try:
                 recipient_user = next(
                     (u for u in network.get_online_users() if u["username"] == recipient),
                     None
                 )
                 if recipient_user:
-                    network.send_message(recipient_user["user_id"], message)
+                    network.send_message(recipient_user["user_id"], message, message_id=uid)
             except Exception as e:
-                print("[NETWORK SEND ERROR]", e)
+                log.warning("Network send failed: %s", e)
 
         return jsonify({"success": True, "message_id": msg_id})
 
     else:
+        # Newest page by default; ?before=<uid> pages back through older messages
+        before = request.args.get("before") or None
+        limit = max(1, min(request.args.get("limit", 50, type=int), MESSAGE_PAGE_MAX))
+
+        group_id = request.args.get("group", "").strip()
+        if group_id:
+            group = database.get_group(group_id)
+            if group is None or current_user not in group["members"]:
+                return jsonify({"error": "Unknown group"}), 404
+            messages = database.get_group_messages(group_id, limit, before)
+            return jsonify({"messages": messages, "has_more": len(messages) == limit})
+
         other_user = request.args.get("with", "").strip()
         if not other_user:
             return jsonify({"error": "Recipient required"}), 400
 
-        messages = database.get_messages(current_user, other_user)
+        messages = database.get_messages(current_user, other_user, limit, before)
+        _mark_delivered(database, current_user, messages)
+        return jsonify({"messages": messages, "has_more": len(messages) == limit})
+
+def _mark_delivered(database, current_user, messages):
+    """Auto-update sent → delivered for messages to the user who is reading them."""
+    arrived = [m for m in messages if m["recipient"] == current_user and m["status"] == "sent"]
+    database.update_message_statuses([m["id"] for m in arrived], "delivered")
+    for msg in arrived:
+        msg["status"] = "delivered"
+
+def _send_group_message(current_user, group_id, message):
+    database = get_database()
+    group = database.get_group(group_id)
+    if group is None or current_user not in group["members"]:
+        return jsonify({"error": "Unknown group"}), 404
+
+    uid = new_message_id()
+    msg_id = database.save_group_message(current_user, group_id, message, group["members"], uid=uid)
+
+    delivery = {}
+    network = get_network()
+    if network.running:
+        try:
+            delivery = network.send_group_message(group_id, group["name"], group["members"], uid, message)
+        except Exception as e:
+            log.warning("Group send failed: %s", e)
+
+    return jsonify({"success": True, "message_id": msg_id, "delivery": delivery})
+
+@app.route('/api/groups', methods=['GET', 'POST'])
+def api_groups():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    current_user = session['username']
+    database = get_database()
+
+    if request.method == 'POST':
+        data = request.json or {}
+        name = str(data.get('name', '')).strip()
+        members = [str(m).strip() for m in data.get('members', []) if str(m).strip()]
+        if not name or not members:
+            return jsonify({'error': 'Name and members required'}), 400
 
-        # Auto-update sent → delivered
-        for msg in messages:
-            if msg["recipient"] == current_user and msg["status"] == "sent":
-                database.update_message_status(msg["id"], "delivered")
-                msg["status"] = "delivered"
+        group_id = uuid.uuid4().hex[:12]
+        database.create_group(group_id, name, current_user, members)
+        return jsonify({'success': True, 'group': database.get_group(group_id)})
 
-        return jsonify({"messages": messages})
+    return jsonify({'groups': database.get_groups(current_user)})
 
 @app.route('/api/update_status', methods=['POST'])
 def api_update_status():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    data = request.json
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid parameters'}), 400
     message_id = data.get('message_id')
     status = data.get('status')
 
-    if not message_id or status not in ('sent', 'delivered', 'read'):
+    if type(message_id) is not int or status not in ('sent', 'delivered', 'read'):
         return jsonify({'error': 'Invalid parameters'}), 400
 
+    # Only the recipient's side of a message is theirs to change
+    if not get_database().update_received_statuses(session['username'], [message_id], status):
+        return jsonify({'error': 'Message not found'}), 404
+    return jsonify({'success': True})
+
+# ----------------- Sync -----------------
+# One request per poll instead of one per panel. The client sends what it
+# already has (a version per section, and the newest and oldest-unconfirmed
+# message uids of the open chat) plus its queued actions (read marks, typing
+# state); the reply holds only what changed.
+#
+#   {"presence": v, "groups": v, "typing": v, "transfers": v,
+#    "chat": {"with": "bob" | "group": id, "after": uid, "unread": uid},
+#    "read": [message ids], "typing_state": {"recipient": "bob", "action": "start" | "stop"}}
+
+def _version(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+def _delta(client_version, key, value):
+    version = _version(value)
+    if version == client_version:
+        return {'version': version}
+    return {'version': version, key: value}
+
+def _online_users():
     try:
-        database.update_message_status(message_id, status)
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        network = get_network()
+        users = network.get_online_users()
+        conflicts = network.get_key_conflicts()
+    except Exception:
+        return []
+    # Only what the sidebar shows; last_seen would change the version on every beacon
+    listed = [{'user_id': u['user_id'], 'username': u['username']} for u in users]
+    # Someone using a known name with a different key: shown, but not selectable
+    listed += [{'user_id': None, 'username': c['username'], 'key_changed': True} for c in conflicts]
+    return sorted(listed, key=lambda u: u['username'])
+
+def _chat_delta(current_user, chat):
+    database = get_database()
+    limit = chat.get('limit')
+    limit = max(1, min(limit if type(limit) is int else 50, MESSAGE_PAGE_MAX))
+    after, unread = (v if isinstance(v, str) else None for v in (chat.get('after'), chat.get('unread')))
+
+    if chat.get('group'):
+        group = database.get_group(str(chat['group']))
+        if group is None or current_user not in group['members']:
+            return {'error': 'Unknown group'}
+        page = database.get_group_messages(group['id'], limit)
+    else:
+        page = database.get_messages(current_user, str(chat['with']), limit)
+        _mark_delivered(database, current_user, page)
+
+    new = [m for m in page if not after or m['uid'] > after]
+    delta = {
+        'messages': new,
+        # Status and receipts of the user's messages the client last saw unconfirmed
+        'statuses': [
+            {'id': m['id'], 'status': m['status'], 'receipts': m.get('receipts')}
+            for m in page
+            if unread and unread <= m['uid'] and after and m['uid'] <= after
+            and m['sender'] == current_user
+        ],
+    }
+    if not after:
+        delta['has_more'] = len(page) == limit
+    elif len(new) == len(page) == limit:
+        delta['reset'] = True  # more than a page arrived; the client starts from the newest
+    return delta
+
+@app.route('/api/sync', methods=['POST'])
+def api_sync():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    current_user = session['username']
+    database = get_database()
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    chat = data.get('chat') or {}
+    typing = data.get('typing_state') or {}
+    if not (isinstance(chat, dict) and isinstance(typing, dict)):
+        return jsonify({'error': 'chat and typing_state must be objects'}), 400
+
+    # ---- Queued actions ----
+    # Anything but message ids is dropped rather than failing the whole sync,
+    # which the client would otherwise retry with the same ids forever
+    read = data.get('read') if isinstance(data.get('read'), list) else []
+    database.mark_read(current_user, [i for i in read[:MESSAGE_PAGE_MAX] if type(i) is int])
+    recipient = str(typing.get('recipient') or '').strip()
+    if recipient and typing.get('action') == 'start':
+        database.user_started_typing(current_user, recipient)
+    elif recipient and typing.get('action') == 'stop':
+        database.user_stopped_typing(current_user, recipient)
+
+    # ---- Deltas ----
+    reply = {}
+    if 'presence' in data:
+        reply['presence'] = _delta(data['presence'], 'users', _online_users())
+    if 'groups' in data:
+        reply['groups'] = _delta(data['groups'], 'groups', database.get_groups(current_user))
+    if 'typing' in data:
+        reply['typing'] = _delta(data['typing'], 'users', sorted(database.get_typing_users(current_user)))
+    if 'transfers' in data:
+        with _transfers_lock:
+            items = [{k: v for k, v in t.items() if k != 'path'} for t in transfers.values()]
+        reply['transfers'] = _delta(data['transfers'], 'transfers', items)
+    if chat.get('with') or chat.get('group'):
+        reply['chat'] = _chat_delta(current_user, chat)
+    return jsonify(reply)
+
+@app.route('/api/metrics')
+def api_metrics():
+    # Peer, transfer and message counts are nobody else's business on the LAN
+    if 'username' not in session and not metrics_public:
+        return jsonify({'error': 'Not logged in'}), 401
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/debug/profile', methods=['GET', 'POST'])
+def api_debug_profile():
+    """Toggle sampled profiling for a route ("http:/api/messages") or packet type
+    ("packet:secure_message") and set the slow-operation threshold at runtime."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    profiler = profiling.PROFILER
+    if request.method == 'POST':
+        data = request.json or {}
+        if profiler.output_dir is None:
+            profiler.configure(output_dir=get_data_path() / 'profiles')
+
+        try:
+            if 'target' in data:
+                target = str(data['target'])
+                if not target.startswith(('http:', 'packet:')):
+                    return jsonify({'error': 'target must start with http: or packet:'}), 400
+                profiler.set_target(target, float(data.get('rate', 0)))
+            if 'slow_ms' in data:
+                profiler.configure(slow_threshold=float(data['slow_ms'] or 0) / 1000)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid parameters'}), 400
+
+    return jsonify(profiler.status())
+
+# ----------------- File Transfers -----------------
+# transfer_id -> progress shown in the UI; outgoing ones also keep what a resume needs
+transfers = {}
+_transfers_lock = threading.Lock()
+_sending = set()  # outgoing transfer ids a _send_file thread is working on
+FILE_SEND_ATTEMPTS = 3
+
+def _track_transfer(event):
+    if not event['type'].startswith('file_'):
+        return
+    state = {'file_progress': 'active', 'file_complete': 'complete', 'file_failed': 'failed'}[event['type']]
+    with _transfers_lock:
+        t = transfers.setdefault(event['transfer_id'], {'id': event['transfer_id'], 'direction': 'received'})
+        t.update({k: v for k, v in event.items() if k in ('sender', 'name', 'bytes', 'size')})
+        t['state'] = state
+        if state == 'complete':
+            t['bytes'] = t['size']
+
+def _send_file(transfer_id):
+    """Send (or resume) an outgoing transfer, retrying from the last acknowledged chunk."""
+    t = transfers[transfer_id]
+    # One sender per transfer, however many resume clicks arrive
+    with _transfers_lock:
+        if transfer_id in _sending:
+            return
+        _sending.add(transfer_id)
+
+    def on_progress(done, size):
+        t['bytes'] = done
+
+    network = get_network()
+    try:
+        for attempt in range(1, FILE_SEND_ATTEMPTS + 1):
+            t['state'] = 'active'
+            try:
+                user = next(u for u in network.get_online_users() if u['username'] == t['recipient'])
+                network.send_file(user['user_id'], t['path'], transfer_id, on_progress)
+            except Exception as e:
+                log.warning("File send %s attempt %s failed: %s", t['name'], attempt, e)
+                if attempt < FILE_SEND_ATTEMPTS:
+                    t.update(state='retrying', error=str(e))
+                    time.sleep(2 * attempt)
+                else:
+                    t.update(state='failed', error=str(e))
+                continue
+
+            t.update(state='complete', bytes=t['size'], error=None)
+            os.remove(t['path'])
+            return
+    finally:
+        with _transfers_lock:
+            _sending.discard(transfer_id)
+
+@app.route('/api/files', methods=['POST'])
+def api_send_file():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    recipient = request.form.get('recipient', '').strip()
+    upload = request.files.get('file')
+    if not recipient or not upload or not upload.filename:
+        return jsonify({'error': 'Recipient and file required'}), 400
+    if not get_network().running:
+        return jsonify({'error': 'Network not running'}), 503
+
+    transfer_id = os.urandom(16).hex()
+    uploads = get_data_path() / 'uploads'
+    uploads.mkdir(exist_ok=True)
+    path = uploads / transfer_id
+    upload.save(path)
+
+    with _transfers_lock:
+        transfers[transfer_id] = {
+            'id': transfer_id,
+            'direction': 'sent',
+            'recipient': recipient,
+            'name': os.path.basename(upload.filename),
+            'path': str(path),
+            'bytes': 0,
+            'size': path.stat().st_size,
+            'state': 'queued',
+        }
+    threading.Thread(target=_send_file, args=(transfer_id,), daemon=True).start()
+    return jsonify({'success': True, 'transfer_id': transfer_id})
+
+@app.route('/api/transfers')
+def api_transfers():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    with _transfers_lock:
+        items = [{k: v for k, v in t.items() if k != 'path'} for t in transfers.values()]
+    return jsonify({'transfers': items})
+
+@app.route('/api/transfers/<transfer_id>/resume', methods=['POST'])
+def api_resume_transfer(transfer_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    t = transfers.get(transfer_id)
+    if not t or t['direction'] != 'sent':
+        return jsonify({'error': 'Unknown transfer'}), 404
+    with _transfers_lock:
+        busy = transfer_id in _sending
+    if busy or t['state'] != 'failed':
+        return jsonify({'error': f"Transfer is {t['state']}"}), 409
+    threading.Thread(target=_send_file, args=(transfer_id,), daemon=True).start()
+    return jsonify({'success': True})
+
+@app.route('/api/files/<path:name>')
+def api_download_file(name):
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    return send_from_directory(get_data_path() / 'downloads', name, as_attachment=True)
 
 # ----------------- Typing Indicators -----------------
 @app.route('/api/typing', methods=['POST'])
@@ -216,6 +657,7 @@ def api_typing():
     if not recipient or action not in ("start", "stop"):
         return jsonify({"error": "Invalid parameters"}), 400
 
+    database = get_database()
     if action == "start":
         database.user_started_typing(session['username'], recipient)
     else:
@@ -227,18 +669,155 @@ def api_typing():
 def api_get_typing():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    typing_users = database.get_typing_users(session['username'])
+    typing_users = get_database().get_typing_users(session['username'])
     return jsonify({"typing": typing_users})
 
 # ----------------- Main -----------------
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SecureLocal Chat")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--production', action='store_true',
+                        help='serve with the pooled production server instead of the Flask dev server')
+    parser.add_argument('--threads', type=int, default=8, help='HTTP worker threads (production)')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='connections allowed to wait for a worker before 503 (production)')
+    parser.add_argument('--backlog', type=int, default=128, help='listen() backlog (production)')
+    parser.add_argument('--keepalive', type=float, default=5,
+                        help='idle keep-alive timeout in seconds (production)')
+    parser.add_argument('--discovery', choices=('multicast', 'broadcast', 'both'), default='both',
+                        help='peer discovery: multicast on every interface, subnet broadcast, or both')
+    parser.add_argument('--peer-workers', type=int, default=NetworkManager.PEER_WORKERS,
+                        help='threads serving inbound peer connections')
+    parser.add_argument('--peer-queue', type=int, default=NetworkManager.PEER_QUEUE,
+                        help='peer connections allowed to wait for a worker before being shed')
+    parser.add_argument('--peer-backlog', type=int, default=NetworkManager.ACCEPT_BACKLOG,
+                        help='listen() backlog of the peer TCP port')
+    parser.add_argument('--network-daemon', action='store_true',
+                        help='run only the network (discovery, peers, crypto) and serve it on --network-socket')
+    parser.add_argument('--network-socket', metavar='PATH',
+                        help='Unix socket of the network daemon; web processes started with it '
+                             'use the daemon instead of running the network themselves')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='let several web processes share --port (production, with --network-socket)')
+    parser.add_argument('--message-cache-mb', type=float, default=message_cache_mb,
+                        help='memory for cached conversation windows (0 disables the cache)')
+    parser.add_argument('--metrics-public', action='store_true',
+                        help='serve /api/metrics without a login (for a Prometheus scraper)')
+    parser.add_argument('--slow-ms', type=float, default=0,
+                        help='log requests and packets slower than this to profiles/slow.log')
+    parser.add_argument('--log-dir', help='directory for the rotating logs (default: <data dir>/logs)')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    parser.add_argument('--log-json', action='store_true', help='write the log as JSON lines')
+    parser.add_argument('--log-max-mb', type=float, default=10, help='rotate the log at this size')
+    parser.add_argument('--log-rotate-when', metavar='WHEN',
+                        help="rotate by time instead of size ('midnight', 'h', ...)")
+    parser.add_argument('--log-backups', type=int, default=5, help='rotated logs to keep')
+    parser.add_argument('--access-sample', type=int, default=100,
+                        help='log 1 in N successful polls in full (0: summaries only); '
+                             'errors and slow requests are always logged')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report import and init time per component, then exit')
+    return parser.parse_args(argv)
+
+def shutdown():
+    if network:
+        network.stop()
+    logs.shutdown()
+
+def _shared_secret_key():
+    """Session key kept in the data directory so every web process accepts
+    the same cookies."""
+    path = get_data_path() / 'session.key'
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return path.read_bytes()
+    key = os.urandom(24)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def _log_name(args):
+    if args.network_daemon:
+        return 'network-daemon'
+    if args.reuse_port:
+        return f'securelocal-{os.getpid()}'  # one file per web process sharing the port
+    return 'securelocal'
+
+def run_network_daemon(socket_path):
+    from network_daemon import NetworkDaemon
+
+    daemon = NetworkDaemon(get_network(), socket_path)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown()
+
+def main(argv=None):
+    global discovery_mode, message_cache_mb, network_socket, metrics_public, access_log
+    args = parse_args(argv)
+    discovery_mode = args.discovery
+    message_cache_mb = args.message_cache_mb
+    metrics_public = args.metrics_public
+    NetworkManager.PEER_WORKERS = args.peer_workers
+    NetworkManager.PEER_QUEUE = args.peer_queue
+    NetworkManager.ACCEPT_BACKLOG = args.peer_backlog
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    profiling.PROFILER.configure(
+        output_dir=get_data_path() / 'profiles',
+        slow_threshold=args.slow_ms / 1000
+    )
+    logs.setup(
+        args.log_dir or get_data_path() / 'logs',
+        level=args.log_level,
+        json_lines=args.log_json,
+        max_bytes=int(args.log_max_mb * 1024 * 1024),
+        backups=args.log_backups,
+        when=args.log_rotate_when,
+        name=_log_name(args),
+    )
+    access_log = logs.AccessLog(POLL_ROUTES, sample=args.access_sample,
+                                slow_ms=args.slow_ms or logs.AccessLog.SLOW_MS)
+
+    if args.network_daemon:
+        run_network_daemon(args.network_socket or get_data_path() / 'network.sock')
+        return
+    if args.network_socket:
+        network_socket = args.network_socket
+        app.secret_key = _shared_secret_key()
+
     print("\n" + "="*60)
     print("SECURELOCAL CHAT - WORKING BROADCAST METHOD")
     print("="*60)
     print("Port 6667: UDP Discovery + TCP Messaging")
-    print("Web Interface: http://localhost:5000")
+    print(f"Web Interface: http://localhost:{args.port}")
     print("="*60)
-    app.run(host='0.0.0.0', port=5000, debug=False)
+
+    if args.production:
+        from server import serve
+        serve(
+            app,
+            host=args.host,
+            port=args.port,
+            threads=args.threads,
+            queue_size=args.queue_size,
+            backlog=args.backlog,
+            keepalive_timeout=args.keepalive,
+            reuse_port=args.reuse_port,
+            on_shutdown=shutdown,
+        )
+    else:
+        try:
+            app.run(host=args.host, port=args.port, debug=False)
+        finally:
+            shutdown()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks - the hot paths timed in-process, no network needed
+
+Covers end-to-end encryption by message size, identity key generation,
+session-key wrap/unwrap (RSA) and agreement (X25519),
+SecurityManager password hashing and user lookup, DatabaseManager writes
+and reads at several database sizes, discovery beacon parsing and packet
+building in NetworkManager. Results are operations per second (best of
+--repeat runs); a run can be saved and later runs compared against it,
+failing when any benchmark got slower than --threshold percent.
+
+    python bench.py --output bench.json                   # record a baseline
+    python bench.py --compare bench.json --threshold 10   # exit 1 on regression
+    python bench.py --only crypto,db --db-rows 10000 --quick
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MESSAGE_SIZES = (64, 1024, 16384)
+
+BENCHMARKS = []  # (group, function(args, workdir) -> {name: operation})
+
+
+def benchmark(group):
+    def register(fn):
+        BENCHMARKS.append((group, fn))
+        return fn
+    return register
+
+
+def measure(operation, min_time, repeat):
+    """Best operations per second over `repeat` batches of about `min_time` seconds."""
+    # Calibrate: double the batch until one takes a measurable share of min_time
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10 or n >= 1 << 20:
+            break
+        n *= 2
+    n = max(1, int(n * min_time / max(elapsed, 1e-9)))
+
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(n):
+            operation()
+        best = max(best, n / (time.perf_counter() - start))
+    return best
+
+
+# ------------------ Crypto ------------------
+@benchmark("crypto")
+def crypto_benchmarks(args, workdir):
+    from e2e_encryption import (KEY_AGREEMENTS, generate_rsa_keys, generate_session_key, encrypt_session_key,
+                                decrypt_session_key, encrypt_payload, decrypt_payload)
+
+    public_pem, private_key = generate_rsa_keys("bench", workdir)
+    key = generate_session_key()
+    wrapped = encrypt_session_key(key, public_pem)
+
+    ops = {
+        "crypto.generate_rsa_keys": lambda: generate_rsa_keys("bench-rsa", workdir),
+        "crypto.wrap_session_key": lambda: encrypt_session_key(key, public_pem),
+        "crypto.unwrap_session_key": lambda: decrypt_session_key(wrapped, private_key),
+    }
+    if "x25519" in KEY_AGREEMENTS:
+        from e2e_encryption import generate_ec_keys, agree_session_key, derive_session_key
+
+        sender_public, sender_private = generate_ec_keys("bench-sender", workdir)
+        recipient_public, recipient_private = generate_ec_keys("bench-recipient", workdir)
+        _, agreed = agree_session_key(recipient_public, sender_private)
+        ops.update({
+            "crypto.generate_ec_keys": lambda: generate_ec_keys("bench-ec", workdir),
+            "crypto.agree_session_key": lambda: agree_session_key(recipient_public, sender_private),
+            "crypto.derive_session_key": lambda: derive_session_key(agreed, recipient_private, sender_public),
+        })
+    for size in MESSAGE_SIZES:
+        data = os.urandom(size)
+        sealed = encrypt_payload(data, key)
+        ops[f"crypto.encrypt[{size}B]"] = lambda data=data: encrypt_payload(data, key)
+        ops[f"crypto.decrypt[{size}B]"] = lambda sealed=sealed: decrypt_payload(sealed, key)
+    return ops
+
+
+# ------------------ Security ------------------
+@benchmark("security")
+def security_benchmarks(args, workdir):
+    from security import SecurityManager
+
+    security = SecurityManager(Path(workdir) / "security")
+    security.create_user("alice", "correct horse")
+    # Lookups read users.json every time, so its size matters; fill it directly
+    # rather than paying PBKDF2 for every user
+    users = security._load_users()
+    for i in range(args.users):
+        users[f"user{i}"] = dict(users["alice"])
+    security._save_users(users)
+    salt = os.urandom(16)
+
+    return {
+        "security.hash_password": lambda: security._hash_password("correct horse", salt),
+        "security.verify_user": lambda: security.verify_user("alice", "correct horse"),
+        f"security.user_exists[{args.users} users]": lambda: security.user_exists("user1"),
+    }
+
+
+# ------------------ Database ------------------
+def _populate(path, rows, conversations=100):
+    """A database with `rows` messages spread over `conversations` pairs of users."""
+    from database import DatabaseManager, new_message_id
+
+    DatabaseManager(path).connection.close()  # create the current schema
+    rng = random.Random(rows)
+    pairs = [(f"user{i}", f"user{i + 1}") for i in range(conversations)]
+    connection = sqlite3.connect(path)
+    batch = []
+    for i in range(rows):
+        sender, recipient = pairs[i % conversations]
+        if rng.random() < 0.5:
+            sender, recipient = recipient, sender
+        batch.append((sender, recipient, f"message {i} " + "x" * 80, "delivered", new_message_id()))
+        if len(batch) == 50000:
+            connection.executemany(
+                "INSERT INTO messages (sender, recipient, message, status, uid) VALUES (?, ?, ?, ?, ?)",
+                batch)
+            batch = []
+    if batch:
+        connection.executemany(
+            "INSERT INTO messages (sender, recipient, message, status, uid) VALUES (?, ?, ?, ?, ?)",
+            batch)
+    connection.commit()
+    connection.close()
+
+
+@benchmark("db")
+def database_benchmarks(args, workdir):
+    from database import DatabaseManager
+
+    ops = {}
+    for rows in args.db_rows:
+        path = Path(workdir) / f"chat-{rows}.db"
+        print(f"  populating {rows} rows...", flush=True)
+        _populate(path, rows)
+        # The message cache would turn every read into a dict copy; measure SQLite
+        db = DatabaseManager(path, cache_entries=0)
+        middle = db.connection.execute(
+            "SELECT uid FROM messages WHERE sender IN ('user0', 'user1') AND recipient IN ('user0', 'user1') "
+            "ORDER BY uid LIMIT 1 OFFSET ?", (rows // 200,)).fetchone()[0]
+        rng = random.Random(1)
+        ids = [rng.randint(1, rows) for _ in range(1024)]
+        statuses = ("delivered", "read")
+        step = [0]
+
+        def update(db=db, ids=ids):
+            step[0] += 1
+            db.update_message_status(ids[step[0] % len(ids)], statuses[step[0] % 2])
+
+        label = f"{rows // 1000}k" if rows < 1_000_000 else f"{rows // 1_000_000}M"
+        ops[f"db.save_message[{label}]"] = lambda db=db: db.save_message("user0", "user1", "benchmark message")
+        ops[f"db.get_messages[{label}]"] = lambda db=db: db.get_messages("user0", "user1")
+        ops[f"db.get_messages_before[{label}]"] = (
+            lambda db=db, uid=middle: db.get_messages("user0", "user1", before=uid))
+        ops[f"db.update_message_status[{label}]"] = update
+    return ops
+
+
+# ------------------ Network ------------------
+def _network(workdir):
+    from database import DatabaseManager
+    from network import NetworkManager
+
+    network = NetworkManager(DatabaseManager(":memory:"), keys_dir=workdir)
+    # Sorts after every peer name, so recording a peer never starts a sync thread
+    network.set_username("~bench")
+    return network
+
+
+@benchmark("discovery")
+def discovery_benchmarks(args, workdir):
+    network = _network(workdir)
+    peer = _network(workdir)
+    beacons = []
+    for i in range(50):
+        peer.user_id, peer.username = f"{i:08x}", f"peer{i}"
+        beacons.append(json.dumps({"type": "discovery", **peer._presence()}).encode())
+    step = [0]
+
+    def parse_and_record():
+        step[0] += 1
+        packet = json.loads(beacons[step[0] % len(beacons)].decode())
+        network._record_peer(packet, "192.0.2.10")
+
+    return {
+        "discovery.parse_beacon": lambda: json.loads(beacons[0].decode()),
+        "discovery.parse_and_record[50 peers]": parse_and_record,
+    }
+
+
+@benchmark("packet")
+def packet_benchmarks(args, workdir):
+    import compress
+    from database import new_message_id
+    from e2e_encryption import generate_session_key
+
+    network = _network(workdir)
+    key = generate_session_key()
+    codec = compress.negotiate(compress.CODECS)
+    ops = {
+        "packet.beacon": lambda: json.dumps({"type": "discovery", **network._presence()}).encode(),
+    }
+    for size in MESSAGE_SIZES:
+        data = ("hello there, " * (size // 13 + 1))[:size].encode()
+        ops[f"packet.secure_message[{size}B]"] = lambda data=data: json.dumps(
+            network._message_packet(new_message_id(), data, codec, key)).encode()
+    return ops
+
+
+# ------------------ Runner ------------------
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    results = {}
+    try:
+        for group, fn in BENCHMARKS:
+            if args.only and group not in args.only:
+                continue
+            print(f"[{group}]", flush=True)
+            for name, operation in fn(args, workdir).items():
+                ops = measure(operation, args.min_time, args.repeat)
+                results[name] = round(ops, 2)
+                print(f"  {name:<40} {ops:>12,.1f} ops/s {1e6 / ops:>12.1f} us/op", flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(summary, baseline, threshold):
+    """Print the change per benchmark; return the names that regressed past `threshold`%."""
+    regressions = []
+    print("\n" + "="*76)
+    print(f"COMPARED TO BASELINE (fail below -{threshold:g}%)")
+    print("="*76)
+    if baseline.get("machine") != summary["machine"]:
+        print(f"  note: baseline was recorded on {baseline.get('machine')}")
+    for name, new in summary["results"].items():
+        old = baseline["results"].get(name)
+        if not old:
+            print(f"  {name:<40} {'new':>12}")
+            continue
+        change = (new - old) / old * 100
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"  {name:<40} {old:>12,.1f} -> {new:>12,.1f} ({change:+6.1f}%){flag}")
+    print("="*76)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hot-path microbenchmarks")
+    parser.add_argument("--only", type=lambda s: s.split(","),
+                        help="comma-separated groups: " + ",".join(g for g, _ in BENCHMARKS))
+    parser.add_argument("--db-rows", type=lambda s: [int(n) for n in s.split(",")],
+                        default=[10_000, 100_000, 1_000_000], help="database sizes to benchmark")
+    parser.add_argument("--users", type=int, default=1000, help="users in users.json for lookups")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per timed batch")
+    parser.add_argument("--repeat", type=int, default=3, help="batches per benchmark; the best counts")
+    parser.add_argument("--quick", action="store_true", help="10k-row database and short batches")
+    parser.add_argument("--output", help="write results as JSON to this file (a baseline)")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output run")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent slower than the baseline that counts as a regression")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.db_rows = [10_000]
+        args.min_time = 0.1
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    summary = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if baseline:
+        regressions = compare(summary, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
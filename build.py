@@ -2,61 +2,140 @@
 """
 Build script for SecureLocal Chat
 Creates single executable with PyInstaller
+
+    python build.py                 # one self-extracting executable
+    python build.py --fast-start    # onedir, pruned, no UPX: nothing to unpack at launch
+    python build.py --measure-only dist/SecureLocalChat/SecureLocalChat.exe
+
+A onefile executable unpacks its whole payload to a temporary directory on
+every launch (and antivirus scans every extracted file) before app.py runs.
+The fast-start build ships the same files already laid out in a directory,
+with bytecode precompiled at -OO, and leaves out stdlib and extension
+modules the app never imports.
 """
 
+import argparse
+import ast
+import json
 import os
 import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import time
+import urllib.request
 from pathlib import Path
 
-def create_build():
-    """Create PyInstaller build"""
-    
-    # Clean previous builds
-    for dir_name in ['build', 'dist']:
-        if os.path.exists(dir_name):
-            shutil.rmtree(dir_name)
-    
-    # Create spec file
-    spec_content = f'''
-# -*- mode: python ; coding: utf-8 -*-
+NAME = 'SecureLocalChat'
 
-a = Analysis(
-    ['app.py'],
-    pathex=[],
-    binaries=[],
-    datas=[
-        ('templates', 'templates'),
-        ('static', 'static'),
-    ],
-    hiddenimports=[
-        'flask',
-        'cryptography',
-        'netifaces',
-    ],
-    hookspath=[],
-    hooksconfig={{}},
-    runtime_hooks=[],
-    excludes=[],
-    noarchive=False,
-    optimize=2,
-)
+REQUIRED_FILES = [
+    'app.py',
+    'security.py',
+    'database.py',
+    'network.py',
+    'server.py',
+    'startup.py',
+    'metrics.py',
+    'profiling.py',
+    'transport.py',
+    'framing.py',
+    'file_transfer.py',
+    'compress.py',
+    'cache.py',
+    'network_daemon.py',
+    'logs.py',
+    'e2e_encryption.py',
+    'templates/setup.html',
+    'templates/login.html',
+    'templates/chat.html',
+    'static/style.css',
+    'app.ico'
+]
+APP_MODULES = [f for f in REQUIRED_FILES if f.endswith('.py')]
 
-pyz = PYZ(a.pure)
+# Needed by PyInstaller's bootloader, or imported lazily inside the stdlib itself
+ALWAYS_KEEP = {
+    'encodings', 'codecs', 'zipimport', 'importlib', 'marshal', 'struct', 'zlib',
+    'multiprocessing', 'cryptography', '_strptime', 'pwd', 'grp', 'gc', 'sysconfig', 'runpy',
+    # Loaded only when a request, file name or log line uses a CJK charset,
+    # which the probe never sends
+    '_multibytecodec', '_codecs_cn', '_codecs_hk', '_codecs_iso2022', '_codecs_jp',
+    '_codecs_kr', '_codecs_tw',
+}
+# Third-party packages that optional imports drag into the graph
+PRUNE_THIRD_PARTY = {'setuptools', 'pkg_resources', 'dotenv', 'numpy', 'PIL', 'IPython', 'pytest'}
+
+# Loads the app the way a session would (every lazy component, every GET page,
+# every project module) and prints the modules that ended up imported
+PROBE = '''
+import json, sys
+sys.argv = ["app.py"]
+import app
+for name in sys.argv[1:]:
+    __import__(name)
+app.profile_startup()
+client = app.app.test_client()
+with client.session_transaction() as s:
+    s["username"] = "probe"
+for rule in app.app.url_map.iter_rules():
+    if "GET" in rule.methods and "<" not in rule.rule:
+        client.get(rule.rule)
+print("MODULES " + json.dumps(sorted(sys.modules)))
+'''
 
+
+# ------------------ Pruning ------------------
+def project_imports():
+    """Top-level names the bundled modules import, including inside functions."""
+    names = set()
+    for path in APP_MODULES:
+        for node in ast.walk(ast.parse(Path(path).read_text(encoding='utf-8'))):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names.add(node.module.split('.')[0])
+    return names
+
+
+def imported_modules():
+    """Top-level modules the app imports at runtime, found by running PROBE."""
+    lazy = [path[:-3] for path in APP_MODULES]
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, APPDATA=home, USERPROFILE=home)
+        result = subprocess.run([sys.executable, '-c', PROBE, *lazy], env=env,
+                                capture_output=True, text=True, timeout=300)
+    for line in result.stdout.splitlines():
+        if line.startswith('MODULES '):
+            return {m.split('.')[0] for m in json.loads(line[8:])}
+    raise RuntimeError(f"Import probe failed:\n{result.stderr}")
+
+
+def prune_list(keep=()):
+    """Stdlib and extension modules to exclude: everything the probe didn't import."""
+    used = imported_modules() | project_imports() | ALWAYS_KEEP | set(keep)
+    # A kept module's C accelerator (multiprocessing -> _multiprocessing) may
+    # only be imported on a path the probe didn't take
+    used |= {'_' + m for m in used}
+    candidates = set(sys.stdlib_module_names) | PRUNE_THIRD_PARTY
+    return sorted(m for m in candidates - used if not m.startswith('__'))
+
+
+# ------------------ Spec ------------------
+def spec(fast_start, excludes):
+    if fast_start:
+        # Binaries stay loose next to the exe; UPX would make every start decompress them
+        exe_and_collect = f'''
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
-    name='SecureLocalChat',
+    exclude_binaries=True,
+    name='{NAME}',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -71,55 +150,200 @@ coll = COLLECT(
     a.binaries,
     a.datas,
     strip=False,
+    upx=False,
+    name='{NAME}',
+)
+'''
+    else:
+        exe_and_collect = f'''
+exe = EXE(
+    pyz,
+    a.scripts,
+    a.binaries,
+    a.datas,
+    [],
+    name='{NAME}',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
     upx=True,
     upx_exclude=[],
-    name='SecureLocalChat',
+    runtime_tmpdir=None,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+    icon='app.ico',
 )
 '''
-    
+
+    return f'''
+# -*- mode: python ; coding: utf-8 -*-
+
+a = Analysis(
+    ['app.py'],
+    pathex=[],
+    binaries=[],
+    datas=[
+        ('templates', 'templates'),
+        ('static', 'static'),
+    ],
+    hiddenimports=[
+        'flask',
+        'cryptography',
+    ],
+    hookspath=[],
+    hooksconfig={{}},
+    runtime_hooks=[],
+    excludes={excludes!r},
+    noarchive=False,
+    optimize=2,
+)
+
+pyz = PYZ(a.pure)
+{exe_and_collect}'''
+
+
+def artifact(fast_start):
+    exe = NAME + ('.exe' if sys.platform == 'win32' else '')
+    return Path('dist') / NAME / exe if fast_start else Path('dist') / exe
+
+
+def create_build(fast_start=False, prune=True, keep=()):
+    """Create PyInstaller build"""
+
+    # Clean previous builds
+    for dir_name in ['build', 'dist']:
+        if os.path.exists(dir_name):
+            shutil.rmtree(dir_name)
+
+    excludes = []
+    if fast_start and prune:
+        print("Finding modules the app imports...")
+        excludes = prune_list(keep)
+        print(f"Pruning {len(excludes)} unused modules: {', '.join(excludes)}")
+
     # Write spec file
-    with open('SecureLocalChat.spec', 'w') as f:
-        f.write(spec_content)
-    
+    with open(f'{NAME}.spec', 'w') as f:
+        f.write(spec(fast_start, excludes))
+
     # Run PyInstaller
-    os.system('pyinstaller --clean --onefile --windowed SecureLocalChat.spec')
-    
+    result = subprocess.run([sys.executable, '-m', 'PyInstaller', '--clean', '--noconfirm', f'{NAME}.spec'])
+    if result.returncode != 0:
+        print("Build failed")
+        sys.exit(result.returncode)
+
+    path = artifact(fast_start)
     print("\n" + "="*50)
     print("Build completed successfully!")
     print("="*50)
-    print("\nExecutable location: dist/SecureLocalChat.exe")
-    print("\nFile size should be approximately 8-12MB")
-    print("\nRequirements for distribution:")
-    print("1. Single .exe file: dist/SecureLocalChat.exe")
-    print("2. Optional: Include README.txt in a .zip archive")
-    print("3. No installer needed - runs directly!")
+    if fast_start:
+        print(f"\nExecutable location: {path}")
+        print(f"\nShip the whole dist/{NAME} folder (e.g. as a .zip)")
+        print(f"Size: {_size(path.parent) / 1e6:.1f} MB")
+    else:
+        print(f"\nExecutable location: {path}")
+        print("\nFile size should be approximately 8-12MB")
+        print("\nRequirements for distribution:")
+        print(f"1. Single .exe file: {path}")
+        print("2. Optional: Include README.txt in a .zip archive")
+        print("3. No installer needed - runs directly!")
     print("\nTest the executable by double-clicking it.")
     print("="*50)
+    return path
+
+
+def _size(path):
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+
+# ------------------ Startup measurement ------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_page(command, timeout=60):
+    """Seconds from launching `command` until its login page answers."""
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, APPDATA=home, USERPROFILE=home)
+        start = time.perf_counter()
+        proc = subprocess.Popen(command + ['--port', str(port)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < timeout:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"{command[0]} exited with {proc.returncode}")
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1).read()
+                    return time.perf_counter() - start
+                except OSError:
+                    time.sleep(0.02)
+            raise RuntimeError(f"{command[0]} did not answer within {timeout}s")
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def measure_startup(command, runs=5):
+    """Launch the app `runs` times; the first launch is the cold one."""
+    times = [time_to_first_page(command) for _ in range(runs)]
+    warm = sorted(times[1:]) or times
+    print("\n" + "="*50)
+    print("STARTUP TIME (launch to first page)")
+    print("="*50)
+    print(f"  {' '.join(command)}")
+    print(f"  cold   {times[0] * 1000:8.0f} ms")
+    print(f"  warm   {warm[len(warm) // 2] * 1000:8.0f} ms (median of {len(warm)})")
+    print("="*50)
+    return times
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the SecureLocal Chat executable")
+    parser.add_argument('--fast-start', action='store_true',
+                        help='onedir build with pruned modules and no UPX, so launch unpacks nothing')
+    parser.add_argument('--no-prune', action='store_true', help='keep every module PyInstaller finds')
+    parser.add_argument('--keep', action='append', default=[], metavar='MODULE',
+                        help='never prune this module (repeatable)')
+    parser.add_argument('--measure', type=int, default=5, metavar='RUNS',
+                        help='time this many launches of the result (0 to skip)')
+    parser.add_argument('--measure-only', metavar='EXE',
+                        help="skip the build; time an existing executable ('python' times python app.py)")
+    return parser.parse_args(argv)
+
 
 if __name__ == '__main__':
+    args = parse_args()
+
+    if args.measure_only:
+        command = [sys.executable, 'app.py'] if args.measure_only == 'python' else [args.measure_only]
+        measure_startup(command, max(args.measure, 1))
+        sys.exit(0)
+
     # Check required files
-    required_files = [
-        'app.py',
-        'security.py',
-        'database.py',
-        'network.py',
-        'templates/setup.html',
-        'templates/login.html',
-        'templates/chat.html',
-        'static/style.css',
-        'app.ico'
-    ]
-    
     missing_files = []
-    for file in required_files:
+    for file in REQUIRED_FILES:
         if not os.path.exists(file):
             missing_files.append(file)
-    
+
     if missing_files:
         print("Error: Missing required files:")
         for file in missing_files:
             print(f"  - {file}")
         print("\nPlease ensure all files are in place before building.")
         sys.exit(1)
-    
-    create_build()
\ No newline at end of file
+
+    path = create_build(fast_start=args.fast_start, prune=not args.no_prune, keep=args.keep)
+    if args.measure:
+        measure_startup([str(path)], args.measure)
@@ -0,0 +1,150 @@
+"""
+In-process LRU cache of conversation windows for DatabaseManager.get_messages
+
+A few active conversations account for nearly all /api/messages polls. The
+cache keeps the formatted result of recent get_messages() calls, keyed by
+conversation and window size, and is bounded both by entry count and by an
+estimate of the memory the cached messages hold. Every write path in
+DatabaseManager either patches cached rows in place (status changes) or
+drops the affected conversation (new or deleted rows).
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+import metrics
+
+LOOKUPS = metrics.counter(
+    "securelocal_message_cache_lookups_total",
+    "Conversation window lookups, by result",
+    ["result"]
+)
+EVICTIONS = metrics.counter(
+    "securelocal_message_cache_evictions_total",
+    "Conversation windows evicted to stay within the cache limits"
+)
+CACHED_BYTES = metrics.gauge(
+    "securelocal_message_cache_bytes",
+    "Estimated memory held by cached conversation windows"
+)
+HIT_RATIO = metrics.gauge(
+    "securelocal_message_cache_hit_ratio",
+    "Share of conversation lookups answered from the cache"
+)
+
+MAX_ENTRIES = 128
+MAX_BYTES = 8 * 1024 * 1024
+
+
+def conversation(user1, user2):
+    """The same key whichever side of the conversation asks."""
+    return (user1, user2) if user1 <= user2 else (user2, user1)
+
+
+def _estimate(messages):
+    return sum(
+        sys.getsizeof(m) + sum(sys.getsizeof(v) for v in m.values())
+        for m in messages
+    )
+
+
+class _Entry:
+    __slots__ = ("messages", "by_id", "size")
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.by_id = {m["id"]: m for m in messages}
+        self.size = _estimate(messages)
+
+
+class MessageCache:
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (conversation, limit) -> _Entry, oldest first
+        self._lock = threading.Lock()
+        self.size = 0
+        self._generation = 0  # bumped by every write, see token()
+        self.hits = 0
+        self.misses = 0
+
+        CACHED_BYTES.set_function(lambda: self.size)
+        HIT_RATIO.set_function(self.hit_rate)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key):
+        """A copy of the cached window, or None; callers may modify what they get."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                LOOKUPS.labels("miss").inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            LOOKUPS.labels("hit").inc()
+            return [dict(m) for m in entry.messages]
+
+    def token(self):
+        """Take before reading the rows to cache; put() ignores results read
+        before a write that landed in between."""
+        return self._generation
+
+    def put(self, key, messages, token):
+        if not self.enabled:
+            return
+        entry = _Entry([dict(m) for m in messages])
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if token != self._generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[key] = entry
+            self.size += entry.size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                EVICTIONS.inc()
+
+    # ------------------ Write path ------------------
+    def invalidate(self, conv):
+        """Drop every cached window of one conversation."""
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if k[0] == conv]:
+                self.size -= self._entries.pop(key).size
+
+    def set_status(self, message_id, status):
+        """Patch a message's status wherever it is cached."""
+        with self._lock:
+            self._generation += 1
+            for entry in self._entries.values():
+                msg = entry.by_id.get(message_id)
+                if msg is not None:
+                    msg["status"] = status
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4),
+        }
@@ -3,7 +3,8 @@ Check network configuration
 """
 
 import socket
-# import netifaces  # Optional, install with: pip install netifaces
+
+from transport import SocketTransport, broadcast_address
 
 def check_network():
     print("="*60)
@@ -34,6 +35,14 @@ def check_network():
     except:
         pass
     
+    # Interfaces discovery will use
+    print("\nDiscovery interfaces:")
+    interfaces = SocketTransport().interfaces()
+    for iface in interfaces:
+        print(f"  - {iface.name}: {iface.ip} netmask {iface.netmask} broadcast {broadcast_address(iface)}")
+    if not interfaces:
+        print("  (none found)")
+
     # Check UDP broadcasting
     print("\nTesting UDP broadcast...")
     test_udp_broadcast()
@@ -45,12 +54,9 @@ def test_udp_broadcast():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     
-    # Test broadcast addresses
-    test_addresses = [
-        ('255.255.255.255', 6667),
-        ('192.168.1.255', 6667),
-        ('192.168.0.255', 6667),
-        ('10.255.255.255', 6667),
+    # The limited broadcast plus each interface's own subnet broadcast
+    test_addresses = [('255.255.255.255', 6667)] + [
+        (addr, 6667) for addr in map(broadcast_address, SocketTransport().interfaces()) if addr
     ]
     
     for addr, port in test_addresses:
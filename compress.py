@@ -0,0 +1,190 @@
+"""
+Payload compression, negotiated per peer and applied before encryption
+
+Peers list the codecs they can decode in their discovery beacons and the
+sender picks the first one in its own preference order. zlib is always
+available; zstd is used when the interpreter has it (the stdlib
+compression.zstd module on 3.14+, or the zstandard package).
+
+Short chat messages barely compress on their own, so they are compressed
+against a shared dictionary: a built-in seed at first, then a per-peer
+dictionary built from recent traffic to that peer and shipped to it once
+(see NetworkManager._maybe_send_dictionary). The codec label carried in the
+encrypted envelope, e.g. "zlib" or "zstd:3f9a0c12", names the dictionary.
+"""
+
+import hashlib
+import zlib
+
+import metrics
+
+try:
+    from compression import zstd as _zstd  # Python 3.14+
+except ImportError:
+    _zstd = None
+    try:
+        import zstandard as _zstandard
+    except ImportError:
+        _zstandard = None
+else:
+    _zstandard = None
+
+CODECS = (["zstd"] if _zstd or _zstandard else []) + ["zlib"]
+
+MIN_SIZE = 32               # below this not even a dictionary helps
+DICTIONARY_MAX_INPUT = 4096 # only messages up to this size use a dictionary
+DICTIONARY_SIZE = 16 * 1024
+MAX_OUTPUT = 16 * 1024 * 1024
+
+INPUT_BYTES = metrics.counter(
+    "securelocal_compression_input_bytes_total",
+    "Payload bytes offered for compression",
+    ["codec"]
+)
+OUTPUT_BYTES = metrics.counter(
+    "securelocal_compression_output_bytes_total",
+    "Payload bytes actually sent after compression",
+    ["codec"]
+)
+SAVED_BYTES = metrics.counter(
+    "securelocal_compression_saved_bytes_total",
+    "Bytes saved by compressing payloads before encryption",
+    ["codec", "dictionary"]
+)
+
+# Common words and fragments of chat, logs and code; ids are content hashes
+SEED_DICTIONARY = (
+    b"Traceback (most recent call last):\n  File \"\", line , in \n"
+    b"ERROR WARNING INFO DEBUG Exception: error: failed to connect timeout "
+    b"def return self import from class function const let var if else for while "
+    b"true false null None True False {\"id\": \"name\": \"type\": \"status\": "
+    b"http://https://localhost:127.0.0.1 /api/ .py .js .json .log "
+    b"Hi hello hey thanks thank you ok okay yes no please sorry see you later "
+    b"what when where why how can you could you I think I'm going to the "
+    b"meeting today tomorrow this morning afternoon let me know sounds good "
+)
+
+
+def dictionary_id(content):
+    return hashlib.sha256(content).hexdigest()[:8]
+
+
+SEED_ID = dictionary_id(SEED_DICTIONARY)
+
+
+def negotiate(peer_codecs):
+    """Pick the first of our codecs the peer also decodes, or None."""
+    for codec in CODECS:
+        if codec in (peer_codecs or ()):
+            return codec
+    return None
+
+
+def _compress(codec, data, dictionary):
+    if codec == "zlib":
+        c = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=dictionary) if dictionary \
+            else zlib.compressobj(6, zlib.DEFLATED, -15)
+        return c.compress(data) + c.flush()
+
+    if codec == "zstd":
+        if _zstd:
+            zdict = _zstd.ZstdDict(dictionary, is_raw=True) if dictionary else None
+            return _zstd.compress(data, level=3, zstd_dict=zdict)
+        zdict = _zstandard.ZstdCompressionDict(
+            dictionary, dict_type=_zstandard.DICT_TYPE_RAWCONTENT) if dictionary else None
+        return _zstandard.ZstdCompressor(level=3, dict_data=zdict).compress(data)
+
+    raise ValueError(f"unknown codec {codec}")
+
+
+def _decompress(codec, data, dictionary):
+    if codec == "zlib":
+        d = zlib.decompressobj(-15, zdict=dictionary) if dictionary else zlib.decompressobj(-15)
+        out = d.decompress(data, MAX_OUTPUT)
+        if d.unconsumed_tail:
+            raise ValueError("decompressed payload too large")
+        return out
+
+    if codec == "zstd":
+        if _zstd:
+            zdict = _zstd.ZstdDict(dictionary, is_raw=True) if dictionary else None
+            d = _zstd.ZstdDecompressor(zstd_dict=zdict)
+            out = d.decompress(data, MAX_OUTPUT)
+            if not d.eof:
+                raise ValueError("decompressed payload too large")
+            return out
+        if _zstandard is None:
+            raise ValueError("zstd not available")
+        zdict = _zstandard.ZstdCompressionDict(
+            dictionary, dict_type=_zstandard.DICT_TYPE_RAWCONTENT) if dictionary else None
+        return _zstandard.ZstdDecompressor(dict_data=zdict).decompress(data, max_output_size=MAX_OUTPUT)
+
+    raise ValueError(f"unknown codec {codec}")
+
+
+def pack(data, codec, dictionary=None, dict_id=None):
+    """Compress `data` if that makes it smaller.
+
+    Returns (payload, label); label is None when the data is sent as-is.
+    """
+    if not codec or len(data) < MIN_SIZE:
+        return data, None
+
+    use_dictionary = len(data) <= DICTIONARY_MAX_INPUT
+    if use_dictionary and dictionary is None:
+        dictionary, dict_id = SEED_DICTIONARY, SEED_ID
+    if not use_dictionary:
+        dictionary = dict_id = None
+
+    packed = _compress(codec, data, dictionary)
+    INPUT_BYTES.labels(codec).inc(len(data))
+    if len(packed) >= len(data):
+        OUTPUT_BYTES.labels(codec).inc(len(data))
+        return data, None
+
+    OUTPUT_BYTES.labels(codec).inc(len(packed))
+    kind = "none" if dict_id is None else "seed" if dict_id == SEED_ID else "peer"
+    SAVED_BYTES.labels(codec, kind).inc(len(data) - len(packed))
+    return packed, f"{codec}:{dict_id}" if dict_id else codec
+
+
+class UnknownDictionary(KeyError):
+    pass
+
+
+def unpack(payload, label, dictionaries):
+    """Reverse pack(); `dictionaries` maps dictionary id -> content for the sender."""
+    if not label:
+        return payload
+    codec, _, dict_id = label.partition(":")
+    dictionary = None
+    if dict_id:
+        dictionary = SEED_DICTIONARY if dict_id == SEED_ID else dictionaries.get(dict_id)
+        if dictionary is None:
+            raise UnknownDictionary(dict_id)
+    return _decompress(codec, payload, dictionary)
+
+
+class History:
+    """Recent short messages to one peer, the raw material of its next dictionary."""
+
+    def __init__(self, size=DICTIONARY_SIZE):
+        self.size = size
+        self.buffer = bytearray(SEED_DICTIONARY)
+        self.fresh = 0  # bytes added since the last dictionary was taken
+
+    def add(self, data):
+        if len(data) > DICTIONARY_MAX_INPUT:
+            return
+        self.buffer += data
+        del self.buffer[:max(len(self.buffer) - self.size, 0)]
+        self.fresh += len(data)
+
+    def ready(self):
+        """A new dictionary is worth sending once half of it would be new material."""
+        return self.fresh >= self.size // 2
+
+    def take(self):
+        self.fresh = 0
+        content = bytes(self.buffer)
+        return dictionary_id(content), content
@@ -2,151 +2,696 @@
 DatabaseManager with read receipts & typing indicators
 """
 
+import os
 import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from threading import Lock
 
+import metrics
+import profiling
+import cache
+from cache import MessageCache, conversation
+
+LOCK_WAIT_SECONDS = metrics.histogram(
+    "securelocal_db_lock_wait_seconds",
+    "Time spent waiting for the DatabaseManager write lock"
+)
+COMMIT_SECONDS = metrics.histogram(
+    "securelocal_db_commit_seconds",
+    "Time spent in SQLite commits"
+)
+
+# ---------------- Message IDs ----------------
+_id_lock = Lock()
+_last_ms = 0
+_seq = 0
+
+def new_message_id():
+    """A globally unique, time-ordered message id in UUIDv7 layout: 48-bit
+    millisecond timestamp, 12-bit counter for ids minted in the same
+    millisecond, 62 random bits. Ids sort by creation time, so inserts land
+    at the end of the unique index."""
+    global _last_ms, _seq
+    with _id_lock:
+        ms = int(time.time() * 1000)
+        if ms <= _last_ms:
+            ms, _seq = _last_ms, _seq + 1
+            if _seq > 0xfff:
+                ms, _seq = ms + 1, 0
+        else:
+            _seq = 0
+        _last_ms = ms
+        seq = _seq
+    rand = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    return str(uuid.UUID(int=(ms << 80) | (0x7 << 76) | (seq << 64) | (0b10 << 62) | rand))
+
+def _legacy_message_id(timestamp, row_id):
+    # Rows from before ids existed: same time ordering, but version nibble 0 so
+    # they are never mistaken for (or synced as) ids another peer also holds
+    ms = int(datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return str(uuid.UUID(int=(ms << 80) | (row_id & ((1 << 76) - 1))))
+
+# Only ids minted by new_message_id() are shared between peers
+_SHARED_UID = "substr(uid, 15, 1) = '7'"
+
+def _shared_uid(value):
+    """Whether a peer-supplied id looks like one new_message_id() minted."""
+    try:
+        return isinstance(value, str) and str(uuid.UUID(value)) == value and value[14] == "7"
+    except ValueError:
+        return False
+
+def _utc_timestamp(value):
+    """A peer-supplied timestamp in the form CURRENT_TIMESTAMP stores (UTC), or None."""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
 class DatabaseManager:
-    def __init__(self, db_path):
+    # Bump when initialize_database() gains a migration step
+    SCHEMA_VERSION = 5
+
+    # Receipt states in delivery order; a receipt never moves backwards
+    STATUS_RANK = {"sent": 0, "delivered": 1, "read": 2}
+
+    def __init__(self, db_path, cache_entries=cache.MAX_ENTRIES, cache_bytes=cache.MAX_BYTES):
         self.db_path = Path(db_path)
         self.connection = None
         self.lock = Lock()  # Thread-safe for Flask
         self.typing_users = set()  # In-memory: (username, recipient)
+        # Hot conversation windows; every write below keeps it current
+        self.message_cache = MessageCache(cache_entries, cache_bytes)
         self.connect()
         self.initialize_database()
 
     def connect(self):
-        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
         self.connection.row_factory = sqlite3.Row
+        if str(self.db_path) != ":memory:":
+            # WAL lets the web processes read while the network daemon writes
+            # (network_daemon.py); NORMAL is durable across crashes in WAL mode
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._data_version = None
 
-    def initialize_database(self):
-        """Create tables if they do not exist and ensure 'status' column exists."""
+    def _check_external_writes(self):
+        """Drop cached reads if another process committed since the last check."""
+        version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            if self._data_version is not None:
+                self.message_cache.clear()
+            self._data_version = version
+
+    @contextmanager
+    def _locked(self):
+        start = time.perf_counter()
         with self.lock:
+            acquired = time.perf_counter()
+            LOCK_WAIT_SECONDS.observe(acquired - start)
+            profiling.record("lock_wait", acquired - start)
+            try:
+                yield
+            finally:
+                profiling.record("sql", time.perf_counter() - acquired)
+
+    def _commit(self):
+        start = time.perf_counter()
+        self.connection.commit()
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+
+    def initialize_database(self):
+        """Create tables and run migrations, unless the stored schema version is current."""
+        with self._locked():
             cursor = self.connection.cursor()
 
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    username TEXT PRIMARY KEY,
-                    security_mode INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= self.SCHEMA_VERSION:
+                return
 
-            # Messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender TEXT NOT NULL,
-                    recipient TEXT NOT NULL,
-                    message TEXT NOT NULL,
-                    is_encrypted INTEGER DEFAULT 0,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            if version < 1:
+                self._create_base_schema(cursor)
+            if version < 2:
+                self._create_group_schema(cursor)
+            if version < 3:
+                self._add_origin_ids(cursor)
+            if version < 4:
+                self._add_message_uids(cursor)
+            if version < 5:
+                self._create_peer_schema(cursor)
 
-            # Ensure 'status' column exists
-            cursor.execute("PRAGMA table_info(messages)")
-            columns = [c[1] for c in cursor.fetchall()]
-            if "status" not in columns:
-                cursor.execute('ALTER TABLE messages ADD COLUMN status TEXT DEFAULT "sent"')
+            cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._commit()
 
-            # Indexes for faster queries
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(sender, recipient)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+    def _create_base_schema(self, cursor):
+        # Users table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                security_mode INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
 
-            self.connection.commit()
+        # Messages table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                is_encrypted INTEGER DEFAULT 0,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Ensure 'status' column exists (databases created before it was added)
+        cursor.execute("PRAGMA table_info(messages)")
+        columns = [c[1] for c in cursor.fetchall()]
+        if "status" not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN status TEXT DEFAULT "sent"')
+
+        # Indexes for faster queries
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(sender, recipient)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+
+    def _create_group_schema(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS groups (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_by TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                group_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                PRIMARY KEY (group_id, username)
+            )
+        ''')
+
+        # A group message is one row in messages (recipient = group id) plus one
+        # receipt per member other than the sender
+        cursor.execute("PRAGMA table_info(messages)")
+        if "group_id" not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE messages ADD COLUMN group_id TEXT')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_receipts (
+                message_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'sent',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (message_id, username)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_group ON messages(group_id, timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(username)')
+
+    def _add_origin_ids(self, cursor):
+        # For received messages: the id the sender stored it under, used to
+        # find what is missing when two peers sync
+        cursor.execute("PRAGMA table_info(messages)")
+        if "origin_id" not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE messages ADD COLUMN origin_id INTEGER')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_origin ON messages(sender, origin_id)')
+
+    def _add_message_uids(self, cursor):
+        # uid is the sender-minted id every copy of a message shares; it
+        # supersedes origin_id for sync, receipts and deduplication
+        cursor.execute("PRAGMA table_info(messages)")
+        if "uid" not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE messages ADD COLUMN uid TEXT')
+        cursor.execute('SELECT id, timestamp FROM messages WHERE uid IS NULL')
+        cursor.executemany(
+            'UPDATE messages SET uid = ? WHERE id = ?',
+            [(_legacy_message_id(ts, row_id), row_id) for row_id, ts in cursor.fetchall()]
+        )
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages(uid)')
+
+    def _create_peer_schema(self, cursor):
+        # Where each peer was last reached, so a restart can probe it directly
+        # instead of waiting for (or never getting) a discovery beacon
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS peers (
+                username TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                ip TEXT NOT NULL,
+                tcp_port INTEGER NOT NULL,
+                fingerprint TEXT,
+                last_seen REAL NOT NULL
+            )
+        ''')
 
     # ---------------- User Methods ----------------
     def add_user(self, username, security_mode=1):
-        with self.lock:
+        with self._locked():
             cursor = self.connection.cursor()
             try:
                 cursor.execute(
                     'INSERT OR REPLACE INTO users (username, security_mode) VALUES (?, ?)',
                     (username, security_mode)
                 )
-                self.connection.commit()
+                self._commit()
                 return True
             except:
                 return False
 
     def user_exists(self, username):
-        cursor = self.connection.cursor()
-        cursor.execute('SELECT 1 FROM users WHERE username = ?', (username,))
-        return cursor.fetchone() is not None
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT 1 FROM users WHERE username = ?', (username,))
+            return cursor.fetchone() is not None
 
     def update_user_mode(self, username, security_mode):
-        with self.lock:
+        with self._locked():
             cursor = self.connection.cursor()
             cursor.execute(
                 'UPDATE users SET security_mode = ? WHERE username = ?',
                 (security_mode, username)
             )
-            self.connection.commit()
+            self._commit()
 
     # ---------------- Message Methods ----------------
-    def save_message(self, sender, recipient, message, is_encrypted=False):
-        with self.lock:
+    def save_message(self, sender, recipient, message, is_encrypted=False, status="sent",
+                     uid=None):
+        """Store a message and return its local id.
+
+        `uid` is the sender's message id (a new one is minted if omitted).
+        Saving the same uid again is a no-op that returns the existing row's id.
+        """
+        with self._locked():
             cursor = self.connection.cursor()
             cursor.execute('''
-                INSERT INTO messages (sender, recipient, message, is_encrypted, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (sender, recipient, message, is_encrypted, "sent"))
-            self.connection.commit()
-            return cursor.lastrowid
-
-    def get_messages(self, user1, user2, limit=50):
-        cursor = self.connection.cursor()
-        cursor.execute('''
-            SELECT * FROM messages
-            WHERE (sender = ? AND recipient = ?)
-               OR (sender = ? AND recipient = ?)
-            ORDER BY timestamp ASC
-            LIMIT ?
-        ''', (user1, user2, user2, user1, limit))
+                INSERT OR IGNORE INTO messages (sender, recipient, message, is_encrypted, status, uid)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (sender, recipient, message, is_encrypted, status, uid or new_message_id()))
+            inserted = cursor.rowcount
+            self._commit()
+            if inserted:
+                self.message_cache.invalidate(conversation(sender, recipient))
+                return cursor.lastrowid
+            cursor.execute('SELECT id FROM messages WHERE uid = ?', (uid,))
+            return cursor.fetchone()[0]
+
+    def get_messages(self, user1, user2, limit=50, before=None):
+        """The newest `limit` messages of a conversation, oldest first.
+
+        Pass the uid of the oldest message already shown as `before` to page
+        further back. Messages are ordered by uid, i.e. by when the sender
+        wrote them.
+        """
+        key = (conversation(user1, user2), limit, before)
+        self._check_external_writes()
+        cached = self.message_cache.get(key)
+        if cached is not None:
+            return cached
+        token = self.message_cache.token()
+
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                SELECT * FROM (
+                    SELECT * FROM messages
+                    WHERE ((sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?))
+                      AND uid < ?
+                    ORDER BY uid DESC
+                    LIMIT ?
+                ) ORDER BY uid ASC
+            ''', (user1, user2, user2, user1, before or "~", limit))  # "~" sorts after every uid
+            rows = cursor.fetchall()
 
         messages = []
         gmt_plus_2 = timezone(timedelta(hours=2))
 
-        for row in cursor.fetchall():
+        for row in rows:
             msg = dict(row)
             utc_dt = datetime.fromisoformat(msg['timestamp'])
             local_dt = utc_dt.replace(tzinfo=timezone.utc).astimezone(gmt_plus_2)
             msg['timestamp'] = local_dt.strftime('%Y-%m-%d %H:%M:%S')
             messages.append(msg)
 
+        self.message_cache.put(key, messages, token)
         return messages
 
     def update_message_status(self, message_id, status):
         """Update a single message's status: sent, delivered, read"""
-        with self.lock:
+        with self._locked():
             cursor = self.connection.cursor()
             cursor.execute(
                 'UPDATE messages SET status = ? WHERE id = ?',
                 (status, message_id)
             )
-            self.connection.commit()
+            self._commit()
+            self.message_cache.set_status(message_id, status)
+
+    def update_message_statuses(self, message_ids, status):
+        """update_message_status() for many messages in one transaction."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        with self._locked():
+            self.connection.executemany(
+                'UPDATE messages SET status = ? WHERE id = ?',
+                [(status, message_id) for message_id in message_ids]
+            )
+            self._commit()
+            for message_id in message_ids:
+                self.message_cache.set_status(message_id, status)
+
+    def mark_read(self, username, message_ids):
+        return self.update_received_statuses(username, message_ids, 'read')
+
+    def update_received_statuses(self, username, message_ids, status):
+        """Set the status of messages on behalf of `username`: only direct
+        messages to them and others' messages in their groups. Returns the
+        ids updated."""
+        marked = []
+        with self._locked():
+            cursor = self.connection.cursor()
+            for message_id in message_ids:
+                cursor.execute('''
+                    UPDATE messages SET status = ?
+                    WHERE id = ? AND (
+                        (group_id IS NULL AND recipient = ?)
+                        OR (sender != ? AND group_id IN (SELECT group_id FROM group_members WHERE username = ?))
+                    )
+                ''', (status, message_id, username, username, username))
+                if cursor.rowcount:
+                    marked.append(message_id)
+            self._commit()
+            for message_id in marked:
+                self.message_cache.set_status(message_id, status)
+        return marked
+
+    def get_message(self, message_id):
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT * FROM messages WHERE id = ?', (message_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def get_message_by_uid(self, uid):
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT * FROM messages WHERE uid = ?', (uid,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def advance_message_status(self, uid, status):
+        """Apply a peer's receipt to the message with this uid; never moves backwards.
+
+        Returns the message row, or None if no such message is stored.
+        """
+        with self._locked():
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                UPDATE messages SET status = ?
+                WHERE uid = ?
+                  AND CASE status WHEN 'read' THEN 2 WHEN 'delivered' THEN 1 ELSE 0 END < ?
+            ''', (status, uid, self.STATUS_RANK[status]))
+            self._commit()
+            cursor.execute('SELECT * FROM messages WHERE uid = ?', (uid,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            self.message_cache.set_status(row["id"], row["status"])
+            return dict(row)
 
     def get_unread_messages(self, recipient):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            'SELECT * FROM messages WHERE recipient = ? AND status != "read"',
-            (recipient,)
-        )
-        return [dict(row) for row in cursor.fetchall()]
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute(
+                'SELECT * FROM messages WHERE recipient = ? AND status != "read"',
+                (recipient,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
 
     def clear_old_messages(self, days=30):
-        with self.lock:
+        with self._locked():
             cursor = self.connection.cursor()
             cursor.execute(
                 'DELETE FROM messages WHERE timestamp < datetime("now", ?)',
                 (f"-{days} days",)
             )
-            self.connection.commit()
+            self._commit()
+            self.message_cache.clear()
             return cursor.rowcount
 
+    # ---------------- Peer Sync Methods ----------------
+    def get_sync_marks(self, me, peer):
+        """High-water marks for the direct conversation with `peer`.
+
+        received: the newest message id we hold from the peer ("" if none).
+        unread: our oldest message to the peer not yet read (None if all are),
+        i.e. where the peer's status changes for us start to matter.
+        """
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute(f'''
+                SELECT MAX(uid) FROM messages
+                WHERE sender = ? AND recipient = ? AND group_id IS NULL AND {_SHARED_UID}
+            ''', (peer, me))
+            received = cursor.fetchone()[0] or ""
+            cursor.execute(f'''
+                SELECT MIN(uid) FROM messages
+                WHERE sender = ? AND recipient = ? AND group_id IS NULL AND {_SHARED_UID}
+                  AND status != 'read'
+            ''', (me, peer))
+            unread = cursor.fetchone()[0]
+            return {"received": received, "unread": unread}
+
+    def get_outgoing_since(self, me, peer, after_uid, limit=500):
+        """Our messages to `peer` newer than its high-water mark, plus any never
+        acknowledged before it (the receiver drops ones it already has)."""
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute(f'''
+                SELECT uid, message, timestamp FROM messages
+                WHERE sender = ? AND recipient = ? AND group_id IS NULL AND {_SHARED_UID}
+                  AND (uid > ? OR status = 'sent')
+                ORDER BY uid
+                LIMIT ?
+            ''', (me, peer, after_uid or "", limit + 1))
+            rows = [dict(row) for row in cursor.fetchall()]
+            return rows[:limit], len(rows) > limit
+
+    def get_status_changes(self, me, peer, from_uid, limit=5000):
+        """Current status of the peer's messages to us from `from_uid` on,
+        one entry per message however many times it changed."""
+        if from_uid is None:
+            return []
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                SELECT uid, status FROM messages
+                WHERE sender = ? AND recipient = ? AND group_id IS NULL
+                  AND uid >= ? AND status != 'sent'
+                ORDER BY uid
+                LIMIT ?
+            ''', (peer, me, from_uid, limit))
+            return [[row[0], row[1]] for row in cursor.fetchall()]
+
+    def save_synced_messages(self, sender, recipient, messages, status="delivered"):
+        """Store messages a peer synced to us, skipping any we already hold.
+
+        Entries without a text message and a shared id are dropped; a
+        timestamp that doesn't parse is replaced with the time of arrival.
+        Returns the stored messages with their new local ids.
+        """
+        stored = []
+        with self._locked():
+            cursor = self.connection.cursor()
+            for msg in messages:
+                if not (isinstance(msg, dict) and isinstance(msg.get("message"), str)
+                        and _shared_uid(msg.get("uid"))):
+                    continue
+                cursor.execute('''
+                    INSERT OR IGNORE INTO messages (sender, recipient, message, is_encrypted, status, uid, timestamp)
+                    VALUES (?, ?, ?, 1, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                ''', (sender, recipient, msg["message"], status, msg["uid"], _utc_timestamp(msg.get("timestamp"))))
+                if cursor.rowcount:
+                    stored.append({**msg, "local_id": cursor.lastrowid})
+            self._commit()
+            if stored:
+                self.message_cache.invalidate(conversation(sender, recipient))
+        return stored
+
+    def apply_status_changes(self, me, peer, changes):
+        """Advance our messages to `peer` to the statuses it reported; never backwards."""
+        rows = [
+            (change[1], change[0], me, peer, self.STATUS_RANK[change[1]])
+            for change in changes
+            if isinstance(change, (list, tuple)) and len(change) == 2
+            and isinstance(change[0], str) and isinstance(change[1], str) and change[1] in self.STATUS_RANK
+        ]
+        with self._locked():
+            cursor = self.connection.cursor()
+            cursor.executemany('''
+                UPDATE messages SET status = ?
+                WHERE uid = ? AND sender = ? AND recipient = ?
+                  AND CASE status WHEN 'read' THEN 2 WHEN 'delivered' THEN 1 ELSE 0 END < ?
+            ''', rows)
+            self._commit()
+            if cursor.rowcount:
+                self.message_cache.invalidate(conversation(me, peer))
+            return cursor.rowcount
+
+    # ---------------- Peer Methods ----------------
+    def save_peer(self, username, user_id, ip, tcp_port, fingerprint=None, last_seen=None):
+        with self._locked():
+            self.connection.execute('''
+                INSERT INTO peers (username, user_id, ip, tcp_port, fingerprint, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET
+                    user_id = excluded.user_id, ip = excluded.ip, tcp_port = excluded.tcp_port,
+                    fingerprint = excluded.fingerprint, last_seen = excluded.last_seen
+            ''', (username, user_id, ip, tcp_port, fingerprint, last_seen or time.time()))
+            self._commit()
+
+    def get_known_peers(self, max_age=None, limit=500):
+        """Peers seen within `max_age` seconds, most recently seen first."""
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute(
+                'SELECT * FROM peers WHERE last_seen >= ? ORDER BY last_seen DESC LIMIT ?',
+                (time.time() - max_age if max_age else 0, limit)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+    # ---------------- Group Methods ----------------
+    def create_group(self, group_id, name, created_by, members):
+        """Create a group (or add members to an existing one with the same id)."""
+        with self._locked():
+            cursor = self.connection.cursor()
+            cursor.execute(
+                'INSERT OR IGNORE INTO groups (id, name, created_by) VALUES (?, ?, ?)',
+                (group_id, name, created_by)
+            )
+            cursor.executemany(
+                'INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)',
+                [(group_id, m) for m in set(members) | {created_by}]
+            )
+            self._commit()
+
+    def get_group(self, group_id):
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT * FROM groups WHERE id = ?', (group_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            group = dict(row)
+            cursor.execute(
+                'SELECT username FROM group_members WHERE group_id = ? ORDER BY username',
+                (group_id,)
+            )
+            group["members"] = [r[0] for r in cursor.fetchall()]
+            return group
+
+    def get_groups(self, username):
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                SELECT g.* FROM groups g
+                JOIN group_members m ON m.group_id = g.id
+                WHERE m.username = ?
+                ORDER BY g.name
+            ''', (username,))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def save_group_message(self, sender, group_id, message, members, is_encrypted=False,
+                           status="sent", uid=None):
+        """Store one message row and a receipt for every member but the sender.
+
+        Like save_message(), saving a uid that is already stored is a no-op.
+        """
+        with self._locked():
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO messages (sender, recipient, message, is_encrypted, status, group_id, uid)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (sender, group_id, message, is_encrypted, status, group_id, uid or new_message_id()))
+            if cursor.rowcount == 0:
+                self._commit()
+                cursor.execute('SELECT id FROM messages WHERE uid = ?', (uid,))
+                return cursor.fetchone()[0]
+            msg_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO message_receipts (message_id, username, status) VALUES (?, ?, ?)',
+                [(msg_id, m, status) for m in members if m != sender]
+            )
+            self._commit()
+            self.message_cache.invalidate(conversation(sender, group_id))
+            return msg_id
+
+    def get_group_messages(self, group_id, limit=50, before=None):
+        """The newest group messages oldest first, each with a `receipts` map of
+        member -> status; `before` pages back as in get_messages()."""
+        with profiling.span("sql"):
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                SELECT * FROM (
+                    SELECT * FROM messages
+                    WHERE group_id = ? AND uid < ?
+                    ORDER BY uid DESC
+                    LIMIT ?
+                ) ORDER BY uid ASC
+            ''', (group_id, before or "~", limit))
+            messages = [dict(row) for row in cursor.fetchall()]
+
+            receipts = {m["id"]: {} for m in messages}
+            if receipts:
+                marks = ",".join("?" * len(receipts))
+                cursor.execute(
+                    f'SELECT message_id, username, status FROM message_receipts WHERE message_id IN ({marks})',
+                    list(receipts)
+                )
+                for message_id, username, status in cursor.fetchall():
+                    receipts[message_id][username] = status
+
+        gmt_plus_2 = timezone(timedelta(hours=2))
+        for msg in messages:
+            utc_dt = datetime.fromisoformat(msg['timestamp'])
+            msg['timestamp'] = utc_dt.replace(tzinfo=timezone.utc).astimezone(gmt_plus_2).strftime('%Y-%m-%d %H:%M:%S')
+            msg['receipts'] = receipts[msg['id']]
+        return messages
+
+    def update_receipt(self, message_id, username, status):
+        """Advance one member's receipt, then roll the message status up to the
+        least advanced member (read only once everyone has read it)."""
+        rank = self.STATUS_RANK[status]
+        with self._locked():
+            cursor = self.connection.cursor()
+            cursor.execute('''
+                UPDATE message_receipts SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE message_id = ? AND username = ?
+                  AND CASE status WHEN 'read' THEN 2 WHEN 'delivered' THEN 1 ELSE 0 END < ?
+            ''', (status, message_id, username, rank))
+            cursor.execute('''
+                UPDATE messages SET status = (
+                    SELECT CASE MIN(CASE status WHEN 'read' THEN 2 WHEN 'delivered' THEN 1 ELSE 0 END)
+                           WHEN 2 THEN 'read' WHEN 1 THEN 'delivered' ELSE 'sent' END
+                    FROM message_receipts WHERE message_id = ?
+                )
+                WHERE id = ? AND EXISTS (SELECT 1 FROM message_receipts WHERE message_id = ?)
+            ''', (message_id, message_id, message_id))
+            self._commit()
+            cursor.execute('SELECT status FROM messages WHERE id = ?', (message_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                self.message_cache.set_status(message_id, row[0])
+
     # ---------------- Typing Indicator Methods ----------------
     def user_started_typing(self, username, recipient):
         """Call when user starts typing"""
@@ -2,32 +2,183 @@ from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.Random import get_random_bytes
 import base64
+import hashlib
+import hmac
 import os
 import json
+import time
+
+import metrics
+import profiling
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    X25519PrivateKey = None
+
+# Ways a peer can hand us a session key, best first; advertised in beacons
+# ("keys" for x25519, "public_key" for rsa)
+KEY_AGREEMENTS = (["x25519"] if X25519PrivateKey else []) + ["rsa"]
+
+CRYPTO_SECONDS = metrics.histogram(
+    "securelocal_crypto_seconds",
+    "Time spent in end-to-end encryption operations",
+    ["op"]
+)
+_ENCRYPT = CRYPTO_SECONDS.labels("encrypt")
+_DECRYPT = CRYPTO_SECONDS.labels("decrypt")
+_WRAP_KEY = CRYPTO_SECONDS.labels("wrap_session_key")
+_UNWRAP_KEY = CRYPTO_SECONDS.labels("unwrap_session_key")
+_AGREE_KEY = CRYPTO_SECONDS.labels("agree_session_key")
+_DERIVE_KEY = CRYPTO_SECONDS.labels("derive_session_key")
+_ENCRYPT_CHUNK = CRYPTO_SECONDS.labels("encrypt_chunk")
+_DECRYPT_CHUNK = CRYPTO_SECONDS.labels("decrypt_chunk")
 
 # -------------------- RSA Key Management --------------------
-def generate_rsa_keys(user_id):
-    """Generate and save RSA public/private key pair."""
+def generate_rsa_keys(user_id, keys_dir='keys'):
+    """Generate and save RSA public/private key pair.
+
+    Returns (public key PEM bytes, private RsaKey), the same as load_rsa_keys().
+    """
     key = RSA.generate(2048)
     private_key = key.export_key()
     public_key = key.publickey().export_key()
 
     # Save keys locally
-    os.makedirs(f'keys/{user_id}', exist_ok=True)
-    with open(f'keys/{user_id}/private.pem', 'wb') as f:
+    key_dir = os.path.join(keys_dir, user_id)
+    os.makedirs(key_dir, exist_ok=True)
+    with open(os.path.join(key_dir, 'private.pem'), 'wb') as f:
         f.write(private_key)
-    with open(f'keys/{user_id}/public.pem', 'wb') as f:
+    with open(os.path.join(key_dir, 'public.pem'), 'wb') as f:
         f.write(public_key)
 
-    return public_key, private_key
+    return public_key, key
 
-def load_rsa_keys(user_id):
-    with open(f'keys/{user_id}/private.pem', 'rb') as f:
+def load_rsa_keys(user_id, keys_dir='keys'):
+    key_dir = os.path.join(keys_dir, user_id)
+    with open(os.path.join(key_dir, 'private.pem'), 'rb') as f:
         private_key = RSA.import_key(f.read())
-    with open(f'keys/{user_id}/public.pem', 'rb') as f:
-        public_key = RSA.import_key(f.read())
+    with open(os.path.join(key_dir, 'public.pem'), 'rb') as f:
+        public_key = f.read()
     return public_key, private_key
 
+# -------------------- X25519 / Ed25519 Key Management --------------------
+def _raw(public_key):
+    return public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def _ec_public(private_keys):
+    agreement, identity = private_keys
+    return {
+        'x25519': base64.b64encode(_raw(agreement.public_key())).decode(),
+        'ed25519': base64.b64encode(_raw(identity.public_key())).decode(),
+    }
+
+def generate_ec_keys(user_id, keys_dir='keys'):
+    """Generate and save an X25519 (key agreement) and Ed25519 (identity) key pair.
+
+    Returns (public keys for beacons, (X25519 private key, Ed25519 private key)),
+    the same as load_ec_keys(). Public keys are 32 bytes, base64 encoded.
+    """
+    private_keys = (X25519PrivateKey.generate(), Ed25519PrivateKey.generate())
+
+    key_dir = os.path.join(keys_dir, user_id)
+    os.makedirs(key_dir, exist_ok=True)
+    for name, key in zip(('x25519.pem', 'ed25519.pem'), private_keys):
+        with open(os.path.join(key_dir, name), 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+
+    return _ec_public(private_keys), private_keys
+
+def load_ec_keys(user_id, keys_dir='keys'):
+    key_dir = os.path.join(keys_dir, user_id)
+    private_keys = []
+    for name in ('x25519.pem', 'ed25519.pem'):
+        with open(os.path.join(key_dir, name), 'rb') as f:
+            private_keys.append(serialization.load_pem_private_key(f.read(), password=None))
+    private_keys = tuple(private_keys)
+    return _ec_public(private_keys), private_keys
+
+# -------------------- Signed Presence --------------------
+# The Ed25519 identity signs everything a beacon or hello says about its
+# sender, so the X25519 (and RSA) key it advertises can't be swapped for
+# someone else's under the same identity.
+_PRESENCE_INFO = b'securelocal-presence'
+PRESENCE_FIELDS = ('user_id', 'username', 'tcp_port', 'proto', 'codecs', 'public_key', 'keys', 'ts')
+
+def _presence_bytes(presence):
+    signed = {field: presence.get(field) for field in PRESENCE_FIELDS}
+    return _PRESENCE_INFO + json.dumps(signed, sort_keys=True, separators=(',', ':')).encode()
+
+def sign_presence(presence, private_keys):
+    """`presence` plus an Ed25519 "signature" over its PRESENCE_FIELDS."""
+    signature = private_keys[1].sign(_presence_bytes(presence))
+    return {**presence, 'signature': base64.b64encode(signature).decode()}
+
+def verify_presence(presence):
+    """Raise ValueError unless `presence` is signed by the Ed25519 key it advertises."""
+    try:
+        identity = Ed25519PublicKey.from_public_bytes(base64.b64decode(presence['keys']['ed25519']))
+        identity.verify(base64.b64decode(presence['signature']), _presence_bytes(presence))
+    except (KeyError, TypeError, ValueError, InvalidSignature):
+        raise ValueError("presence not signed by the identity key it advertises")
+
+# -------------------- X25519 Session Key Agreement --------------------
+# The sender makes an ephemeral X25519 key, agrees a secret with the
+# recipient's static key and runs it through HKDF; the session key is never
+# sent. The sender signs the ephemeral key with its Ed25519 identity, so the
+# recipient can tell the key came from the peer whose beacon it has.
+_KEY_INFO = b'securelocal-session-key'
+
+def _session_key(shared, ephemeral, recipient):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=ephemeral + recipient,
+                info=_KEY_INFO).derive(shared)
+
+def agree_session_key(friend_keys, private_keys):
+    """X25519 counterpart of generate_session_key() + encrypt_session_key().
+
+    Returns (session key, data for the session_key packet).
+    """
+    start = time.perf_counter()
+    recipient = base64.b64decode(friend_keys['x25519'])
+    ephemeral = X25519PrivateKey.generate()
+    ephemeral_public = _raw(ephemeral.public_key())
+    shared = ephemeral.exchange(X25519PublicKey.from_public_bytes(recipient))
+    session_key = _session_key(shared, ephemeral_public, recipient)
+    signature = private_keys[1].sign(_KEY_INFO + ephemeral_public + recipient)
+    elapsed = time.perf_counter() - start
+    _AGREE_KEY.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return session_key, {
+        'ephemeral': base64.b64encode(ephemeral_public).decode(),
+        'signature': base64.b64encode(signature).decode(),
+    }
+
+def derive_session_key(data, private_keys, sender_keys):
+    """The recipient's side of agree_session_key(). The signature must match
+    the Ed25519 key in `sender_keys` (the sender's advertised public keys);
+    a sender that advertised none is refused."""
+    start = time.perf_counter()
+    if not sender_keys or not sender_keys.get('ed25519'):
+        raise ValueError("sender has no Ed25519 identity key to check the session key against")
+    ephemeral_public = base64.b64decode(data['ephemeral'])
+    recipient = _raw(private_keys[0].public_key())
+    identity = Ed25519PublicKey.from_public_bytes(base64.b64decode(sender_keys['ed25519']))
+    try:
+        identity.verify(base64.b64decode(data['signature']), _KEY_INFO + ephemeral_public + recipient)
+    except InvalidSignature:
+        raise ValueError("session key not signed by the sender's identity key")
+    shared = private_keys[0].exchange(X25519PublicKey.from_public_bytes(ephemeral_public))
+    session_key = _session_key(shared, ephemeral_public, recipient)
+    elapsed = time.perf_counter() - start
+    _DERIVE_KEY.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return session_key
+
 # -------------------- AES Session Key Management --------------------
 def generate_session_key():
     """Generate a random AES session key."""
@@ -35,30 +186,100 @@ def generate_session_key():
 
 def encrypt_session_key(session_key, friend_public_key):
     """Encrypt AES session key using friend's RSA public key."""
+    start = time.perf_counter()
     cipher_rsa = PKCS1_OAEP.new(RSA.import_key(friend_public_key))
     encrypted_session_key = cipher_rsa.encrypt(session_key)
+    elapsed = time.perf_counter() - start
+    _WRAP_KEY.observe(elapsed)
+    profiling.record("crypto", elapsed)
     return base64.b64encode(encrypted_session_key).decode()
 
 def decrypt_session_key(encrypted_session_key_b64, private_key):
+    start = time.perf_counter()
     encrypted_session_key = base64.b64decode(encrypted_session_key_b64)
     cipher_rsa = PKCS1_OAEP.new(private_key)
-    return cipher_rsa.decrypt(encrypted_session_key)
+    session_key = cipher_rsa.decrypt(encrypted_session_key)
+    elapsed = time.perf_counter() - start
+    _UNWRAP_KEY.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return session_key
 
 # -------------------- AES Message Encryption --------------------
-def encrypt_message(message, session_key):
+def encrypt_payload(data, session_key, codec=None):
+    """Encrypt raw bytes. `codec` names the compression applied to them, and is
+    authenticated along with the ciphertext so it can't be swapped in transit."""
+    start = time.perf_counter()
     cipher_aes = AES.new(session_key, AES.MODE_EAX)
-    ciphertext, tag = cipher_aes.encrypt_and_digest(message.encode())
+    if codec:
+        cipher_aes.update(codec.encode())
+    ciphertext, tag = cipher_aes.encrypt_and_digest(data)
     data = {
         'nonce': base64.b64encode(cipher_aes.nonce).decode(),
         'ciphertext': base64.b64encode(ciphertext).decode(),
         'tag': base64.b64encode(tag).decode()
     }
+    if codec:
+        data['codec'] = codec
+    elapsed = time.perf_counter() - start
+    _ENCRYPT.observe(elapsed)
+    profiling.record("crypto", elapsed)
     return json.dumps(data)
 
-def decrypt_message(encrypted_data_json, session_key):
+def decrypt_payload(encrypted_data_json, session_key):
+    """Returns (bytes, codec); codec is None for uncompressed payloads."""
+    start = time.perf_counter()
     data = json.loads(encrypted_data_json)
     nonce = base64.b64decode(data['nonce'])
     ciphertext = base64.b64decode(data['ciphertext'])
     tag = base64.b64decode(data['tag'])
+    codec = data.get('codec')
     cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce=nonce)
-    return cipher_aes.decrypt_and_verify(ciphertext, tag).decode()
+    if codec:
+        cipher_aes.update(codec.encode())
+    plaintext = cipher_aes.decrypt_and_verify(ciphertext, tag)
+    elapsed = time.perf_counter() - start
+    _DECRYPT.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return plaintext, codec
+
+def encrypt_message(message, session_key):
+    return encrypt_payload(message.encode(), session_key)
+
+def decrypt_message(encrypted_data_json, session_key):
+    plaintext, codec = decrypt_payload(encrypted_data_json, session_key)
+    if codec:
+        raise ValueError(f"compressed payload ({codec}) passed to decrypt_message")
+    return plaintext.decode()
+
+# -------------------- Receipts --------------------
+def receipt_mac(session_key, message_id, status, group_id=None):
+    """Authenticates a status update with the session key the message came under,
+    which only its sender and its recipient know."""
+    data = json.dumps([message_id, status, group_id]).encode()
+    return hmac.new(session_key, b'securelocal-receipt:' + data, hashlib.sha256).hexdigest()
+
+# -------------------- File Chunk Encryption --------------------
+def derive_transfer_key(session_key, transfer_id):
+    """Per-transfer AES key, so chunk nonces never share a key across transfers."""
+    return hmac.new(session_key, b'securelocal-file:' + transfer_id, hashlib.sha256).digest()
+
+def encrypt_chunk(key, data, aad):
+    """AES-GCM encrypt one chunk; returns nonce (12) + tag (16) + ciphertext."""
+    start = time.perf_counter()
+    cipher = AES.new(key, AES.MODE_GCM, nonce=get_random_bytes(12))
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    elapsed = time.perf_counter() - start
+    _ENCRYPT_CHUNK.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return cipher.nonce + tag + ciphertext
+
+def decrypt_chunk(key, blob, aad):
+    start = time.perf_counter()
+    cipher = AES.new(key, AES.MODE_GCM, nonce=blob[:12])
+    cipher.update(aad)
+    data = cipher.decrypt_and_verify(blob[28:], blob[12:28])
+    elapsed = time.perf_counter() - start
+    _DECRYPT_CHUNK.observe(elapsed)
+    profiling.record("crypto", elapsed)
+    return data
@@ -0,0 +1,173 @@
+"""
+Streaming encrypted file transfer over a framed peer connection
+
+    sender                                   receiver
+    file_offer {transfer_id, manifest}   ->
+                                         <-  file_accept {next_chunk} | error {error}
+    chunk frames (binary, AES-GCM)       ->
+                                         <-  file_ack {next_chunk}, one per chunk
+    file_end {chunks}                    ->
+                                         <-  file_done {name}
+
+The manifest (name, size, chunk size) travels encrypted under the session
+key. Each chunk is encrypted under a per-transfer key with the transfer id
+and chunk index as associated data, so chunks can't be reordered, replayed
+into another transfer or forged. The sender keeps at most `window` chunks
+unacknowledged. The receiver appends chunks straight to a .part file, so
+an interrupted transfer resumes at the first chunk it has not stored.
+"""
+
+import json
+import os
+import struct
+from pathlib import Path
+
+CHUNK_SIZE = 256 * 1024
+WINDOW = 8
+
+CHUNK_FRAME = 0x01
+CHUNK_HEADER = struct.Struct(">B16sQ")  # frame type, transfer id, chunk index
+
+
+def pack_chunk(transfer_id, index, blob):
+    return CHUNK_HEADER.pack(CHUNK_FRAME, transfer_id, index) + blob
+
+
+def unpack_chunk(payload):
+    kind, transfer_id, index = CHUNK_HEADER.unpack_from(payload)
+    if kind != CHUNK_FRAME:
+        raise ValueError(f"unexpected frame type {kind}")
+    return transfer_id, index, payload[CHUNK_HEADER.size:]
+
+
+def chunk_aad(transfer_id, index):
+    return transfer_id + struct.pack(">Q", index)
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+def safe_filename(name):
+    name = os.path.basename(str(name).replace("\\", "/")).strip().lstrip(".")
+    return name or "file"
+
+
+# ------------------ Sending ------------------
+def stream_file(sock, path, transfer_id, key, start_chunk, chunk_size=CHUNK_SIZE,
+                window=WINDOW, on_progress=None):
+    """Send chunks from `start_chunk` to the end of `path`, then file_end.
+
+    The file is read through one fixed buffer, so memory use does not
+    depend on its size.
+    """
+    from e2e_encryption import encrypt_chunk
+    from framing import send_frame, send_json, recv_json
+
+    size = os.path.getsize(path)
+    total = chunk_count(size, chunk_size)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    acked = start_chunk
+
+    def wait_for_ack():
+        nonlocal acked
+        reply = recv_json(sock)
+        if reply.get("type") != "file_ack":
+            raise ConnectionError(f"transfer aborted by peer: {reply}")
+        acked = reply["next_chunk"]
+        if on_progress:
+            on_progress(min(acked * chunk_size, size), size)
+
+    with open(path, "rb", buffering=0) as f:
+        f.seek(start_chunk * chunk_size)
+        for index in range(start_chunk, total):
+            n = f.readinto(buffer)
+            blob = encrypt_chunk(key, view[:n], chunk_aad(transfer_id, index))
+            send_frame(sock, pack_chunk(transfer_id, index, blob))
+
+            while index + 1 - acked >= window:
+                wait_for_ack()
+
+    send_json(sock, {"type": "file_end", "transfer_id": transfer_id.hex(), "chunks": total})
+    while True:
+        reply = recv_json(sock)
+        if reply.get("type") == "file_ack":
+            acked = reply["next_chunk"]
+            if on_progress:
+                on_progress(min(acked * chunk_size, size), size)
+        elif reply.get("type") == "file_done":
+            return reply
+        else:
+            raise ConnectionError(f"transfer failed: {reply}")
+
+
+# ------------------ Receiving ------------------
+class IncomingTransfer:
+    """A file being written to disk chunk by chunk, resumable from its .part file."""
+
+    def __init__(self, downloads_dir, transfer_id, manifest, key):
+        self.downloads_dir = Path(downloads_dir)
+        self.transfer_id = transfer_id
+        self.key = key
+        self.name = safe_filename(manifest["name"])
+        self.size = int(manifest["size"])
+        self.chunk_size = int(manifest["chunk_size"])
+        if not 0 < self.chunk_size <= 4 * CHUNK_SIZE:
+            raise ValueError("bad chunk size")
+        self.total = chunk_count(self.size, self.chunk_size)
+
+        partial_dir = self.downloads_dir / ".partial"
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_path = partial_dir / f"{transfer_id.hex()}-{self.chunk_size}.part"
+
+        # Only whole chunks count; a torn last write is dropped and re-sent
+        done = self.partial_path.stat().st_size if self.partial_path.exists() else 0
+        self.next_chunk = min(done // self.chunk_size, self.total)
+        self._file = open(self.partial_path, "ab")
+        self._file.truncate(self.next_chunk * self.chunk_size)
+
+    @property
+    def bytes_done(self):
+        return min(self.next_chunk * self.chunk_size, self.size)
+
+    def write(self, index, blob):
+        from e2e_encryption import decrypt_chunk
+
+        if index != self.next_chunk:
+            raise ValueError(f"expected chunk {self.next_chunk}, got {index}")
+        data = decrypt_chunk(self.key, blob, chunk_aad(self.transfer_id, index))
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(data) != expected:
+            raise ValueError(f"chunk {index} has {len(data)} bytes, expected {expected}")
+        self._file.write(data)
+        self.next_chunk += 1
+
+    def finish(self, chunks):
+        """Move the completed file into the downloads directory and return its path."""
+        if chunks != self.total or self.next_chunk != self.total:
+            raise ValueError(f"incomplete transfer: {self.next_chunk}/{self.total} chunks")
+        self._file.close()
+
+        stem, ext = os.path.splitext(self.name)
+        target = self.downloads_dir / self.name
+        n = 1
+        while target.exists():
+            target = self.downloads_dir / f"{stem} ({n}){ext}"
+            n += 1
+        os.replace(self.partial_path, target)
+        return target
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def encrypt_manifest(name, size, chunk_size, session_key):
+    from e2e_encryption import encrypt_message
+    return encrypt_message(json.dumps({"name": name, "size": size, "chunk_size": chunk_size}), session_key)
+
+
+def decrypt_manifest(payload, session_key):
+    from e2e_encryption import decrypt_message
+    return json.loads(decrypt_message(payload, session_key))
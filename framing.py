@@ -0,0 +1,96 @@
+"""
+Framing for peer TCP connections
+
+Protocol 1 (legacy) sends one raw JSON packet per send() and the receiver
+reads it with a single recv(8192), so anything larger gets truncated.
+Protocol 2 prefixes every packet with a 4-byte big-endian length. JSON
+payloads start with "{"; binary payloads (file chunks) start with a
+type byte below 0x20, so the receiver can always tell them apart.
+Peers advertise their protocol in discovery beacons.
+"""
+
+import json
+import socket
+import struct
+import time
+
+PROTOCOL_VERSION = 2
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = 32 * 1024 * 1024
+RECV_SIZE = 256 * 1024  # most one recv() allocates
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _recv(sock, n, deadline):
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("read deadline passed")
+        sock.settimeout(remaining)
+    return sock.recv(n)
+
+
+def recv_exact(sock, n, deadline=None):
+    """Read exactly n bytes; raises ConnectionError if the peer closes first.
+
+    The buffer grows with the bytes that actually arrive, so a header that
+    announces a large frame costs nothing until its payload follows. With a
+    `deadline` (time.monotonic()) the whole read times out then, however
+    the bytes trickle in.
+    """
+    buf = bytearray()
+    while len(buf) < n:
+        got = _recv(sock, min(n - len(buf), RECV_SIZE), deadline)
+        if not got:
+            raise ConnectionError(f"connection closed after {len(buf)} of {n} bytes")
+        buf += got
+    return bytes(buf)
+
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def send_json(sock, obj):
+    send_frame(sock, json.dumps(obj).encode())
+
+
+def recv_frame(sock):
+    """Return the next frame's payload, or None if the peer closed between frames."""
+    first = sock.recv(1)
+    if not first:
+        return None
+    length, = HEADER.unpack(first + recv_exact(sock, HEADER.size - 1))
+    if length > MAX_FRAME:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME}")
+    return recv_exact(sock, length)
+
+
+def recv_json(sock):
+    payload = recv_frame(sock)
+    if payload is None:
+        raise ConnectionError("connection closed while waiting for a reply")
+    return json.loads(payload.decode())
+
+
+def read_packet(sock, legacy_bufsize=8192, deadline=None):
+    """Read one inbound packet in either protocol, all of it by `deadline`.
+
+    Returns (payload, framed), or (None, None) once the peer has closed.
+    """
+    first = _recv(sock, 1, deadline)
+    if not first:
+        return None, None
+
+    if first == b"{":
+        # Protocol 1: the whole JSON packet arrives in one segment
+        return first + _recv(sock, legacy_bufsize - 1, deadline), False
+
+    length, = HEADER.unpack(first + recv_exact(sock, HEADER.size - 1, deadline))
+    if length > MAX_FRAME:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME}")
+    return recv_exact(sock, length, deadline), True
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Loopback load generator - runs N chat nodes on this host and measures
+end-to-end message throughput and latency
+
+Each node is its own process (NetworkManager + DatabaseManager on a
+temporary database) so CPU and memory can be reported per node. Nodes find
+each other with unicast beacons to their neighbours' discovery ports on
+127.0.0.1, so no broadcast or real LAN is needed.
+
+    python loadgen.py --nodes 8 --duration 30 --rate 100 --sizes 64,1024,4096 \\
+        --fanout 2 --read-receipts 0.5 --churn 0.1 --output run.json
+    python loadgen.py --nodes 8 --compare run.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCH_PREFIX = "BENCH|"
+
+
+# ------------------ Node process ------------------
+def _node_main(index, config, commands, results):
+    from database import DatabaseManager
+    from network import NetworkManager
+
+    if not config["verbose"]:
+        sys.stdout = open(os.devnull, "w")
+
+    workdir = tempfile.mkdtemp(prefix=f"loadgen-node{index}-")
+    cpu_start = time.process_time()
+
+    ports = config["ports"]
+    discovery_port, tcp_port = ports[index]
+    beacon_targets = [("127.0.0.1", d) for i, (d, _) in enumerate(ports) if i != index]
+
+    database = DatabaseManager(Path(workdir) / "chat.db")
+    network = NetworkManager(
+        database,
+        discovery_port=discovery_port,
+        tcp_port=tcp_port,
+        beacon_targets=beacon_targets,
+        keys_dir=os.path.join(workdir, "keys"),
+    )
+    network.BROADCAST_INTERVAL = config["beacon_interval"]
+    network.set_username(f"node{index}")
+
+    lock = threading.Lock()
+    latencies = []
+    stats = {
+        "node": index,
+        "sent": 0,
+        "send_errors": 0,
+        "received": 0,
+        "read_receipts_sent": 0,
+        "receipts_received": 0,
+        "churn_events": 0,
+    }
+
+    def on_event(event):
+        if event["type"] == "message" and event["message"].startswith(BENCH_PREFIX):
+            _, _seq, sent_at, want_read, _ = event["message"].split("|", 4)
+            latency = time.time() - float(sent_at)
+            with lock:
+                stats["received"] += 1
+                latencies.append(latency)
+            if want_read == "1":
+                try:
+                    network.send_status_update(event["sender_id"], event["uid"], "read")
+                    with lock:
+                        stats["read_receipts_sent"] += 1
+                except OSError:
+                    pass
+        elif event["type"] == "status":
+            with lock:
+                stats["receipts_received"] += 1
+
+    network.message_callbacks.append(on_event)
+    network.start()
+
+    # Wait for every other node to show up before reporting ready
+    deadline = time.time() + config["discovery_timeout"]
+    while time.time() < deadline and len(network.get_online_users()) < len(ports) - 1:
+        time.sleep(0.1)
+    results.put(("ready", index, len(network.get_online_users())))
+
+    while True:
+        cmd = commands.get()
+
+        if cmd[0] == "send":
+            _, recipients, size, want_read, seq = cmd
+            header = f"{BENCH_PREFIX}{seq}|{time.time():.6f}|{int(want_read)}|"
+            text = header + "x" * max(size - len(header), 0)
+            by_name = {u["username"]: u["user_id"] for u in network.get_online_users()}
+            for name in recipients:
+                stats["sent"] += 1
+                try:
+                    network.send_message(by_name[name], text)
+                except (KeyError, OSError):
+                    stats["send_errors"] += 1
+
+        elif cmd[0] == "churn":
+            stats["churn_events"] += 1
+            network.stop(wait=True)
+            time.sleep(cmd[1])
+            network.start()
+
+        elif cmd[0] == "stop":
+            network.stop()
+            break
+
+    stats["cpu_seconds"] = round(time.process_time() - cpu_start, 3)
+    stats["max_rss_mb"] = _max_rss_mb()
+    with lock:
+        stats["latencies"] = list(latencies)
+    results.put(("done", index, stats))
+
+    database.connection.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _max_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ------------------ Controller ------------------
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def run(args):
+    n = args.nodes
+    if n < 2:
+        raise SystemExit("need at least 2 nodes")
+    ports = [(args.base_port + 2 * i, args.base_port + 2 * i + 1) for i in range(n)]
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    config = {
+        "ports": ports,
+        "beacon_interval": args.beacon_interval,
+        "discovery_timeout": args.discovery_timeout,
+        "verbose": args.verbose,
+    }
+
+    results = multiprocessing.Queue()
+    commands = [multiprocessing.Queue() for _ in range(n)]
+    procs = [
+        multiprocessing.Process(target=_node_main, args=(i, config, commands[i], results), daemon=True)
+        for i in range(n)
+    ]
+    for p in procs:
+        p.start()
+
+    print(f"[LOADGEN] Starting {n} nodes on ports {args.base_port}-{args.base_port + 2 * n - 1}")
+    peers_at_start = {}
+    for _ in range(n):
+        _, index, peers = results.get(timeout=args.discovery_timeout + 120)
+        peers_at_start[index] = peers
+    print(f"[LOADGEN] All nodes ready (min peers seen: {min(peers_at_start.values())}/{n - 1})")
+
+    rng = random.Random(args.seed)
+    fanout = min(args.fanout, n - 1)
+    interval = 1.0 / args.rate
+    churn_chance = args.churn / args.rate
+
+    seq = 0
+    started = time.time()
+    next_tick = started
+    while time.time() - started < args.duration:
+        sender = rng.randrange(n)
+        recipients = rng.sample([i for i in range(n) if i != sender], fanout)
+        commands[sender].put((
+            "send",
+            [f"node{r}" for r in recipients],
+            rng.choice(sizes),
+            rng.random() < args.read_receipts,
+            seq,
+        ))
+        seq += 1
+
+        if churn_chance and rng.random() < churn_chance:
+            commands[rng.randrange(n)].put(("churn", args.churn_downtime))
+
+        next_tick += interval
+        delay = next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    send_phase = time.time() - started
+
+    print(f"[LOADGEN] Sent {seq} messages x{fanout} in {send_phase:.1f}s, draining for {args.drain}s")
+    time.sleep(args.drain)
+    for q in commands:
+        q.put(("stop",))
+
+    nodes = {}
+    deadline = time.time() + 60
+    while len(nodes) < n and time.time() < deadline:
+        try:
+            kind, index, stats = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        if kind == "done":
+            stats["peers_at_start"] = peers_at_start.get(index)
+            nodes[index] = stats
+    for p in procs:
+        p.join(5)
+
+    return _summarize(args, nodes, send_phase)
+
+
+def _summarize(args, nodes, send_phase):
+    latencies = sorted(l for s in nodes.values() for l in s.pop("latencies"))
+    sent = sum(s["sent"] for s in nodes.values())
+    delivered = sum(s["received"] for s in nodes.values())
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "config": vars(args),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "send_phase_s": round(send_phase, 3),
+        "messages_sent": sent,
+        "messages_delivered": delivered,
+        "send_errors": sum(s["send_errors"] for s in nodes.values()),
+        "delivery_ratio": round(delivered / sent, 4) if sent else None,
+        "throughput_msgs_per_s": round(delivered / send_phase, 2) if send_phase else None,
+        "latency_ms": {
+            "p50": ms(_percentile(latencies, 50)),
+            "p90": ms(_percentile(latencies, 90)),
+            "p99": ms(_percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+        },
+        "nodes": [nodes[i] for i in sorted(nodes)],
+    }
+
+
+def print_report(summary, baseline=None):
+    print("\n" + "="*60)
+    print("LOOPBACK LOAD TEST")
+    print("="*60)
+    print(f"Sent: {summary['messages_sent']}  Delivered: {summary['messages_delivered']}  "
+          f"Errors: {summary['send_errors']}")
+    print(f"Throughput: {summary['throughput_msgs_per_s']} msgs/s")
+    lat = summary["latency_ms"]
+    print(f"Latency ms: p50={lat['p50']} p90={lat['p90']} p99={lat['p99']} max={lat['max']}")
+
+    print("\n  node   sent  recv  errors  cpu_s   rss_mb")
+    for s in summary["nodes"]:
+        print(f"  {s['node']:>4} {s['sent']:>6} {s['received']:>5} {s['send_errors']:>7} "
+              f"{s['cpu_seconds']:>6} {s['max_rss_mb']!s:>8}")
+
+    if baseline:
+        print("\nCompared to baseline:")
+        for label, key in (("throughput", "throughput_msgs_per_s"),):
+            _print_delta(label, baseline.get(key), summary.get(key))
+        for pct in ("p50", "p99"):
+            _print_delta(f"latency {pct}", baseline["latency_ms"].get(pct), lat.get(pct))
+    print("="*60)
+
+
+def _print_delta(label, old, new):
+    if old is None or new is None:
+        print(f"  {label:<14} {old} -> {new}")
+        return
+    change = (new - old) / old * 100 if old else 0.0
+    print(f"  {label:<14} {old} -> {new} ({change:+.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback multi-node load generator")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--base-port", type=int, default=17000,
+                        help="node i uses base+2i (discovery) and base+2i+1 (TCP)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of sending")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second across all nodes")
+    parser.add_argument("--sizes", default="64,512,4096", help="comma-separated message sizes in bytes")
+    parser.add_argument("--fanout", type=int, default=1, help="recipients per message")
+    parser.add_argument("--read-receipts", type=float, default=0.0,
+                        help="fraction of messages the recipient marks read")
+    parser.add_argument("--churn", type=float, default=0.0,
+                        help="node restarts per second across the cluster")
+    parser.add_argument("--churn-downtime", type=float, default=2.0)
+    parser.add_argument("--beacon-interval", type=float, default=1.0)
+    parser.add_argument("--discovery-timeout", type=float, default=30.0)
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for in-flight messages")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output run")
+    parser.add_argument("--verbose", action="store_true", help="show node output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    summary = run(args)
+    print_report(summary, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Logging - one queued, rotating setup for the app, server and network
+
+Records are put on an in-memory queue by the thread that logs them and
+written by a single background thread, so request and packet threads never
+wait on disk. If the writer falls behind, records are dropped (and counted)
+rather than blocking.
+
+The access log is written by the app itself (see AccessLog) instead of
+Werkzeug/wsgiref. Requests the UI repeats every few seconds (polls, typing
+notices, read receipts) are counted and summarised once a minute, with one
+in `sample` logged in full; server errors and slow requests are always
+logged.
+
+    python app.py --log-json --log-max-mb 20 --access-sample 100
+"""
+
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from pathlib import Path
+
+import metrics
+
+DROPPED = metrics.counter(
+    "securelocal_log_records_dropped_total",
+    "Log records dropped because the log writer fell behind"
+)
+
+QUEUE_SIZE = 10000
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listeners = []
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line; `extra` fields given to the logger are included."""
+
+    _STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self._STANDARD})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _TagFormatter(logging.Formatter):
+    """Console lines in the old print style: "[NETWORK] ...", "[NETWORK WARNING] ..."."""
+
+    def format(self, record):
+        tag = record.name.rsplit(".", 1)[-1].upper()
+        if record.levelno >= logging.WARNING:
+            tag = f"{tag} {record.levelname}"
+        record.message = record.getMessage()
+        line = f"[{tag}] {record.message}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def __init__(self, q, listener):
+        super().__init__(q)
+        self.listener = listener
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def close(self):
+        # Stop the writer (flushing the queue) unless shutdown() already did
+        if self.listener in _listeners:
+            _listeners.remove(self.listener)
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+        super().close()
+
+
+def background(*handlers):
+    """A handler that hands records to `handlers` on a background thread."""
+    q = queue.Queue(QUEUE_SIZE)
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return _DroppingQueueHandler(q, listener)
+
+
+def setup(log_dir, level="INFO", json_lines=False, max_bytes=10_000_000, backups=5,
+          when=None, console=True, name="securelocal"):
+    """Send every "securelocal" logger to a rotating file (and the console).
+
+    Rotation is by size, or by time when `when` is given ("midnight", "h", ...).
+    Each process needs its own `name`: rotation isn't safe across processes.
+    """
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    path = log_dir / (f"{name}.jsonl" if json_lines else f"{name}.log")
+    if when:
+        file_handler = TimedRotatingFileHandler(path, when=when, backupCount=backups)
+    else:
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+    file_handler.setFormatter(JSONFormatter() if json_lines else logging.Formatter(FORMAT))
+
+    handlers = [file_handler]
+    if console:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(_TagFormatter())
+        handlers.append(stream)
+
+    logger = logging.getLogger("securelocal")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(background(*handlers))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    # Werkzeug's own access lines are replaced by AccessLog
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    return path
+
+
+def shutdown():
+    """Flush whatever is still queued; call before exiting."""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+# ------------------ Access log ------------------
+class AccessLog:
+    """Decides which requests get an access line; see the module docstring."""
+
+    SUMMARY_INTERVAL = 60
+    SLOW_MS = 1000
+
+    def __init__(self, poll_routes, sample=100, slow_ms=SLOW_MS, logger=None):
+        self.poll_routes = set(poll_routes)  # (method, url rule) pairs
+        self.sample = sample
+        self.slow = slow_ms / 1000
+        self.log = logger or logging.getLogger("securelocal.access")
+        self._counts = {}  # (method, route, status) -> [requests, total seconds]
+        self._since = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, method, route, path, status, seconds, remote=None):
+        fields = {"method": method, "path": path, "status": status,
+                  "ms": round(seconds * 1000, 1), "remote": remote}
+        line = f"{remote} {method} {path} {status} {fields['ms']}ms"
+
+        poll = (method, route) in self.poll_routes
+        if status >= 500:
+            self.log.error(line, extra=fields)
+        elif seconds >= self.slow or (status >= 400 and not poll):
+            self.log.warning(line, extra=fields)
+        elif not poll:
+            self.log.info(line, extra=fields)
+        else:
+            # A logged-out tab keeps polling too; its 401s are summarised like the rest
+            with self._lock:
+                counts = self._counts.setdefault((method, route, status), [0, 0.0])
+                counts[0] += 1
+                counts[1] += seconds
+                sampled = self.sample and (counts[0] - 1) % self.sample == 0
+            if sampled:
+                self.log.info(f"{line} (sampled 1/{self.sample})", extra=fields)
+        self._maybe_summarize()
+
+    def _maybe_summarize(self):
+        now = time.monotonic()
+        if now - self._since < self.SUMMARY_INTERVAL:
+            return
+        with self._lock:
+            if now - self._since < self.SUMMARY_INTERVAL:
+                return
+            counts, self._counts = self._counts, {}
+            elapsed, self._since = now - self._since, now
+        for (method, route, status), (n, total) in sorted(counts.items()):
+            self.log.info(
+                f"{method} {route} {status} x{n} in {elapsed:.0f}s, avg {total / n * 1000:.1f}ms",
+                extra={"method": method, "route": route, "status": status, "count": n,
+                       "avg_ms": round(total / n * 1000, 1), "summary": True}
+            )
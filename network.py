@@ -5,253 +5,1479 @@ Network Manager - UDP discovery + TCP messaging with E2EE + status sync
 import socket
 import threading
 import json
+import hashlib
+import hmac
 import time
 import uuid
+import logging
 import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
-from e2e_encryption import (
-    generate_rsa_keys, load_rsa_keys,
-    generate_session_key, encrypt_session_key, decrypt_session_key,
-    encrypt_message, decrypt_message
+import compress
+import metrics
+import profiling
+from database import new_message_id
+from framing import PROTOCOL_VERSION, read_packet, send_json, recv_json
+from transport import SocketTransport, broadcast_address, interface_for
+
+log = logging.getLogger("securelocal.network")
+
+SEND_SECONDS = metrics.histogram(
+    "securelocal_network_send_seconds",
+    "Time to deliver one outbound TCP exchange, connect to reply",
+    ["type"]
+)
+RECEIVE_SECONDS = metrics.histogram(
+    "securelocal_network_receive_seconds",
+    "Time to handle one inbound TCP packet",
+    ["type"]
+)
+BYTES_SENT = metrics.counter(
+    "securelocal_network_bytes_sent_total",
+    "Bytes written to peer TCP connections",
+    ["type"]
+)
+BYTES_RECEIVED = metrics.counter(
+    "securelocal_network_bytes_received_total",
+    "Bytes read from peer TCP connections",
+    ["type"]
+)
+BEACONS = metrics.counter(
+    "securelocal_discovery_beacons_total",
+    "Discovery beacons sent, received and refused",
+    ["direction"]
+)
+PEERS = metrics.gauge(
+    "securelocal_discovery_peers",
+    "Peers seen within the presence timeout"
+)
+KEY_EXCHANGES = metrics.counter(
+    "securelocal_session_key_exchanges_total",
+    "AES session keys sent to or accepted from peers, by key agreement",
+    ["direction", "scheme"]
+)
+TRANSFERS = metrics.counter(
+    "securelocal_file_transfers_total",
+    "File transfers finished, by direction and result",
+    ["direction", "result"]
+)
+SYNCS = metrics.counter(
+    "securelocal_sync_runs_total",
+    "Reconnect-time sync handshakes, by result",
+    ["result"]
+)
+SYNCED = metrics.counter(
+    "securelocal_sync_items_total",
+    "Messages and status changes exchanged by sync",
+    ["kind", "direction"]
+)
+PROBES = metrics.counter(
+    "securelocal_peer_probes_total",
+    "Direct TCP probes of known peers, by result",
+    ["result"]
+)
+INBOUND_QUEUED = metrics.gauge(
+    "securelocal_inbound_queue_depth",
+    "Accepted peer connections waiting for a worker"
+)
+INBOUND_ACTIVE = metrics.gauge(
+    "securelocal_inbound_active_connections",
+    "Peer connections being served by a worker"
 )
+INBOUND_REJECTED = metrics.counter(
+    "securelocal_inbound_rejected_total",
+    "Peer connections shed at accept time, by reason",
+    ["reason"]
+)
+KEY_CHANGES = metrics.counter(
+    "securelocal_peer_key_changes_total",
+    "Known peers that came back with a different identity key"
+)
+ERRORS = metrics.counter(
+    "securelocal_network_errors_total",
+    "Network operations that raised",
+    ["op"]
+)
+
+
+class PeerError(ConnectionError):
+    """A protocol 2 peer answered with an error packet."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# Fields _record_peer relies on and their types; only user_id and username are required
+PRESENCE_TYPES = {"user_id": str, "username": str, "tcp_port": int, "proto": int,
+                  "codecs": list, "public_key": str, "keys": dict}
+
+
+def check_presence(presence):
+    """Raise ValueError unless a beacon, hello or key introduction is well formed."""
+    for field, kind in PRESENCE_TYPES.items():
+        value = presence.get(field)
+        required = field in ("user_id", "username")
+        if value is None and not required:
+            continue
+        if not isinstance(value, kind) or isinstance(value, bool) or (required and not value):
+            raise ValueError(f"malformed presence: {field}")
+    if not 0 < presence.get("tcp_port", 1) < 65536:
+        raise ValueError("malformed presence: tcp_port")
+    if not all(isinstance(v, str) for v in (presence.get("keys") or {}).values()):
+        raise ValueError("malformed presence: keys")
+    if not all(isinstance(c, str) for c in presence.get("codecs") or []):
+        raise ValueError("malformed presence: codecs")
+
+
+def peer_fingerprint(presence):
+    """Short hash of the identity a beacon or hello advertises.
+
+    With X25519/Ed25519 keys it covers both, so a new agreement key under the
+    same identity counts as a changed key too. Those fingerprints are prefixed
+    to tell them apart from RSA ones, which change every session and so are
+    never pinned.
+    """
+    keys = presence.get("keys") or {}
+    if keys.get("ed25519"):
+        bundle = f"{keys['ed25519']}:{keys.get('x25519')}"
+        return "ed25519:" + hashlib.sha256(bundle.encode()).hexdigest()[:32]
+    return hashlib.sha256((presence.get("public_key") or "").encode()).hexdigest()[:32]
+
+
+# e2e_encryption (and pycryptodome behind it) is imported inside the methods
+# that need it, so creating a NetworkManager stays cheap until login.
 
 
 class NetworkManager:
     DISCOVERY_PORT = 6667
     TCP_PORT = 6668
+    # Administratively scoped (RFC 2365), so routers never forward it off-site
+    MULTICAST_GROUP = "239.255.66.67"
     BROADCAST_INTERVAL = 3
+    INTERFACE_REFRESH = 30
+    CONNECT_TIMEOUT = 5
+    PEER_TIMEOUT = 10
+    TRANSFER_TIMEOUT = 30
+    FANOUT_WORKERS = 16
+    SYNC_BATCH = 500
+    SYNC_MAX_STATUSES = 5000   # status changes in one batch (see get_status_changes)
+    SYNC_MAX_ROUNDS = 20
+
+    # Inbound connections: a fixed pool of workers behind a bounded queue,
+    # like server.py does for HTTP; anything beyond that is shed at accept
+    ACCEPT_BACKLOG = 128
+    PEER_WORKERS = 16
+    PEER_QUEUE = 64
+    MAX_CONNECTIONS_PER_PEER = 8
+    READ_TIMEOUT = 30        # a packet not complete this long after the last one gives its worker back
+    # Delivery receipts go out from their own threads, so a slow or absent
+    # peer never holds an inbound worker while we connect to it
+    RECEIPT_WORKERS = 2
+    RECEIPT_QUEUE = 1000
 
-    def __init__(self, database):
+    # Peers we have talked to are kept in the database ("peers" table) and
+    # probed over TCP at startup, and whenever their beacons stop arriving,
+    # so they are reachable at once and even where broadcast is filtered
+    PROBE_TIMEOUT = 1
+    PROBE_MAX_BACKOFF = 60
+    PROBE_BATCH = 32         # probes per round, so a long peers table can't stall the loop
+    KNOWN_PEER_MAX_AGE = 30 * 24 * 3600
+    PEER_SAVE_INTERVAL = 60  # rewrite an unchanged peers row at most this often
+    KNOWN_PEER_LIMIT = 10000  # peers rows loaded at start: probe targets and pinned identity keys
+
+    def __init__(self, database, discovery_port=None, tcp_port=None,
+                 beacon_targets=None, keys_dir="keys", transport=None,
+                 downloads_dir="downloads", discovery="both"):
         self.database = database
+        self.transport = transport or SocketTransport()
         self.running = False
+        self._threads = []
+
+        # Per-instance ports so several nodes can share one host (see loadgen.py)
+        self.discovery_port = discovery_port or self.DISCOVERY_PORT
+        self.tcp_port = tcp_port or self.TCP_PORT
+        # Explicit unicast targets replace interface discovery entirely
+        self.beacon_targets = beacon_targets
+        # "multicast", "broadcast" or "both" (reaches peers that only listen for broadcast)
+        if discovery not in ("multicast", "broadcast", "both"):
+            raise ValueError(f"unknown discovery mode {discovery}")
+        self.discovery = discovery
+        self.interfaces = []
+        self.keys_dir = keys_dir
+        self.downloads_dir = downloads_dir
 
         self.user_id = str(uuid.uuid4())[:8]
         self.username = None
-        self.local_ip = self._get_local_ip()
+        self._local_ip = None
 
-        self.online_users = {}      # user_id -> {username, ip, public_key, last_seen}
-        self.session_keys = {}      # user_id -> AES key
+        # user_id -> {username, ip, addresses, tcp_port, proto, codecs, public_key, last_seen};
+        # addresses maps each of our interfaces the peer was heard on to its address there
+        self.online_users = {}
+        # One AES key per direction: a key we receive never replaces the one we
+        # send with, so two peers that start talking at once can't cross keys
+        self.session_keys = {}      # user_id -> AES key the peer sent us (its packets)
+        self.key_owners = {}        # user_id -> username of the peer that key was set up with
+        self.sending_keys = {}      # user_id -> AES key we sent the peer (our packets)
+        self.sending_key_owners = {}  # user_id -> username we sent that key to
+        self._key_locks = {}        # user_id -> Lock held while that key is exchanged
+        self._key_locks_guard = threading.Lock()
+        self.dictionaries_out = {}  # user_id -> (dict_id, content) the peer has acknowledged
+        self.dictionaries_in = {}   # user_id -> {dict_id: content} received from that peer
+        self._histories = {}        # user_id -> compress.History of recent short messages
         self.message_callbacks = [] # UI / Flask listeners
 
+        self._inbound = None        # queue of (socket, peer ip) waiting for a worker
+        self._receipts = None       # queue of status updates waiting for a receipt thread
+        self._connections = {}      # peer ip -> connections queued or being served
+        self._connections_lock = threading.Lock()
+
+        self._known_peers = {}      # username -> peers row: where to probe it
+        self._saved_peers = {}      # username -> (ip, tcp_port, fingerprint, saved at) last written
+        self.key_conflicts = {}     # username -> the peer claiming it with an identity key we don't know
+        self._presence_ts = {}      # user_id -> timestamp of the newest signed presence accepted
+
+        # RSA identity (PEM, RsaKey): made only for peers without X25519, see _need_rsa_keys
         self.public_key = None
         self.private_key = None
+        # X25519/Ed25519 identity: public keys for beacons, (X25519, Ed25519) private keys
+        self.ec_public = None
+        self.ec_private = None
+        self._rsa_lock = threading.Lock()
+        self._rsa_pending = False
+
+        PEERS.set_function(self._count_peers)
 
-        print(f"[NETWORK] Initialized at {self.local_ip}")
+        log.info("Initialized as %s", self.user_id)
 
     # ------------------ Helpers ------------------
+    @property
+    def local_ip(self):
+        if self._local_ip is None:
+            self._local_ip = self._get_local_ip()
+        return self._local_ip
+
     def _get_local_ip(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
+        return self.transport.local_ip()
+
+    def set_username(self, username, keys=None):
+        """Set the identity; `keys` is an optional RSA (public PEM, private key) pair to use as-is.
+
+        The identity is an X25519/Ed25519 pair when the cryptography package is
+        available, kept per username so peers recognise us across restarts;
+        RSA keys are then only made once a peer that lacks X25519 shows up.
+        """
+        from e2e_encryption import KEY_AGREEMENTS, generate_ec_keys, load_ec_keys
 
-    def set_username(self, username):
         self.username = username
-        key_dir = f"keys/{self.user_id}"
-        if not os.path.exists(key_dir):
-            self.public_key, self.private_key = generate_rsa_keys(self.user_id)
-        else:
-            self.public_key, self.private_key = load_rsa_keys(self.user_id)
+        if keys is not None:
+            self.public_key, self.private_key = keys
+
+        if "x25519" in KEY_AGREEMENTS:
+            identity = "identity-" + hashlib.sha256(username.encode()).hexdigest()[:16]
+            try:
+                self.ec_public, self.ec_private = load_ec_keys(identity, self.keys_dir)
+            except FileNotFoundError:
+                self.ec_public, self.ec_private = generate_ec_keys(identity, self.keys_dir)
+        elif keys is None:
+            self._make_rsa_keys()
+
+    def _make_rsa_keys(self):
+        from e2e_encryption import generate_rsa_keys, load_rsa_keys
+
+        with self._rsa_lock:
+            if self.public_key is not None:
+                return
+            if os.path.exists(os.path.join(self.keys_dir, self.user_id, "private.pem")):
+                self.public_key, self.private_key = load_rsa_keys(self.user_id, self.keys_dir)
+            else:
+                self.public_key, self.private_key = generate_rsa_keys(self.user_id, self.keys_dir)
+                log.info("Generated RSA keys for peers without X25519")
+
+    def _need_rsa_keys(self):
+        """A peer can only give us session keys over RSA; generate ours off the listener thread."""
+        with self._rsa_lock:
+            if self.public_key is not None or self._rsa_pending:
+                return
+            self._rsa_pending = True
+        threading.Thread(target=self._make_rsa_keys, daemon=True).start()
 
     # ------------------ Start / Stop ------------------
     def start(self):
-        if not self.username or not self.public_key:
+        if not self.username or not (self.public_key or self.ec_public):
             raise RuntimeError("set_username() first")
 
         if self.running:
             return
 
         self.running = True
-        threading.Thread(target=self._broadcast_presence, daemon=True).start()
-        threading.Thread(target=self._listen_for_peers, daemon=True).start()
-        threading.Thread(target=self._tcp_server, daemon=True).start()
+        log.info("Starting at %s", self.local_ip)
+        self._load_known_peers()
+        self._inbound = queue.Queue(maxsize=self.PEER_QUEUE)
+        self._receipts = queue.Queue(maxsize=self.RECEIPT_QUEUE)
+        self._threads = [
+            threading.Thread(target=self._broadcast_presence, daemon=True),
+            threading.Thread(target=self._listen_for_peers, daemon=True),
+            threading.Thread(target=self._tcp_server, daemon=True),
+            threading.Thread(target=self._probe_known_peers, daemon=True),
+        ] + [
+            threading.Thread(target=self._inbound_worker, name=f"peer-worker-{i}", daemon=True)
+            for i in range(self.PEER_WORKERS)
+        ] + [
+            threading.Thread(target=self._send_receipts, name=f"receipts-{i}", daemon=True)
+            for i in range(self.RECEIPT_WORKERS)
+        ]
+        INBOUND_QUEUED.set_function(self._inbound.qsize)
+        for t in self._threads:
+            t.start()
 
-        print("[NETWORK] Running")
+        log.info("Running")
 
-    def stop(self):
+    def stop(self, wait=False):
+        """Stop the background threads; with wait=True block until they released their ports."""
         self.running = False
+        if wait:
+            for t in self._threads:
+                t.join(self.BROADCAST_INTERVAL + 1)
 
     # ------------------ UDP Discovery ------------------
+    def _refresh_interfaces(self):
+        interfaces = self.transport.interfaces()
+        if interfaces != self.interfaces:
+            log.info("Interfaces: %s", ", ".join(f"{i.name}={i.ip}" for i in interfaces) or "none")
+        self.interfaces = interfaces
+
+    def _beacon_routes(self, broadcast_sock, multicast_socks):
+        """(socket, target) for every beacon to send this round."""
+        if self.beacon_targets:
+            return [(broadcast_sock, target) for target in self.beacon_targets]
+
+        routes = []
+        if self.discovery in ("multicast", "both"):
+            for iface in self.interfaces:
+                if iface.ip not in multicast_socks:
+                    multicast_socks[iface.ip] = self.transport.open_datagram(multicast_interface=iface.ip)
+                routes.append((multicast_socks[iface.ip], (self.MULTICAST_GROUP, self.discovery_port)))
+
+        if self.discovery in ("broadcast", "both"):
+            # Directed broadcast per subnet; 255.255.255.255 only leaves via the default route
+            targets = {broadcast_address(iface) or "<broadcast>" for iface in self.interfaces}
+            for target in targets or {"<broadcast>"}:
+                routes.append((broadcast_sock, (target, self.discovery_port)))
+        return routes
+
+    def _presence(self):
+        """What a beacon (or a reply to a direct probe) says about us."""
+        presence = {
+            "user_id": self.user_id,
+            "username": self.username,
+            "tcp_port": self.tcp_port,
+            "proto": PROTOCOL_VERSION,
+            "codecs": compress.CODECS,
+            # Older peers require the field; until we have RSA keys they get an
+            # empty one, which they only fail to use if they try to message us
+            "public_key": self.public_key.decode() if self.public_key else "",
+            "ts": time.time()
+        }
+        if self.ec_public:
+            from e2e_encryption import sign_presence
+
+            presence["keys"] = self.ec_public
+            presence = sign_presence(presence, self.ec_private)
+        return presence
+
     def _broadcast_presence(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock = self.transport.open_datagram(broadcast=True)
+        multicast_socks = {}  # interface ip -> socket bound to that interface for sending
+        next_refresh = 0
 
         while self.running:
-            packet = {
-                "type": "discovery",
-                "user_id": self.user_id,
-                "username": self.username,
-                "public_key": self.public_key.decode()
-            }
-            sock.sendto(json.dumps(packet).encode(), ("<broadcast>", self.DISCOVERY_PORT))
+            if not self.beacon_targets and time.monotonic() >= next_refresh:
+                self._refresh_interfaces()
+                next_refresh = time.monotonic() + self.INTERFACE_REFRESH
+                for ip in set(multicast_socks) - {i.ip for i in self.interfaces}:
+                    multicast_socks.pop(ip).close()
+
+            beacon = json.dumps({"type": "discovery", **self._presence()}).encode()
+            for route_sock, target in self._beacon_routes(sock, multicast_socks):
+                try:
+                    route_sock.sendto(beacon, target)
+                    BEACONS.labels("sent").inc()
+                except OSError:
+                    ERRORS.labels("beacon").inc()
             time.sleep(self.BROADCAST_INTERVAL)
 
         sock.close()
+        for s in multicast_socks.values():
+            s.close()
 
     def _listen_for_peers(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(("", self.DISCOVERY_PORT))
-        sock.settimeout(1)
+        # One socket hears broadcasts and, once joined, multicast on every interface
+        sock = self.transport.open_datagram(port=self.discovery_port, timeout=1)
+        joined = set()
+        rejoin_at = 0
 
         while self.running:
+            if not self.beacon_targets and self.discovery in ("multicast", "both"):
+                # Forget interfaces that went away so they are joined again when
+                # they return, and re-check the rest now and then in case one
+                # bounced between two interface refreshes (joining twice is harmless)
+                joined &= {iface.ip for iface in self.interfaces}
+                if time.monotonic() >= rejoin_at:
+                    joined.clear()
+                    rejoin_at = time.monotonic() + self.INTERFACE_REFRESH
+                for iface in self.interfaces:
+                    if iface.ip not in joined and self.transport.join_multicast(sock, self.MULTICAST_GROUP, iface.ip):
+                        joined.add(iface.ip)
             try:
                 data, addr = sock.recvfrom(4096)
                 pkt = json.loads(data.decode())
 
-                if pkt.get("type") != "discovery":
+                if not isinstance(pkt, dict) or pkt.get("type") != "discovery":
                     continue
-                if pkt["user_id"] == self.user_id:
+                if pkt.get("user_id") == self.user_id:
                     continue
-
-                self.online_users[pkt["user_id"]] = {
-                    "username": pkt["username"],
-                    "ip": addr[0],
-                    "public_key": pkt["public_key"],
-                    "last_seen": time.time()
-                }
+                BEACONS.labels("received").inc()
+                self._record_peer(pkt, addr[0])
 
             except socket.timeout:
                 pass
+            except (ValueError, KeyError, TypeError) as e:
+                # Anyone on the LAN can send us anything: not JSON, fields of the
+                # wrong type, or signed by someone other than the identity it names
+                BEACONS.labels("refused").inc()
+                log.warning("Dropped beacon from %s: %s", addr[0], e)
 
         sock.close()
 
+    def _verify_presence(self, pkt):
+        """Raise ValueError unless a presence that advertises X25519/Ed25519 keys
+        is signed by that identity, and no older than the last one it signed.
+
+        Returns whether the presence was verified at all (False for older peers).
+        """
+        if not (pkt.get("keys") and self.ec_public):
+            return False  # an older peer (or we can't check it, and won't use its keys)
+        from e2e_encryption import verify_presence
+
+        verify_presence(pkt)
+        if not isinstance(pkt.get("ts"), (int, float)):
+            raise ValueError("presence without a timestamp")
+        if pkt["ts"] < self._presence_ts.get(pkt["user_id"], 0):
+            raise ValueError(f"stale presence for {pkt['user_id']}")
+        self._presence_ts[pkt["user_id"]] = pkt["ts"]
+        return True
+
+    def _record_peer(self, pkt, ip):
+        """Record a beacon, hello or key introduction; False if the peer was refused.
+
+        Raises ValueError for a malformed presence or one whose signature
+        doesn't check out.
+        """
+        check_presence(pkt)
+        verified = self._verify_presence(pkt)
+        now = time.time()
+        fingerprint = peer_fingerprint(pkt)
+        if not self._check_identity(pkt, ip, fingerprint, now):
+            return False
+        iface = interface_for(self.interfaces, ip)
+        previous = self.online_users.get(pkt["user_id"], {})
+        addresses = {
+            name: a for name, a in previous.get("addresses", {}).items()
+            if now - a["last_seen"] <= self.PEER_TIMEOUT
+        }
+        addresses[iface.name if iface else "default"] = {"ip": ip, "last_seen": now}
+        reappeared = now - previous.get("last_seen", 0) > self.PEER_TIMEOUT
+
+        self.online_users[pkt["user_id"]] = {
+            "username": pkt["username"],
+            "ip": ip,
+            "addresses": addresses,
+            "tcp_port": pkt.get("tcp_port", self.TCP_PORT),
+            "proto": pkt.get("proto", 1),
+            "codecs": pkt.get("codecs", []),
+            "public_key": pkt.get("public_key"),
+            "keys": pkt.get("keys"),
+            "last_seen": now
+        }
+        self._remember_peer(pkt, ip, now, fingerprint)
+        if not (self.ec_public and pkt.get("keys")):
+            self._need_rsa_keys()
+
+        # One side of each pair starts the sync; the handshake covers both
+        # directions. Only with a peer whose pinned identity signed its presence,
+        # since the sync hands it our side of the conversation
+        if verified and reappeared and pkt.get("proto", 1) >= 2 and self.username < pkt["username"]:
+            threading.Thread(target=self._sync_in_background, args=(pkt["user_id"],), daemon=True).start()
+        return True
+
+    # ------------------ Known peers ------------------
+    # The first Ed25519 key a username is seen with is pinned in the peers
+    # table. Anyone later claiming that name with another key is kept out of
+    # online_users (so no session key is set up with it) and reported, until
+    # the user accepts the new key with trust_new_key(). RSA-only peers make
+    # new keys every session, so their fingerprints are recorded but not pinned.
+    def _check_identity(self, pkt, ip, fingerprint, now):
+        username = pkt["username"]
+        known = self._known_peers.get(username)
+        pinned = known and known.get("fingerprint")
+        if not pinned or not pinned.startswith("ed25519:") or pinned == fingerprint:
+            return True
+
+        conflict = self.key_conflicts.get(username)
+        if conflict is None or conflict["fingerprint"] != fingerprint:
+            KEY_CHANGES.inc()
+            log.warning("%s at %s presented a different identity key than before; "
+                        "ignoring it until the new key is trusted", username, ip)
+            self._notify({"type": "key_changed", "username": username, "ip": ip})
+        self.key_conflicts[username] = {
+            "username": username, "user_id": pkt["user_id"], "ip": ip,
+            "tcp_port": pkt.get("tcp_port", self.TCP_PORT), "fingerprint": fingerprint, "last_seen": now
+        }
+        return False
+
+    def get_key_conflicts(self):
+        """Names currently claimed with an identity key other than the pinned one."""
+        now = time.time()
+        return [c for c in list(self.key_conflicts.values()) if now - c["last_seen"] <= self.PEER_TIMEOUT]
+
+    def trust_new_key(self, username):
+        """Pin the key a known peer came back with (once the user has checked it); False if there was none."""
+        conflict = self.key_conflicts.pop(username, None)
+        if conflict is None:
+            return False
+        self._saved_peers.pop(username, None)
+        self._known_peers[username] = {k: conflict[k] for k in
+                                       ("username", "user_id", "ip", "tcp_port", "fingerprint", "last_seen")}
+        self.database.save_peer(username, conflict["user_id"], conflict["ip"], conflict["tcp_port"],
+                                conflict["fingerprint"], conflict["last_seen"])
+        log.info("Trusting the new identity key of %s", username)
+        return True
+
+    def _remember_peer(self, pkt, ip, now, fingerprint):
+        username = pkt["username"]
+        port = pkt.get("tcp_port", self.TCP_PORT)
+        saved = self._saved_peers.get(username)
+        if saved and saved[:3] == (ip, port, fingerprint) and now - saved[3] < self.PEER_SAVE_INTERVAL:
+            return
+
+        self._saved_peers[username] = (ip, port, fingerprint, now)
+        self._known_peers[username] = {"username": username, "user_id": pkt["user_id"], "ip": ip,
+                                       "tcp_port": port, "fingerprint": fingerprint, "last_seen": now}
+        try:
+            self.database.save_peer(username, pkt["user_id"], ip, port, fingerprint, now)
+        except Exception as e:
+            ERRORS.labels("save_peer").inc()
+            log.warning("Could not save peer %s: %s", username, e)
+
+    def _load_known_peers(self):
+        """Every saved peer, before any beacon is heard, so pinned keys hold from the start."""
+        try:
+            for peer in self.database.get_known_peers(limit=self.KNOWN_PEER_LIMIT):
+                if peer["username"] != self.username:
+                    self._known_peers.setdefault(peer["username"], peer)
+        except Exception as e:
+            log.warning("Could not load known peers: %s", e)
+
+    def _probe_known_peers(self):
+        """Probe recently seen known peers at startup, then any whose beacons
+        stop arriving, backing off from the ones that don't answer.
+
+        Peers still beaconing are skipped, and each round probes at most
+        PROBE_BATCH of the rest, most recently seen first.
+        """
+        backoff = {}  # username -> (monotonic time of next attempt, current delay)
+        with ThreadPoolExecutor(max_workers=self.FANOUT_WORKERS) as pool:
+            while self.running:
+                now, wall = time.monotonic(), time.time()
+                heard = {
+                    u["username"] for u in list(self.online_users.values())
+                    if wall - u["last_seen"] <= 2 * self.BROADCAST_INTERVAL
+                }
+                due = sorted(
+                    (peer for name, peer in list(self._known_peers.items())
+                     if name not in heard and backoff.get(name, (0, 0))[0] <= now
+                     and wall - peer["last_seen"] <= self.KNOWN_PEER_MAX_AGE),
+                    key=lambda peer: peer["last_seen"], reverse=True
+                )[:self.PROBE_BATCH]
+                for peer, reached in zip(due, pool.map(self._probe, due)):
+                    if reached:
+                        backoff.pop(peer["username"], None)
+                    else:
+                        delay = min(backoff.get(peer["username"], (0, self.BROADCAST_INTERVAL / 2))[1] * 2,
+                                    self.PROBE_MAX_BACKOFF)
+                        backoff[peer["username"]] = (time.monotonic() + delay, delay)
+                time.sleep(self.BROADCAST_INTERVAL)
+
+    def _probe(self, peer):
+        """Say hello to a known peer's last address; it answers with its presence."""
+        try:
+            with self.transport.open_connection((peer["ip"], peer["tcp_port"]),
+                                                timeout=self.PROBE_TIMEOUT) as sock:
+                reply = self._exchange(sock, {"type": "hello", **self._presence()}, framed=True)
+            if not isinstance(reply, dict) or reply.get("type") != "hello" or reply.get("user_id") == self.user_id:
+                raise ValueError("not a hello")
+            self._record_peer(reply, peer["ip"])
+        except (OSError, ValueError, KeyError, TypeError):
+            PROBES.labels("unreachable").inc()
+            return False
+        PROBES.labels("ok").inc()
+        return True
+
     def get_online_users(self):
         now = time.time()
         self.online_users = {
             uid: u for uid, u in self.online_users.items()
-            if now - u["last_seen"] <= 10
+            if now - u["last_seen"] <= self.PEER_TIMEOUT
         }
         return [{"user_id": uid, **u} for uid, u in self.online_users.items()]
 
+    def _count_peers(self):
+        now = time.time()
+        return sum(
+            1 for u in list(self.online_users.values())
+            if now - u["last_seen"] <= self.PEER_TIMEOUT
+        )
+
     # ------------------ TCP Server ------------------
     def _tcp_server(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(("0.0.0.0", self.TCP_PORT))
-        sock.listen(5)
-        sock.settimeout(1)
+        sock = self.transport.open_listener(self.tcp_port, backlog=self.ACCEPT_BACKLOG, timeout=1)
 
         while self.running:
             try:
-                conn, _ = sock.accept()
-                threading.Thread(
-                    target=self._handle_tcp_client,
-                    args=(conn,),
-                    daemon=True
-                ).start()
+                conn, address = sock.accept()
             except socket.timeout:
-                pass
+                continue
+            self._admit(conn, address[0])
 
         sock.close()
 
+    def _admit(self, conn, ip):
+        """Queue an accepted connection for a worker, or shed it if the peer
+        already holds its share of connections or the queue is full."""
+        with self._connections_lock:
+            if self._connections.get(ip, 0) >= self.MAX_CONNECTIONS_PER_PEER:
+                reason = "peer_limit"
+            else:
+                try:
+                    self._inbound.put_nowait((conn, ip))
+                except queue.Full:
+                    reason = "queue_full"
+                else:
+                    self._connections[ip] = self._connections.get(ip, 0) + 1
+                    return
+
+        INBOUND_REJECTED.labels(reason).inc()
+        try:
+            # Framed senders see this as a PeerError; it is cheaper than a timeout
+            conn.settimeout(1)
+            send_json(conn, {"type": "error", "error": "busy", "code": reason})
+        except OSError:
+            pass
+        conn.close()
+
+    def _inbound_worker(self):
+        while self.running:
+            try:
+                conn, ip = self._inbound.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            INBOUND_ACTIVE.inc()
+            try:
+                self._handle_tcp_client(conn)
+            finally:
+                INBOUND_ACTIVE.dec()
+                with self._connections_lock:
+                    self._connections[ip] -= 1
+                    if not self._connections[ip]:
+                        del self._connections[ip]
+
     def _handle_tcp_client(self, c):
+        # A sender may put several packets on one connection (session_key then
+        # secure_message, or a whole file transfer), each answered in turn.
+        transfers = {}  # transfer_id -> IncomingTransfer on this connection
         try:
-            packet = json.loads(c.recv(8192).decode())
+            while self.running:
+                start = time.perf_counter()
+                # A deadline for the whole packet: trickling bytes doesn't keep the worker
+                data, framed = read_packet(c, deadline=time.monotonic() + self.READ_TIMEOUT)
+                if data is None:
+                    break
+                c.settimeout(self.READ_TIMEOUT)  # for the replies
+                if data[:1] == b"{":
+                    self._handle_packet(c, data, framed, start, transfers)
+                elif not self._handle_chunk(c, data, transfers):
+                    break
+        except socket.timeout:
+            ERRORS.labels("read_timeout").inc()
+            log.info("Dropped connection that sent no whole packet in %ss", self.READ_TIMEOUT)
+        except OSError as e:
+            ERRORS.labels("receive").inc()
+            log.warning("Receive failed: %s", e)
+        finally:
+            for t in transfers.values():
+                t.close()
+                TRANSFERS.labels("received", "interrupted").inc()
+                self._notify({"type": "file_failed", "direction": "received",
+                              "transfer_id": t.transfer_id.hex(), "name": t.name,
+                              "bytes": t.bytes_done, "size": t.size})
+            c.close()
+
+    def _notify(self, event):
+        for cb in self.message_callbacks:
+            cb(event)
+
+    def _key_owner(self, packet):
+        """The peer whose session key `packet` arrived under; the "sender" the
+        packet names must be that peer, or it is refused."""
+        owner = self.key_owners.get(packet["sender_id"])
+        if owner is None:
+            raise ValueError(f"no session key from {packet['sender_id']}")
+        if packet.get("sender", owner) != owner:
+            raise ValueError(f"{packet['sender_id']} is {owner}, not {packet['sender']}")
+        return owner
+
+    def _admit_group_message(self, group_id, name, sender, members):
+        """Create a group the first time we hear of it; afterwards only its
+        creator may add members, and only members may post."""
+        group = self.database.get_group(group_id)
+        if group is None:
+            if self.username not in members:
+                raise ValueError(f"group {group_id} does not include us")
+            self.database.create_group(group_id, name, sender, members)
+        elif group["created_by"] == sender:
+            self.database.create_group(group_id, group["name"], sender, members)
+        elif sender not in group["members"]:
+            raise ValueError(f"{sender} is not a member of group {group_id}")
+
+    def _receipt_sender(self, packet, msg):
+        """The member a status update for our message `msg` comes from.
+
+        It must carry a MAC under the key we sent that member (see
+        e2e_encryption.receipt_mac). Only direct receipts from protocol 1
+        peers, which predate the MAC, are taken on trust.
+        """
+        from e2e_encryption import receipt_mac
+
+        sender_id = packet.get("sender_id")
+        key = self.sending_keys.get(sender_id)
+        if key is None or "mac" not in packet:
+            legacy = [u for u in self.online_users.values()
+                      if u["username"] == msg["recipient"] and u.get("proto", 1) < 2]
+            if packet.get("group_id") or not legacy:
+                raise ValueError("unauthenticated status update")
+            return msg["recipient"]
+
+        expected = receipt_mac(key, packet["message_id"], packet["status"], packet.get("group_id"))
+        if not hmac.compare_digest(expected, str(packet["mac"])):
+            raise ValueError("status update MAC does not match")
+        member = self.sending_key_owners[sender_id]
+        if packet.get("group_id") != msg["group_id"] or (not msg["group_id"] and member != msg["recipient"]):
+            raise ValueError(f"{member} cannot acknowledge message {packet['message_id']}")
+        return member
+
+    def _reply(self, c, framed, packet):
+        # Protocol 1 peers only ever expect a bare OK
+        if framed:
+            send_json(c, packet)
+        else:
+            c.send(b"OK")
+
+    def _handle_packet(self, c, data, framed, start, transfers):
+        from e2e_encryption import decrypt_session_key, derive_session_key, decrypt_payload
+
+        received = time.perf_counter()
+        ptype = None
+        trace = None
+        try:
+            packet = json.loads(data.decode())
             ptype = packet.get("type")
+            BYTES_RECEIVED.labels(ptype).inc(len(data))
+
+            trace = profiling.PROFILER.begin("packet", ptype, start=start)
+            profiling.record("socket", received - start)
+
+            # ---- Direct probe from a peer that knew our address ----
+            if ptype == "hello":
+                if packet["user_id"] != self.user_id:
+                    self._record_peer(packet, c.getpeername()[0])
+                self._reply(c, framed, {"type": "hello", **self._presence()})
 
             # ---- Session key exchange ----
-            if ptype == "session_key":
-                self.session_keys[packet["sender_id"]] = decrypt_session_key(
-                    packet["data"], self.private_key
-                )
-                c.send(b"OK")
+            elif ptype == "session_key":
+                peer = self.online_users.get(packet["sender_id"])
+                presence = packet.get("presence")
+                if peer is None and isinstance(presence, dict) and presence.get("user_id") == packet["sender_id"]:
+                    # Its beacon hasn't reached us yet; the key carries the same presence
+                    self._record_peer(presence, c.getpeername()[0])
+                    peer = self.online_users.get(packet["sender_id"])
+                if peer is None:
+                    raise ValueError(f"session key from unknown peer {packet['sender_id']}")
+                scheme = packet.get("scheme", "rsa")
+                if scheme == "x25519":
+                    if not self.ec_private:
+                        raise ValueError("x25519 session key, but this peer has no X25519 key")
+                    key = derive_session_key(packet["data"], self.ec_private, peer.get("keys"))
+                elif peer.get("keys") and self.ec_private:
+                    # Unsigned, so anyone could send it; two X25519 peers never need RSA
+                    raise ValueError("RSA session key from a peer that has an Ed25519 identity")
+                elif self.private_key is None:
+                    raise ValueError("RSA session key before our RSA keys were ready")
+                else:
+                    key = decrypt_session_key(packet["data"], self.private_key)
+                self.session_keys[packet["sender_id"]] = key
+                self.key_owners[packet["sender_id"]] = peer["username"]
+                KEY_EXCHANGES.labels("received", scheme).inc()
+                self._reply(c, framed, {"type": "ack"})
 
             # ---- Secure message ----
             elif ptype == "secure_message":
                 sender_id = packet["sender_id"]
-                plaintext = decrypt_message(
+                sender = self._key_owner(packet)
+                body, codec = decrypt_payload(
                     packet["payload"],
                     self.session_keys[sender_id]
                 )
+                plaintext = compress.unpack(body, codec, self.dictionaries_in.get(sender_id, {})).decode()
 
+                # A retried send carries the same id; store and announce it once
+                uid = packet.get("message_id") or new_message_id()
+                duplicate = self.database.get_message_by_uid(uid) is not None
                 msg_id = self.database.save_message(
-                    packet["sender"],
+                    sender,
                     self.username,
                     plaintext,
                     is_encrypted=True,
-                    status="delivered"
+                    status="delivered",
+                    uid=uid
                 )
 
                 # notify sender (✔✔)
-                self.send_status_update(sender_id, msg_id, "delivered")
+                self.queue_status_update(sender_id, uid, "delivered")
+                if duplicate:
+                    self._reply(c, framed, {"type": "ack"})
+                    return
 
-                for cb in self.message_callbacks:
-                    cb({
-                        "type": "message",
-                        "sender": packet["sender"],
-                        "message": plaintext,
-                        "id": msg_id
-                    })
+                self._notify({
+                    "type": "message",
+                    "sender": sender,
+                    "sender_id": sender_id,
+                    "message": plaintext,
+                    "id": msg_id,
+                    "uid": uid
+                })
 
-                c.send(b"OK")
+                self._reply(c, framed, {"type": "ack"})
 
             # ---- Status update ----
-            elif ptype == "status_update":
-                self.database.update_message_status(
-                    packet["message_id"],
-                    packet["status"]
+            # ---- Group message ----
+            elif ptype == "group_message":
+                sender_id = packet["sender_id"]
+                sender = self._key_owner(packet)
+                content_key, _ = decrypt_payload(packet["key"], self.session_keys[sender_id])
+                body, codec = decrypt_payload(packet["payload"], content_key)
+                plaintext = compress.unpack(body, codec, {}).decode()
+
+                group_id = packet["group_id"]
+                uid = packet["message_id"]
+                self._admit_group_message(group_id, packet["group_name"], sender, packet["members"])
+                duplicate = self.database.get_message_by_uid(uid) is not None
+                msg_id = self.database.save_group_message(
+                    sender,
+                    group_id,
+                    plaintext,
+                    (),
+                    is_encrypted=True,
+                    status="delivered",
+                    uid=uid
                 )
 
-                for cb in self.message_callbacks:
-                    cb({
-                        "type": "status",
-                        "message_id": packet["message_id"],
-                        "status": packet["status"]
-                    })
+                self.queue_status_update(sender_id, uid, "delivered", group_id=group_id)
+                if duplicate:
+                    self._reply(c, framed, {"type": "ack"})
+                    return
+
+                self._notify({
+                    "type": "message",
+                    "sender": sender,
+                    "sender_id": sender_id,
+                    "group_id": group_id,
+                    "message": plaintext,
+                    "id": msg_id,
+                    "uid": uid
+                })
+
+                self._reply(c, framed, {"type": "ack"})
+
+            elif ptype == "status_update":
+                # message_id is the id we minted when sending, not the peer's row id
+                msg = self.database.get_message_by_uid(packet["message_id"])
+                if msg is None or msg["sender"] != self.username:
+                    self._reply(c, framed, {"type": "ack"})
+                    return
+                member = self._receipt_sender(packet, msg)
+                if packet.get("group_id"):
+                    self.database.update_receipt(
+                        msg["id"],
+                        member,
+                        packet["status"]
+                    )
+                else:
+                    self.database.advance_message_status(
+                        packet["message_id"],
+                        packet["status"]
+                    )
+
+                self._notify({
+                    "type": "status",
+                    "message_id": msg["id"],
+                    "uid": packet["message_id"],
+                    "status": packet["status"],
+                    "group_id": packet.get("group_id"),
+                    "username": member
+                })
 
-                c.send(b"OK")
+                self._reply(c, framed, {"type": "ack"})
+
+            # ---- Reconnect sync ----
+            elif ptype == "sync_request":
+                peer = self._key_owner(packet)
+                session_key = self.session_keys[packet["sender_id"]]
+                marks = self.database.get_sync_marks(self.username, peer)
+                outgoing, more = self.database.get_outgoing_since(
+                    self.username, peer, packet["received"], self.SYNC_BATCH)
+                statuses = self.database.get_status_changes(self.username, peer, packet["unread"])
+                self._count_synced("sent", outgoing, statuses)
+
+                send_json(c, {
+                    "type": "sync_response",
+                    **marks,
+                    "payload": self._seal_sync_batch(peer, outgoing, statuses, session_key),
+                    "more": more
+                })
+
+            elif ptype == "sync_batch":
+                peer = self._key_owner(packet)
+                batch = self._open_sync_batch(packet["payload"], self.session_keys[packet["sender_id"]])
+                self._apply_sync_batch(peer, packet["sender_id"], batch)
+                # Everything in the batch is here now, including ones we already had
+                send_json(c, {
+                    "type": "ack",
+                    "statuses": [[m["uid"], "delivered"] for m in batch["messages"]
+                                 if isinstance(m, dict) and isinstance(m.get("uid"), str)]
+                })
+
+            # ---- Compression dictionary ----
+            elif ptype == "compression_dict":
+                sender_id = packet["sender_id"]
+                body, codec = decrypt_payload(packet["payload"], self.session_keys[sender_id])
+                content = compress.unpack(body, codec, {})
+                if compress.dictionary_id(content) != packet["dict_id"]:
+                    raise ValueError("dictionary id does not match its content")
+
+                # Keep the previous one too; messages packed with it may still be in flight
+                known = self.dictionaries_in.setdefault(sender_id, {})
+                known[packet["dict_id"]] = content
+                while len(known) > 2:
+                    del known[next(iter(known))]
+                self._reply(c, framed, {"type": "ack"})
+
+            # ---- File transfer ----
+            elif ptype == "file_offer":
+                self._accept_file(c, packet, transfers)
+
+            elif ptype == "file_end":
+                self._finish_file(c, packet, transfers)
 
         except Exception as e:
-            print("[TCP ERROR]", e)
+            ERRORS.labels("receive").inc()
+            log.warning("Receive failed: %s", e)
+            if framed:
+                try:
+                    code = "unknown_dictionary" if isinstance(e, compress.UnknownDictionary) else None
+                    send_json(c, {"type": "error", "error": str(e), "code": code})
+                except OSError:
+                    pass
         finally:
-            c.close()
+            if ptype:
+                RECEIVE_SECONDS.labels(ptype).observe(time.perf_counter() - start)
+            profiling.PROFILER.end(trace)
+
+    # ------------------ File receiver ------------------
+    def _accept_file(self, c, packet, transfers):
+        from e2e_encryption import derive_transfer_key
+        from file_transfer import IncomingTransfer, decrypt_manifest
+
+        session_key = self.session_keys[packet["sender_id"]]
+        transfer_id = bytes.fromhex(packet["transfer_id"])
+        manifest = decrypt_manifest(packet["manifest"], session_key)
+
+        t = IncomingTransfer(self.downloads_dir, transfer_id, manifest,
+                             derive_transfer_key(session_key, transfer_id))
+        t.sender = self._key_owner(packet)
+        t.sender_id = packet["sender_id"]
+        transfers[transfer_id] = t
+        c.settimeout(self.TRANSFER_TIMEOUT)
+
+        log.info("Receiving %s (%s bytes) from %s, chunk %s/%s", t.name, t.size, t.sender, t.next_chunk, t.total)
+        send_json(c, {"type": "file_accept", "next_chunk": t.next_chunk})
+        self._file_progress(t)
+
+    def _handle_chunk(self, c, data, transfers):
+        """Store one chunk frame; returns False if the connection should be dropped."""
+        from file_transfer import unpack_chunk
+
+        BYTES_RECEIVED.labels("file_chunk").inc(len(data))
+        try:
+            transfer_id, index, blob = unpack_chunk(data)
+            t = transfers[transfer_id]
+            t.write(index, blob)
+        except Exception as e:
+            # A bad chunk poisons the rest of the stream; the sender resumes later
+            ERRORS.labels("file_chunk").inc()
+            log.warning("File chunk rejected: %s", e)
+            send_json(c, {"type": "error", "error": str(e)})
+            return False
+
+        send_json(c, {"type": "file_ack", "next_chunk": t.next_chunk})
+        self._file_progress(t)
+        return True
+
+    def _finish_file(self, c, packet, transfers):
+        t = transfers.pop(bytes.fromhex(packet["transfer_id"]))
+        try:
+            path = t.finish(packet["chunks"])
+        except Exception:
+            t.close()
+            TRANSFERS.labels("received", "failed").inc()
+            raise
+
+        TRANSFERS.labels("received", "complete").inc()
+        log.info("Saved %s", path)
+        send_json(c, {"type": "file_done", "name": path.name})
+        self._notify({
+            "type": "file_complete",
+            "direction": "received",
+            "transfer_id": t.transfer_id.hex(),
+            "sender": t.sender,
+            "sender_id": t.sender_id,
+            "name": path.name,
+            "path": str(path),
+            "size": t.size,
+        })
+
+    def _file_progress(self, t):
+        self._notify({
+            "type": "file_progress",
+            "direction": "received",
+            "transfer_id": t.transfer_id.hex(),
+            "sender": t.sender,
+            "name": t.name,
+            "bytes": t.bytes_done,
+            "size": t.size,
+        })
+
+    # ------------------ TCP client ------------------
+    def _connect(self, user):
+        """Connect through the address the peer was last heard on, then its others."""
+        port = user.get("tcp_port", self.TCP_PORT)
+        candidates = [user["ip"]] + [
+            a["ip"] for a in user.get("addresses", {}).values() if a["ip"] != user["ip"]
+        ]
+        error = None
+        with profiling.span("socket"):
+            for ip in dict.fromkeys(candidates):
+                try:
+                    return self.transport.open_connection((ip, port), timeout=self.CONNECT_TIMEOUT)
+                except OSError as e:
+                    error = e
+        raise error
+
+    def _exchange(self, sock, packet, framed=False):
+        """Send one packet and wait for the peer's reply (a dict when framed, else raw bytes)."""
+        data = json.dumps(packet).encode()
+        with profiling.span("socket"):
+            if framed:
+                send_json(sock, packet)
+                reply = recv_json(sock)
+            else:
+                sock.send(data)
+                reply = sock.recv(1024)
+        BYTES_SENT.labels(packet["type"]).inc(len(data))
+        if framed and reply.get("type") == "error":
+            raise PeerError(f"peer rejected {packet['type']}: {reply.get('error')}", reply.get("code"))
+        return reply
+
+    def _ensure_session_key(self, sock, recipient_id, user, framed):
+        from e2e_encryption import generate_session_key, encrypt_session_key, agree_session_key
+
+        with self._key_locks_guard:
+            lock = self._key_locks.setdefault(recipient_id, threading.Lock())
+
+        # Concurrent sends wait for the first exchange to be acknowledged, so
+        # none of them can reach the peer ahead of the key
+        with lock:
+            if recipient_id in self.sending_keys:
+                return self.sending_keys[recipient_id]
+
+            packet = {"type": "session_key", "sender_id": self.user_id, "presence": self._presence()}
+            if self.ec_private and user.get("keys"):
+                # Both sides have X25519: agree on the key instead of sending it
+                sk, packet["data"] = agree_session_key(user["keys"], self.ec_private)
+                packet["scheme"] = "x25519"
+            elif user.get("public_key"):
+                sk = generate_session_key()
+                packet["data"] = encrypt_session_key(sk, user["public_key"])
+            else:
+                raise ConnectionError(f"{user['username']} has no key we can use yet")
+            self._exchange(sock, packet, framed)
+            self.sending_keys[recipient_id] = sk
+            self.sending_key_owners[recipient_id] = user["username"]
+            KEY_EXCHANGES.labels("sent", packet.get("scheme", "rsa")).inc()
+            return sk
+
+    # ------------------ Reconnect sync ------------------
+    def sync_with(self, user_id):
+        """Reconcile the direct conversation with a peer that just (re)appeared.
+
+        Both sides swap high-water marks, then each sends only the messages
+        the other is missing and the current status of the other's messages,
+        sealed as one batch per direction on a single connection. Returns
+        (messages received, messages sent).
+        """
+        user = self.online_users[user_id]
+        peer = user["username"]
+        received = sent = 0
+        start = time.perf_counter()
+        sock = self._connect(user)
+        sock.settimeout(self.TRANSFER_TIMEOUT)
+
+        try:
+            session_key = self._ensure_session_key(sock, user_id, user, True)
+            for _ in range(self.SYNC_MAX_ROUNDS):
+                marks = self.database.get_sync_marks(self.username, peer)
+                reply = self._exchange(sock, {
+                    "type": "sync_request",
+                    "sender": self.username,
+                    "sender_id": self.user_id,
+                    **marks
+                }, framed=True)
+                received += self._apply_sync_batch(peer, user_id, self._open_sync_batch(reply["payload"], session_key))
+
+                outgoing, more = self.database.get_outgoing_since(
+                    self.username, peer, reply["received"], self.SYNC_BATCH)
+                statuses = self.database.get_status_changes(self.username, peer, reply["unread"])
+                self._count_synced("sent", outgoing, statuses)
+                ack = self._exchange(sock, {
+                    "type": "sync_batch",
+                    "sender": self.username,
+                    "sender_id": self.user_id,
+                    "payload": self._seal_sync_batch(peer, outgoing, statuses, session_key)
+                }, framed=True)
+                statuses = ack.get("statuses")
+                if isinstance(statuses, list) and len(statuses) <= self.SYNC_MAX_STATUSES:
+                    self.database.apply_status_changes(self.username, peer, statuses)
+                sent += len(outgoing)
+
+                if not (more or reply.get("more")):
+                    break
+        finally:
+            sock.close()
+
+        SEND_SECONDS.labels("sync").observe(time.perf_counter() - start)
+        return received, sent
+
+    def _sync_in_background(self, user_id, attempts=3):
+        # A freshly started peer may beacon before its TCP listener is up
+        for attempt in range(1, attempts + 1):
+            try:
+                received, sent = self.sync_with(user_id)
+            except Exception as e:
+                if attempt < attempts and self.running:
+                    time.sleep(self.BROADCAST_INTERVAL)
+                    continue
+                SYNCS.labels("failed").inc()
+                ERRORS.labels("sync").inc()
+                log.warning("Sync failed: %s", e)
+                return
+            SYNCS.labels("ok").inc()
+            if received or sent:
+                log.info("Synced with %s: %s received, %s sent", self.online_users[user_id]["username"], received, sent)
+            return
+
+    def _seal_sync_batch(self, peer, messages, statuses, session_key):
+        from e2e_encryption import encrypt_payload
+
+        peer_codecs = next((u.get("codecs") for u in self.online_users.values() if u["username"] == peer), [])
+        data = json.dumps({"messages": messages, "statuses": statuses}).encode()
+        body, label = compress.pack(data, compress.negotiate(peer_codecs))
+        return encrypt_payload(body, session_key, label)
+
+    def _open_sync_batch(self, payload, session_key):
+        from e2e_encryption import decrypt_payload
+
+        body, label = decrypt_payload(payload, session_key)
+        return json.loads(compress.unpack(body, label, {}))
+
+    def _apply_sync_batch(self, peer, peer_id, batch):
+        if not (isinstance(batch, dict) and isinstance(batch.get("messages"), list)
+                and isinstance(batch.get("statuses"), list)):
+            raise ValueError("malformed sync batch")
+        if len(batch["messages"]) > self.SYNC_BATCH or len(batch["statuses"]) > self.SYNC_MAX_STATUSES:
+            raise ValueError("sync batch too large")
+        stored = self.database.save_synced_messages(peer, self.username, batch["messages"])
+        self.database.apply_status_changes(self.username, peer, batch["statuses"])
+        self._count_synced("received", batch["messages"], batch["statuses"])
+
+        for msg in stored:
+            self._notify({
+                "type": "message",
+                "sender": peer,
+                "sender_id": peer_id,
+                "message": msg["message"],
+                "id": msg["local_id"],
+                "uid": msg["uid"]
+            })
+        if batch["statuses"]:
+            self._notify({"type": "sync", "peer": peer, "statuses": len(batch["statuses"])})
+        return len(stored)
+
+    def _count_synced(self, direction, messages, statuses):
+        SYNCED.labels("message", direction).inc(len(messages))
+        SYNCED.labels("status", direction).inc(len(statuses))
 
     # ------------------ Send message ------------------
-    def send_message(self, recipient_id, plaintext):
+    def send_message(self, recipient_id, plaintext, message_id=None):
+        """Encrypt and deliver one direct message; returns its message id.
+
+        Pass the id the message was saved under so receipts and retries refer
+        to the same row on both sides; a fresh id is minted otherwise.
+        """
+        start = time.perf_counter()
+        message_id = message_id or new_message_id()
         user = self.online_users[recipient_id]
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((user["ip"], self.TCP_PORT))
-
-        if recipient_id not in self.session_keys:
-            sk = generate_session_key()
-            self.session_keys[recipient_id] = sk
-            sock.send(json.dumps({
-                "type": "session_key",
-                "sender_id": self.user_id,
-                "data": encrypt_session_key(sk, user["public_key"])
-            }).encode())
-            sock.recv(1024)
+        framed = user.get("proto", 1) >= 2
+        codec = compress.negotiate(user.get("codecs")) if framed else None
+        data = plaintext.encode()
+        sock = self._connect(user)
 
-        sock.send(json.dumps({
+        try:
+            session_key = self._ensure_session_key(sock, recipient_id, user, framed)
+            dict_id, dictionary = self.dictionaries_out.get(recipient_id, (None, None))
+            try:
+                self._exchange(sock, self._message_packet(
+                    message_id, data, codec, session_key, dict_id, dictionary), framed)
+            except PeerError as e:
+                # The peer lost our dictionary (restart); fall back to the seed
+                if e.code != "unknown_dictionary":
+                    raise
+                self.dictionaries_out.pop(recipient_id, None)
+                self._exchange(sock, self._message_packet(message_id, data, codec, session_key), framed)
+
+            if codec:
+                self._maybe_send_dictionary(sock, recipient_id, session_key, codec, data)
+        finally:
+            sock.close()
+        SEND_SECONDS.labels("secure_message").observe(time.perf_counter() - start)
+        return message_id
+
+    def _message_packet(self, message_id, data, codec, session_key, dict_id=None, dictionary=None):
+        from e2e_encryption import encrypt_payload
+
+        body, label = compress.pack(data, codec, dictionary, dict_id)
+        return {
             "type": "secure_message",
             "sender": self.username,
             "sender_id": self.user_id,
-            "payload": encrypt_message(plaintext, self.session_keys[recipient_id]),
+            "message_id": message_id,
+            "payload": encrypt_payload(body, session_key, label),
             "timestamp": time.time()
-        }).encode())
+        }
 
-        sock.recv(1024)
-        sock.close()
+    def _maybe_send_dictionary(self, sock, recipient_id, session_key, codec, data):
+        """Feed the peer's history and, once enough is new, ship it a fresh dictionary."""
+        from e2e_encryption import encrypt_payload
+
+        history = self._histories.setdefault(recipient_id, compress.History())
+        history.add(data)
+        if not history.ready():
+            return
+
+        dict_id, content = history.take()
+        body, label = compress.pack(content, codec)
+        try:
+            self._exchange(sock, {
+                "type": "compression_dict",
+                "sender_id": self.user_id,
+                "dict_id": dict_id,
+                "payload": encrypt_payload(body, session_key, label),
+            }, framed=True)
+        except (OSError, ValueError) as e:
+            # The message itself is delivered; keep using the old dictionary
+            ERRORS.labels("compression_dict").inc()
+            log.warning("Dictionary send to %s failed: %s", recipient_id, e)
+            return
+        self.dictionaries_out[recipient_id] = (dict_id, content)
+
+    # ------------------ Send group message ------------------
+    def send_group_message(self, group_id, group_name, members, message_id, plaintext):
+        """Encrypt a group message once and deliver it to every online member in parallel.
+
+        The body is sealed under a fresh content key; each member only gets
+        that key wrapped with its session key. Returns {username: error or None}.
+        """
+        from e2e_encryption import generate_session_key, encrypt_payload
+
+        start = time.perf_counter()
+        by_name = {u["username"]: u for u in self.get_online_users()}
+        results = {}
+        targets = []
+        for name in members:
+            if name == self.username:
+                continue
+            user = by_name.get(name)
+            if user is None:
+                results[name] = "offline"
+            elif user.get("proto", 1) < 2:
+                results[name] = "unsupported"
+            else:
+                targets.append(user)
+
+        # One payload for everyone: the codec must suit every member, and only
+        # the seed dictionary is shared by all of them
+        shared = set(compress.CODECS)
+        for user in targets:
+            shared &= set(user.get("codecs", []))
+        body, label = compress.pack(plaintext.encode(), compress.negotiate(shared))
+        content_key = generate_session_key()
+        payload = encrypt_payload(body, content_key, label)
+
+        def deliver(user):
+            sock = self._connect(user)
+            try:
+                session_key = self._ensure_session_key(sock, user["user_id"], user, True)
+                self._exchange(sock, {
+                    "type": "group_message",
+                    "sender": self.username,
+                    "sender_id": self.user_id,
+                    "group_id": group_id,
+                    "group_name": group_name,
+                    "members": list(members),
+                    "message_id": message_id,
+                    "key": encrypt_payload(content_key, session_key),
+                    "payload": payload,
+                    "timestamp": time.time()
+                }, framed=True)
+            finally:
+                sock.close()
+
+        if targets:
+            with ThreadPoolExecutor(max_workers=min(self.FANOUT_WORKERS, len(targets))) as pool:
+                futures = {pool.submit(deliver, user): user["username"] for user in targets}
+                for future, name in futures.items():
+                    try:
+                        future.result()
+                        results[name] = None
+                    except Exception as e:
+                        ERRORS.labels("group_send").inc()
+                        results[name] = str(e)
+
+        SEND_SECONDS.labels("group_message").observe(time.perf_counter() - start)
+        return results
+
+    # ------------------ Send file ------------------
+    def send_file(self, recipient_id, path, transfer_id=None, on_progress=None):
+        """Stream a file to a peer; pass the same transfer_id again to resume.
+
+        Returns the transfer id (hex). Raises if the peer is offline, speaks
+        protocol 1 or the connection fails part way.
+        """
+        from e2e_encryption import derive_transfer_key
+        from file_transfer import CHUNK_SIZE, encrypt_manifest, stream_file
+
+        user = self.online_users[recipient_id]
+        if user.get("proto", 1) < 2:
+            raise RuntimeError(f"{user['username']} does not support file transfer")
+
+        transfer_id = bytes.fromhex(transfer_id) if transfer_id else os.urandom(16)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        sock = self._connect(user)
+        sock.settimeout(self.TRANSFER_TIMEOUT)
+
+        try:
+            session_key = self._ensure_session_key(sock, recipient_id, user, True)
+            reply = self._exchange(sock, {
+                "type": "file_offer",
+                "sender": self.username,
+                "sender_id": self.user_id,
+                "transfer_id": transfer_id.hex(),
+                "manifest": encrypt_manifest(os.path.basename(path), size, CHUNK_SIZE, session_key),
+            }, framed=True)
+            if reply.get("type") != "file_accept":
+                raise ConnectionError(f"file offer refused: {reply}")
+
+            first = reply["next_chunk"]
+            stream_file(sock, path, transfer_id, derive_transfer_key(session_key, transfer_id),
+                        first, CHUNK_SIZE, on_progress=on_progress)
+            BYTES_SENT.labels("file_chunk").inc(max(size - first * CHUNK_SIZE, 0))
+        except Exception:
+            TRANSFERS.labels("sent", "failed").inc()
+            raise
+        finally:
+            sock.close()
+
+        TRANSFERS.labels("sent", "complete").inc()
+        SEND_SECONDS.labels("file").observe(time.perf_counter() - start)
+        return transfer_id.hex()
 
     # ------------------ Status sender ------------------
-    def send_status_update(self, recipient_id, message_id, status):
+    def queue_status_update(self, recipient_id, message_id, status, group_id=None):
+        """send_status_update() from a receipt thread; dropped (and counted) when they are behind."""
+        try:
+            self._receipts.put_nowait((recipient_id, message_id, status, group_id))
+        except queue.Full:
+            ERRORS.labels("receipt_dropped").inc()
+
+    def _send_receipts(self):
+        while self.running:
+            try:
+                args = self._receipts.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.send_status_update(*args)
+            except Exception as e:
+                ERRORS.labels("status_update").inc()
+                log.info("Receipt for %s not sent: %s", args[1], e)
+
+    def send_status_update(self, recipient_id, message_id, status, group_id=None):
+        from e2e_encryption import receipt_mac
+
         if recipient_id not in self.online_users:
             return
 
+        start = time.perf_counter()
         user = self.online_users[recipient_id]
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((user["ip"], self.TCP_PORT))
+        sock = self._connect(user)
 
-        sock.send(json.dumps({
-            "type": "status_update",
-            "message_id": message_id,
-            "status": status
-        }).encode())
-
-        sock.recv(1024)
-        sock.close()
+        try:
+            packet = {
+                "type": "status_update",
+                "message_id": message_id,
+                "status": status
+            }
+            if group_id:
+                # Group receipts are tracked per member on the sender's side
+                packet.update(group_id=group_id, username=self.username)
+            key = self.session_keys.get(recipient_id)
+            if key is not None:
+                # Proves to the message's sender that we are the member it went to
+                packet.update(sender_id=self.user_id,
+                              mac=receipt_mac(key, message_id, status, group_id))
+            self._exchange(sock, packet, user.get("proto", 1) >= 2)
+        finally:
+            sock.close()
+        SEND_SECONDS.labels("status_update").observe(time.perf_counter() - start)
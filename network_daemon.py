@@ -0,0 +1,325 @@
+"""
+NetworkManager in its own process, driven over a Unix domain socket
+
+    python app.py --network-daemon                  # owns ports 6667/6668
+    python app.py --production --network-socket ~/.securelocalchat/network.sock
+
+The daemon runs the one NetworkManager (discovery, peer TCP, all RSA/AES
+work); any number of web processes talk to it through NetworkClient, which
+has the same methods the app uses on a NetworkManager. Both sides open the
+same SQLite database, which runs in WAL mode so reads in the web processes
+don't block the daemon's writes.
+
+Every message is a length-prefixed JSON frame (framing.py):
+
+    request   {"id": 7, "method": "send_message", "params": {...}}
+    reply     {"id": 7, "result": ...} | {"id": 7, "error": "...", "kind": "ConnectionError"}
+    progress  {"id": 7, "progress": [bytes_done, size]}     (send_file only)
+
+A connection that sends {"method": "subscribe"} instead receives every
+NetworkManager event as {"event": {...}} until it closes.
+"""
+
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+import metrics
+from framing import send_json, recv_json
+
+log = logging.getLogger("securelocal.daemon")
+
+RPC_SECONDS = metrics.histogram(
+    "securelocal_daemon_rpc_seconds",
+    "Time to serve one RPC from a web process",
+    ["method"]
+)
+SUBSCRIBERS = metrics.gauge(
+    "securelocal_daemon_subscribers",
+    "Web processes subscribed to network events"
+)
+
+# Methods a web process may call, with the NetworkManager arguments they take
+METHODS = {
+    "status": (),
+    "start": ("username",),
+    "get_online_users": (),
+    "get_key_conflicts": (),
+    "trust_new_key": ("username",),
+    "send_message": ("recipient_id", "plaintext", "message_id"),
+    "send_group_message": ("group_id", "group_name", "members", "message_id", "plaintext"),
+    "send_file": ("recipient_id", "path", "transfer_id", "progress"),
+    "send_status_update": ("recipient_id", "message_id", "status", "group_id"),
+}
+
+
+class RemoteError(Exception):
+    """An RPC that raised inside the daemon; `kind` is the exception class name."""
+
+    def __init__(self, message, kind=None):
+        super().__init__(message)
+        self.kind = kind
+
+
+# ------------------ Daemon ------------------
+class NetworkDaemon:
+    EVENT_QUEUE = 1000  # events buffered per subscriber before it is dropped
+
+    def __init__(self, network, socket_path):
+        self.network = network
+        self.socket_path = str(socket_path)
+        self.running = False
+        self._subscribers = []
+        self._lock = threading.Lock()
+        network.message_callbacks.append(self._publish)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)  # only this user may drive the network
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(64)
+        sock.settimeout(1)
+        self.running = True
+        log.info("Listening on %s", self.socket_path)
+
+        try:
+            while self.running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+        finally:
+            sock.close()
+            os.unlink(self.socket_path)
+
+    def stop(self):
+        self.running = False
+
+    def _serve(self, conn):
+        try:
+            while self.running:
+                try:
+                    request = recv_json(conn)
+                except (ConnectionError, ValueError):
+                    return
+                if request.get("method") == "subscribe":
+                    self._stream_events(conn)
+                    return
+                self._call(conn, request)
+        finally:
+            conn.close()
+
+    def _call(self, conn, request):
+        call_id, method = request.get("id"), request.get("method")
+        params = request.get("params") or {}
+        start = time.perf_counter()
+        try:
+            if method not in METHODS:
+                raise ValueError(f"unknown method {method}")
+            unknown = set(params) - set(METHODS[method])
+            if unknown:
+                raise ValueError(f"unexpected parameters {sorted(unknown)}")
+            result = getattr(self, f"_rpc_{method}", None)
+            if result is not None:
+                result = result(conn, call_id, **params)
+            else:
+                result = getattr(self.network, method)(**params)
+            reply = {"id": call_id, "result": result}
+        except Exception as e:
+            reply = {"id": call_id, "error": str(e), "kind": type(e).__name__}
+        RPC_SECONDS.labels(str(method)).observe(time.perf_counter() - start)
+        send_json(conn, reply)
+
+    def _rpc_status(self, conn, call_id):
+        return {
+            "running": self.network.running,
+            "username": self.network.username,
+            "user_id": self.network.user_id,
+        }
+
+    def _rpc_start(self, conn, call_id, username):
+        # One identity per daemon; a second login under another name is refused
+        if self.network.running and self.network.username != username:
+            raise RuntimeError(f"network already running as {self.network.username}")
+        if self.network.username != username:
+            self.network.set_username(username)
+        self.network.start()
+        return self._rpc_status(conn, call_id)
+
+    def _rpc_send_file(self, conn, call_id, recipient_id, path, transfer_id=None, progress=False):
+        def on_progress(done, size):
+            send_json(conn, {"id": call_id, "progress": [done, size]})
+        return self.network.send_file(recipient_id, path, transfer_id, on_progress if progress else None)
+
+    # ------------------ Events ------------------
+    def _publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # A stuck web process must not hold up packet handling
+                self._drop(q)
+
+    def _drop(self, q):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+                SUBSCRIBERS.dec()
+
+    def _stream_events(self, conn):
+        q = queue.Queue(maxsize=self.EVENT_QUEUE)
+        with self._lock:
+            self._subscribers.append(q)
+        SUBSCRIBERS.inc()
+        try:
+            send_json(conn, {"subscribed": True})
+            while self.running:
+                try:
+                    event = q.get(timeout=1)
+                except queue.Empty:
+                    if q not in self._subscribers:
+                        return
+                    continue
+                send_json(conn, {"event": event})
+        except OSError:
+            pass
+        finally:
+            self._drop(q)
+
+
+# ------------------ Client ------------------
+class NetworkClient:
+    """Stands in for NetworkManager in a web process, forwarding to the daemon."""
+
+    RECONNECT_DELAY = 1
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+        self.username = None
+        self.message_callbacks = []
+        self._local = threading.local()  # one connection per calling thread
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+        self._events_thread = None
+        self._closed = False
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def call(self, method, on_progress=None, **params):
+        with self._id_lock:
+            self._next_id += 1
+            call_id = self._next_id
+
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = self._local.sock = self._connect()
+        try:
+            send_json(sock, {"id": call_id, "method": method, "params": params})
+            while True:
+                reply = recv_json(sock)
+                if "progress" not in reply:
+                    break
+                if on_progress:
+                    on_progress(*reply["progress"])
+        except (OSError, ValueError):
+            # The daemon restarted or the stream is out of step; reconnect next call
+            self._local.sock = None
+            sock.close()
+            raise
+
+        if "error" in reply:
+            raise RemoteError(reply["error"], reply.get("kind"))
+        return reply["result"]
+
+    # ------------------ NetworkManager API ------------------
+    @property
+    def running(self):
+        try:
+            return self.call("status")["running"]
+        except (OSError, RemoteError):
+            return False
+
+    @property
+    def user_id(self):
+        return self.call("status")["user_id"]
+
+    def set_username(self, username, keys=None):
+        self.username = username
+
+    def start(self):
+        self.call("start", username=self.username)
+        self.subscribe()
+
+    def stop(self, wait=False):
+        # The daemon keeps running for the other web processes
+        self._closed = True
+
+    def get_online_users(self):
+        return self.call("get_online_users")
+
+    def get_key_conflicts(self):
+        return self.call("get_key_conflicts")
+
+    def trust_new_key(self, username):
+        return self.call("trust_new_key", username=username)
+
+    def send_message(self, recipient_id, plaintext, message_id=None):
+        return self.call("send_message", recipient_id=recipient_id, plaintext=plaintext,
+                         message_id=message_id)
+
+    def send_group_message(self, group_id, group_name, members, message_id, plaintext):
+        return self.call("send_group_message", group_id=group_id, group_name=group_name,
+                         members=list(members), message_id=message_id, plaintext=plaintext)
+
+    def send_file(self, recipient_id, path, transfer_id=None, on_progress=None):
+        return self.call("send_file", on_progress, recipient_id=recipient_id, path=str(path),
+                         transfer_id=transfer_id, progress=on_progress is not None)
+
+    def send_status_update(self, recipient_id, message_id, status, group_id=None):
+        return self.call("send_status_update", recipient_id=recipient_id, message_id=message_id,
+                         status=status, group_id=group_id)
+
+    # ------------------ Events ------------------
+    def subscribe(self):
+        """Start delivering the daemon's events to message_callbacks (idempotent)."""
+        if self._events_thread is None:
+            self._events_thread = threading.Thread(target=self._receive_events, daemon=True)
+            self._events_thread.start()
+
+    def _receive_events(self):
+        lost = False
+        while not self._closed:
+            try:
+                sock = self._connect()
+                sock.settimeout(None)
+                send_json(sock, {"method": "subscribe"})
+                recv_json(sock)
+                lost = False
+                while not self._closed:
+                    event = recv_json(sock)["event"]
+                    for cb in self.message_callbacks:
+                        try:
+                            cb(event)
+                        except Exception as e:
+                            log.exception("Event callback failed: %s", e)
+            except (OSError, ValueError) as e:
+                if not lost:
+                    log.warning("Event stream lost (%s); reconnecting", e)
+                lost = True
+                time.sleep(self.RECONNECT_DELAY)
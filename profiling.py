@@ -0,0 +1,182 @@
+"""
+Request profiling - sampled cProfile captures and slow-operation traces
+
+Targets are "<kind>:<name>" strings, e.g. "http:/api/messages" for a Flask
+route or "packet:secure_message" for an inbound peer packet. Each target
+has a sample rate; sampled operations are run under cProfile and dumped
+to the profile directory. Independently, any traced operation slower than
+the threshold is written to slow.log with its timing breakdown.
+"""
+
+import cProfile
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+import logs
+
+_local = threading.local()
+
+
+class _Trace:
+    __slots__ = ("target", "start", "breakdown", "profile")
+
+    def __init__(self, target, start):
+        self.target = target
+        self.start = start
+        self.breakdown = {}
+        self.profile = None
+
+
+class Profiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.targets = {}            # target -> sample rate (0..1]
+        self.slow_threshold = None   # seconds; None disables slow traces
+        self.output_dir = None
+        self.max_profiles = 50
+        self._slow_log = None
+
+    # ------------------ Configuration ------------------
+    def configure(self, output_dir=None, slow_threshold=None, max_profiles=None):
+        with self._lock:
+            if output_dir is not None and Path(output_dir) != self.output_dir:
+                self.output_dir = Path(output_dir)
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                self._slow_log = self._open_slow_log()
+            if slow_threshold is not None:
+                self.slow_threshold = slow_threshold if slow_threshold > 0 else None
+            if max_profiles is not None:
+                self.max_profiles = max_profiles
+
+    def set_target(self, target, rate):
+        """Sample `rate` (0..1) of operations matching `target`; 0 turns it off."""
+        with self._lock:
+            if rate <= 0:
+                self.targets.pop(target, None)
+            else:
+                self.targets[target] = min(float(rate), 1.0)
+
+    def status(self):
+        return {
+            "targets": dict(self.targets),
+            "slow_ms": self.slow_threshold * 1000 if self.slow_threshold else None,
+            "output_dir": str(self.output_dir) if self.output_dir else None,
+            "max_profiles": self.max_profiles,
+        }
+
+    def _open_slow_log(self):
+        logger = logging.getLogger("securelocal.slow")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        handler = RotatingFileHandler(
+            self.output_dir / "slow.log", maxBytes=1_000_000, backupCount=5
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # Written from a background thread so slow requests don't also wait on disk
+        logger.addHandler(logs.background(handler))
+        return logger
+
+    # ------------------ Tracing ------------------
+    def begin(self, kind, name, start=None):
+        """Start tracing an operation on this thread; returns a token for end()."""
+        if getattr(_local, "trace", None) is not None:
+            return None  # already inside a traced operation
+
+        target = f"{kind}:{name}"
+        rate = self.targets.get(target)
+        if rate is None and self.slow_threshold is None:
+            return None
+
+        trace = _Trace(target, start if start is not None else time.perf_counter())
+        if rate is not None and self.output_dir is not None and random.random() < rate:
+            trace.profile = cProfile.Profile()
+            trace.profile.enable()
+        _local.trace = trace
+        return trace
+
+    def end(self, trace):
+        if trace is None:
+            return
+        _local.trace = None
+
+        duration = time.perf_counter() - trace.start
+        profile_path = None
+        if trace.profile is not None:
+            trace.profile.disable()
+            profile_path = self._dump_profile(trace, duration)
+
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            self._log_slow(trace, duration, profile_path)
+
+    @contextmanager
+    def trace(self, kind, name):
+        token = self.begin(kind, name)
+        try:
+            yield
+        finally:
+            self.end(token)
+
+    # ------------------ Output ------------------
+    def _dump_profile(self, trace, duration):
+        safe_target = "".join(c if c.isalnum() else "_" for c in trace.target).strip("_")
+        path = self.output_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{int(duration * 1000)}ms-{safe_target}.prof"
+        try:
+            trace.profile.dump_stats(path)
+            self._rotate_profiles()
+            return str(path)
+        except OSError:
+            return None
+
+    def _rotate_profiles(self):
+        profiles = sorted(self.output_dir.glob("profile-*.prof"), key=lambda p: p.stat().st_mtime)
+        for old in profiles[:-self.max_profiles]:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+    def _log_slow(self, trace, duration, profile_path):
+        if self._slow_log is None:
+            return
+        accounted = sum(trace.breakdown.values())
+        breakdown = {k: round(v * 1000, 3) for k, v in trace.breakdown.items()}
+        breakdown["other"] = round(max(duration - accounted, 0) * 1000, 3)
+        self._slow_log.info(json.dumps({
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "target": trace.target,
+            "duration_ms": round(duration * 1000, 3),
+            "breakdown_ms": breakdown,
+            "profile": profile_path,
+        }))
+
+
+PROFILER = Profiler()
+
+
+# ------------------ Breakdown helpers ------------------
+def record(category, seconds):
+    """Add `seconds` to `category` (lock_wait, sql, crypto, socket) of the active trace."""
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.breakdown[category] = trace.breakdown.get(category, 0.0) + seconds
+
+
+@contextmanager
+def span(category):
+    if getattr(_local, "trace", None) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, time.perf_counter() - start)
@@ -0,0 +1,196 @@
+"""
+Production WSGI server - pooled worker threads, HTTP keep-alive, bounded queue
+
+Pure stdlib (wsgiref + http.server) so the PyInstaller bundle needs nothing extra.
+"""
+
+import logging
+import queue
+import signal
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+from werkzeug.wsgi import LimitedStream
+
+log = logging.getLogger("securelocal.server")
+
+
+class _KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        # Without a length the client can only find the end of the body by EOF
+        if "Content-Length" not in self.headers or self.request_handler.close_connection:
+            self.request_handler.close_connection = True
+            self.headers["Connection"] = "close"
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # Idle keep-alive connections give their worker back after this many seconds
+        self.timeout = self.server.keepalive_timeout
+        super().setup()
+
+    def log_request(self, code="-", size="-"):
+        # The app writes its own access log (logs.AccessLog)
+        pass
+
+    def log_message(self, format, *args):
+        log.warning("%s %s", self.address_string(), format % args)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.send_error(411)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return
+
+        stdin = LimitedStream(self.rfile, length)
+        handler = _KeepAliveServerHandler(
+            stdin, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=True
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        # Skip any body the app didn't read so the next request line lines up
+        if not self.close_connection:
+            try:
+                stdin.exhaust()
+            except Exception:
+                self.close_connection = True
+
+
+class PooledWSGIServer(WSGIServer):
+    """Hands accepted connections to a fixed pool of worker threads.
+
+    Connections wait in a bounded queue; once it is full new connections
+    get an immediate 503 instead of piling up behind busy workers.
+    """
+
+    def __init__(self, host, port, app, threads=8, queue_size=64,
+                 backlog=128, keepalive_timeout=5, reuse_port=False):
+        self.request_queue_size = backlog
+        # Several worker processes bind the same port; the kernel spreads connections
+        self.allow_reuse_port = reuse_port
+        self.keepalive_timeout = keepalive_timeout
+        self.rejected = 0
+
+        self._pending = queue.Queue(maxsize=queue_size)
+        self._workers = []
+
+        super().__init__((host, port), KeepAliveRequestHandler)
+        self.set_app(app)
+        self.port = self.server_address[1]
+
+        for i in range(threads):
+            t = threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    # ------------------ Dispatch ------------------
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected += 1
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall(
+                b"HTTP/1.1 503 Service Unavailable\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: 0\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    # ------------------ Shutdown ------------------
+    def queue_depth(self):
+        return self._pending.qsize()
+
+    def drain(self, timeout=10):
+        """Let workers finish queued connections, then stop them."""
+        for _ in self._workers:
+            self._pending.put(None)
+        for t in self._workers:
+            t.join(timeout)
+
+
+def serve(app, host="0.0.0.0", port=5000, threads=8, queue_size=64,
+          backlog=128, keepalive_timeout=5, reuse_port=False, on_shutdown=None):
+    """Run `app` until SIGINT/SIGTERM, then drain workers and call `on_shutdown`."""
+    server = PooledWSGIServer(
+        host, port, app,
+        threads=threads,
+        queue_size=queue_size,
+        backlog=backlog,
+        keepalive_timeout=keepalive_timeout,
+        reuse_port=reuse_port,
+    )
+
+    def _stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it can't run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, _stop)
+        signal.signal(signal.SIGTERM, _stop)
+
+    log.info("Serving on http://%s:%s (%s threads, queue %s, backlog %s)",
+             host, server.port, threads, queue_size, backlog)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.drain()
+        log.info("Stopped (%s connections rejected)", server.rejected)
+        if on_shutdown:
+            on_shutdown()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Simulated network run - many NetworkManagers on one in-process network
+
+Every peer is a real NetworkManager with an in-memory DatabaseManager,
+talking through a SimulatedTransport (transport.py) instead of sockets, so
+discovery and delivery can be profiled at scale with configurable latency,
+loss, bandwidth and partitions and without any network access.
+
+    python simulate.py --peers 500 --latency-ms 2 --jitter-ms 1 --loss 0.01 \\
+        --messages 1000 --rate 200 --output sim.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import DatabaseManager
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+
+def _ip(index):
+    n = index + 1
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def _ms_summary(values):
+    values = sorted(values)
+
+    def ms(v):
+        return round(v * 1000, 3) if v is not None else None
+
+    return {
+        "p50": ms(_percentile(values, 50)),
+        "p90": ms(_percentile(values, 90)),
+        "p99": ms(_percentile(values, 99)),
+        "max": ms(values[-1] if values else None),
+    }
+
+
+def run(args, log):
+    from e2e_encryption import KEY_AGREEMENTS, generate_rsa_keys
+
+    net = SimulatedNetwork(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        loss=args.loss,
+        bandwidth=args.bandwidth_kbps * 125 if args.bandwidth_kbps else None,
+        seed=args.seed,
+    )
+
+    # X25519 identities are generated per peer in no time; RSA ones would
+    # dominate the run, so without X25519 every virtual peer shares one
+    keys_dir = tempfile.mkdtemp(prefix="simulate-keys-")
+    shared_keys = None if "x25519" in KEY_AGREEMENTS else generate_rsa_keys("simulate", keys_dir)
+
+    # ---- Start peers ----
+    nodes = []
+    lock = threading.Lock()
+    latencies = []
+    delivered = [0]
+
+    def make_callback():
+        def on_event(event):
+            if event["type"] == "message" and event["message"].startswith("SIM|"):
+                sent_at = float(event["message"].split("|", 2)[1])
+                with lock:
+                    delivered[0] += 1
+                    latencies.append(time.monotonic() - sent_at)
+        return on_event
+
+    log(f"[SIM] Starting {args.peers} peers")
+    started = time.monotonic()
+    for i in range(args.peers):
+        node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(_ip(i)),
+                              discovery=args.discovery, keys_dir=keys_dir)
+        node.BROADCAST_INTERVAL = args.beacon_interval
+        node.PEER_WORKERS = args.peer_workers
+        node.set_username(f"peer{i}", keys=shared_keys)
+        node.message_callbacks.append(make_callback())
+        node.start()
+        nodes.append(node)
+    startup = time.monotonic() - started
+
+    # ---- Discovery convergence ----
+    converged_at = {}
+    deadline = time.monotonic() + args.discovery_timeout
+    while len(converged_at) < len(nodes) and time.monotonic() < deadline:
+        now = time.monotonic()
+        for i, node in enumerate(nodes):
+            if i not in converged_at and node._count_peers() >= len(nodes) - 1:
+                converged_at[i] = now - started
+        time.sleep(0.1)
+    log(f"[SIM] {len(converged_at)}/{len(nodes)} peers saw everyone")
+
+    # ---- Delivery ----
+    rng = random.Random(args.seed)
+    if args.partition:
+        cut = int(len(nodes) * args.partition)
+        net.partition([_ip(i) for i in range(cut)], [_ip(i) for i in range(cut, len(nodes))])
+        log(f"[SIM] Partitioned {cut} peers from {len(nodes) - cut}")
+
+    send_locks = [threading.Lock() for _ in nodes]
+    errors = [0]
+
+    def send(sender, recipient, size):
+        text = f"SIM|{time.monotonic():.6f}|".ljust(size, "x")
+        try:
+            # One send at a time per peer, as a single UI would do
+            with send_locks[sender]:
+                nodes[sender].send_message(nodes[recipient].user_id, text)
+        except Exception:
+            with lock:
+                errors[0] += 1
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    send_started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.senders) as pool:
+        for n in range(args.messages):
+            sender, recipient = rng.sample(range(len(nodes)), 2)
+            pool.submit(send, sender, recipient, rng.choice(sizes))
+            delay = send_started + (n + 1) / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    time.sleep(args.drain)
+    send_phase = time.monotonic() - send_started
+
+    for node in nodes:
+        node.stop()
+    shutil.rmtree(keys_dir, ignore_errors=True)
+
+    return {
+        "config": vars(args),
+        "startup_s": round(startup, 3),
+        "discovery": {
+            "converged": len(converged_at),
+            "peers": len(nodes),
+            "convergence_ms": _ms_summary(list(converged_at.values())),
+        },
+        "delivery": {
+            "sent": args.messages,
+            "delivered": delivered[0],
+            "send_errors": errors[0],
+            "throughput_msgs_per_s": round(delivered[0] / send_phase, 2),
+            "latency_ms": _ms_summary(latencies),
+        },
+        "network": dict(net.stats),
+    }
+
+
+def print_report(summary):
+    print("\n" + "="*60)
+    print("SIMULATED NETWORK RUN")
+    print("="*60)
+    d = summary["discovery"]
+    print(f"Peers started in {summary['startup_s']}s")
+    print(f"Discovery: {d['converged']}/{d['peers']} converged, ms {d['convergence_ms']}")
+    m = summary["delivery"]
+    print(f"Delivery: {m['delivered']}/{m['sent']} delivered, {m['send_errors']} errors, "
+          f"{m['throughput_msgs_per_s']} msgs/s")
+    print(f"Latency ms: {m['latency_ms']}")
+    print(f"Network: {summary['network']}")
+    print("="*60)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run many peers on a simulated in-process network")
+    parser.add_argument("--peers", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="one-way latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability")
+    parser.add_argument("--bandwidth-kbps", type=float, default=0,
+                        help="per-host uplink in kbit/s (0 = unlimited)")
+    parser.add_argument("--beacon-interval", type=float, default=1.0)
+    parser.add_argument("--peer-workers", type=int, default=4,
+                        help="inbound connection workers per peer (threads add up at scale)")
+    parser.add_argument("--discovery", choices=("multicast", "broadcast", "both"), default="both")
+    parser.add_argument("--discovery-timeout", type=float, default=30.0)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--sizes", default="64,512,4096")
+    parser.add_argument("--senders", type=int, default=16, help="concurrent sending threads")
+    parser.add_argument("--partition", type=float, default=0.0,
+                        help="fraction of peers cut off from the rest during delivery")
+    parser.add_argument("--drain", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show per-peer output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = sys.stdout
+
+    def log(msg):
+        print(msg, file=out, flush=True)
+
+    # Thousands of peers each print on start; keep the report readable
+    threading.stack_size(512 * 1024)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="[%(name)s] %(message)s")
+    else:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        summary = run(args, log)
+    finally:
+        sys.stdout = out
+
+    print_report(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
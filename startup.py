@@ -0,0 +1,30 @@
+"""
+Startup profiling - records import and init time per component
+"""
+
+import time
+from contextlib import contextmanager
+
+timings = []  # (phase, name, seconds) in the order they happened
+
+
+@contextmanager
+def timed(phase, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((phase, name, time.perf_counter() - start))
+
+
+def report():
+    total = sum(t for _, _, t in timings)
+
+    print("\n" + "="*60)
+    print("STARTUP PROFILE")
+    print("="*60)
+    for phase, name, seconds in timings:
+        print(f"  {phase:<8} {name:<24} {seconds * 1000:9.1f} ms")
+    print("-"*60)
+    print(f"  {'total':<33} {total * 1000:9.1f} ms")
+    print("="*60)
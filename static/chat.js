@@ -7,102 +7,379 @@ const messagesEl = document.getElementById('messagesContainer');
 const messageInputEl = document.getElementById('messageInput');
 const sendBtnEl = document.getElementById('sendBtn');
 const currentChatEl = document.getElementById('currentChat');
+const fileInputEl = document.getElementById('fileInput');
+const fileBtnEl = document.getElementById('fileBtn');
+const transferListEl = document.getElementById('transferList');
+const groupListEl = document.getElementById('groupList');
+const newGroupBtnEl = document.getElementById('newGroupBtn');
 
 let typingTimeout;
+let typingActive = false;
 
 // ----------------- Online Users -----------------
-async function updateOnlineUsers() {
-    try {
-        const response = await fetch('/api/users');
-        if (!response.ok) return;
-        const data = await response.json();
-        const users = data.users || [];
+function renderUsers(users) {
+    userListEl.innerHTML = '';
+    if (!users.length) {
+        userListEl.innerHTML = '<div class="empty-state">No users online</div>';
+        return;
+    }
 
-        userListEl.innerHTML = '';
-        if (!users.length) {
-            userListEl.innerHTML = '<div class="empty-state">No users online</div>';
+    users.forEach(user => {
+        const li = document.createElement('li');
+        li.className = 'user-item';
+        if (user.key_changed) {
+            renderKeyChanged(li, user);
+            userListEl.appendChild(li);
             return;
         }
+        if (currentUser && !currentUser.group_id && currentUser.username === user.username) li.classList.add('active');
+        li.innerHTML = `<div class="user-name">${user.username}</div>`;
+        li.onclick = (e) => selectUser(user, e);
+        userListEl.appendChild(li);
+    });
+}
 
-        users.forEach(user => {
-            const li = document.createElement('li');
-            li.className = 'user-item';
-            if (currentUser && currentUser.username === user.username) li.classList.add('active');
-            li.innerHTML = `<div class="user-name">${user.username}</div>`;
-            li.onclick = (e) => selectUser(user, e);
-            userListEl.appendChild(li);
+// Someone is using a known user's name with a different key: it may be that
+// user on a new install, or someone else. Only trusted once the user says so.
+function renderKeyChanged(li, user) {
+    li.classList.add('key-changed');
+    const name = document.createElement('div');
+    name.className = 'user-name';
+    name.textContent = `⚠ ${user.username}: key changed`;
+    li.appendChild(name);
+
+    const btn = document.createElement('button');
+    btn.textContent = 'Trust new key';
+    btn.onclick = () => trustNewKey(user.username);
+    li.appendChild(btn);
+}
+
+async function trustNewKey(username) {
+    if (!confirm(`Only trust the new key if ${username} confirms they reinstalled or changed devices. Trust it?`)) return;
+    try {
+        await fetch(`/api/peers/${encodeURIComponent(username)}/trust`, { method: 'POST' });
+        requestSync(0);
+    } catch (err) {
+        console.error('Error trusting key:', err);
+    }
+}
+
+// ----------------- Groups -----------------
+function renderGroups(groups) {
+    groupListEl.innerHTML = '';
+    groups.forEach(group => {
+        const li = document.createElement('li');
+        li.className = 'user-item';
+        if (currentUser && currentUser.group_id === group.id) li.classList.add('active');
+        const name = document.createElement('div');
+        name.className = 'user-name';
+        name.textContent = group.name;
+        li.appendChild(name);
+        li.onclick = (e) => selectUser({ username: group.name, group_id: group.id }, e);
+        groupListEl.appendChild(li);
+    });
+}
+
+async function createGroup() {
+    const name = prompt('Group name');
+    if (!name) return;
+    const members = (prompt('Members (comma-separated usernames)') || '')
+        .split(',').map(m => m.trim()).filter(Boolean);
+    if (!members.length) return;
+
+    try {
+        const response = await fetch('/api/groups', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ name, members })
         });
+        if (!response.ok) {
+            const error = await response.json();
+            alert(`Failed: ${error.error || 'Unknown error'}`);
+        }
+        requestSync(0);
     } catch (err) {
-        console.error('Error loading users:', err);
+        console.error('Error creating group:', err);
     }
 }
 
 // ----------------- Select Chat -----------------
 function selectUser(user, event) {
+    if (typingActive) stopTyping();
     currentUser = user;
     document.querySelectorAll('.user-item').forEach(i => i.classList.remove('active'));
     event.currentTarget.classList.add('active');
 
     currentChatEl.textContent = `Chat with ${user.username}`;
     messageInputEl.disabled = sendBtnEl.disabled = false;
+    fileBtnEl.disabled = !!user.group_id;
     messageInputEl.focus();
 
-    loadMessages(user.username);
+    resetMessages();
+    renderTyping();
+    stickNext = true;
+    requestSync(0);
+}
+
+function chatKey(user) {
+    return user.group_id ? `group:${user.group_id}` : `user:${user.username}`;
+}
+
+function messagesUrl() {
+    return currentUser.group_id
+        ? `/api/messages?group=${encodeURIComponent(currentUser.group_id)}`
+        : `/api/messages?with=${encodeURIComponent(currentUser.username)}`;
 }
 
 // ----------------- Messages -----------------
-async function loadMessages(recipient) {
+// The open conversation lives in a local store keyed by message id. Polls
+// only append new rows and patch the ones whose status changed, and the
+// pane only renders the rows near the viewport: spacers stand in for the
+// rest, and older pages are fetched when the user scrolls to the top.
+const ROW_ESTIMATE = 60;      // px, height assumed for rows not rendered yet
+const OVERSCAN = 600;         // px rendered beyond each edge of the viewport
+const STICK_DISTANCE = 40;    // px from the bottom that still counts as at the bottom
+
+let store = new Map();        // id -> message
+let order = [];               // ids, oldest first
+let heights = new Map();      // id -> measured row height
+let rowEls = new Map();       // id -> rendered row
+let markedRead = new Set();   // ids already reported as read
+let openChat = null;          // chatKey() the store belongs to
+let hasOlder = false;
+let loadingOlder = false;
+let renderQueued = false;
+let stickNext = false;       // scroll to the newest row when the next sync lands
+
+const topSpacerEl = document.createElement('div');
+const bottomSpacerEl = document.createElement('div');
+const emptyEl = document.createElement('div');
+emptyEl.className = 'empty-state';
+emptyEl.textContent = 'No messages yet';
+
+function resetMessages() {
+    store = new Map();
+    order = [];
+    heights = new Map();
+    rowEls = new Map();
+    markedRead = new Set();
+    openChat = currentUser ? chatKey(currentUser) : null;
+    hasOlder = false;
+    topSpacerEl.style.height = bottomSpacerEl.style.height = '0px';
+    messagesEl.replaceChildren(topSpacerEl, bottomSpacerEl);
+}
+
+function isMine(msg) {
+    return msg.sender.toLowerCase() === username;
+}
+
+/** Own message whose delivery or read receipts may still change. */
+function unconfirmed(msg) {
+    if (!isMine(msg)) return false;
+    if (msg.receipts) return Object.values(msg.receipts).some(s => s !== 'read');
+    return msg.status !== 'read';
+}
+
+/** What the open chat already holds, for /api/sync to send only what is new. */
+function chatCursor() {
+    const chat = currentUser.group_id ? { group: currentUser.group_id } : { with: currentUser.username };
+    if (order.length) {
+        chat.after = store.get(order[order.length - 1]).uid;
+        const pending = order.find(id => unconfirmed(store.get(id)));
+        if (pending !== undefined) chat.unread = store.get(pending).uid;
+    }
+    return chat;
+}
+
+/** Merge the open chat's part of a sync reply. */
+function applyChat(delta) {
+    // More arrived since the last sync than one page holds: start from the newest
+    if (delta.reset) {
+        resetMessages();
+        hasOlder = true;
+    }
+    if (!order.length && 'has_more' in delta) hasOlder = !!delta.has_more;
+
+    const updates = (delta.messages || []).slice();
+    for (const st of delta.statuses || []) {
+        const known = store.get(st.id);
+        if (known) updates.push({ ...known, status: st.status, receipts: st.receipts || known.receipts });
+    }
+
+    const atBottom = isAtBottom();
+    const changed = mergeMessages(updates);
+    if (changed.length || !order.length) renderMessages(stickNext || atBottom);
+    stickNext = false;
+    markMessagesAsRead(changed);
+}
+
+async function loadOlderMessages() {
+    if (loadingOlder || !hasOlder || !order.length) return;
+    const key = openChat;
+    loadingOlder = true;
     try {
-        const response = await fetch(`/api/messages?with=${encodeURIComponent(recipient)}`);
+        const oldest = store.get(order[0]);
+        const response = await fetch(`${messagesUrl()}&before=${encodeURIComponent(oldest.uid)}`);
         if (!response.ok) return;
         const data = await response.json();
-        const messages = data.messages || [];
-        displayMessages(messages);
-        markMessagesAsRead(messages);
+        if (key !== openChat) return;
+        hasOlder = !!data.has_more;
+
+        const messages = (data.messages || []).filter(m => !store.has(m.id));
+        if (!messages.length) return;
+        mergeMessages(messages);
+        // The top spacer grows by the estimate for each new row; keep the view where it was
+        messagesEl.scrollTop += messages.length * ROW_ESTIMATE;
+        renderMessages(false);
     } catch (err) {
-        console.error('Error loading messages:', err);
+        console.error('Error loading older messages:', err);
+    } finally {
+        loadingOlder = false;
     }
 }
 
-function displayMessages(messages) {
-    messagesEl.innerHTML = '';
+function signature(msg) {
+    return `${msg.status}|${JSON.stringify(msg.receipts || {})}`;
+}
+
+/** Add new messages and patch changed ones; returns the messages that changed. */
+function mergeMessages(messages) {
+    const changed = [];
+    let appended = true;
+    for (const msg of messages) {
+        if (!msg || !msg.sender) continue;
+        const known = store.get(msg.id);
+        if (!known) {
+            if (order.length && msg.uid < store.get(order[order.length - 1]).uid) appended = false;
+            store.set(msg.id, msg);
+            order.push(msg.id);
+            changed.push(msg);
+        } else if (signature(known) !== signature(msg)) {
+            store.set(msg.id, msg);
+            const row = rowEls.get(msg.id);
+            if (row) fillMeta(row.querySelector('.message-time'), msg);
+            changed.push(msg);
+        }
+    }
+    if (!appended) order.sort((a, b) => (store.get(a).uid < store.get(b).uid ? -1 : 1));
+    return changed;
+}
+
+function statusHTML(msg) {
+    if (msg.receipts) {
+        const states = Object.values(msg.receipts);
+        const read = states.filter(s => s === 'read').length;
+        const delivered = states.filter(s => s !== 'sent').length;
+        return `<span class="status ${msg.status}">Delivered ${delivered}/${states.length} • Read ${read}/${states.length}</span>`;
+    }
+    if (msg.status === 'read') return '<span class="status read">Read</span>';
+    if (msg.status === 'delivered') return '<span class="status delivered">Delivered</span>';
+    return '<span class="status sent">Sent</span>';
+}
+
+function fillMeta(metaEl, msg) {
+    const isSent = isMine(msg);
+    const time = msg.timestamp ? new Date(msg.timestamp).toLocaleTimeString() : '';
+    metaEl.textContent = `${time} • ${msg.sender} `;
+    if (isSent) metaEl.insertAdjacentHTML('beforeend', statusHTML(msg));
+}
+
+function messageRow(msg) {
+    const div = document.createElement('div');
+    div.className = `message ${msg.sender.toLowerCase() === username ? 'sent' : 'received'}`;
+
+    const bubble = document.createElement('div');
+    bubble.className = 'message-bubble';
+    bubble.textContent = msg.message || msg.plaintext || msg.content || '[Encrypted message]';
+    div.appendChild(bubble);
+
+    const meta = document.createElement('div');
+    meta.className = 'message-time';
+    fillMeta(meta, msg);
+    div.appendChild(meta);
+    return div;
+}
+
+function isAtBottom() {
+    return messagesEl.scrollHeight - messagesEl.scrollTop - messagesEl.clientHeight < STICK_DISTANCE;
+}
+
+function rowHeight(id) {
+    return heights.get(id) || ROW_ESTIMATE;
+}
 
-    if (!Array.isArray(messages) || !messages.length) {
-        messagesEl.innerHTML = '<div class="empty-state">No messages yet</div>';
+/** Render the rows around the viewport (or the newest rows) between the two spacers. */
+function renderMessages(stickToBottom) {
+    if (!order.length) {
+        rowEls.forEach(row => row.remove());
+        rowEls.clear();
+        messagesEl.replaceChildren(emptyEl);
         return;
     }
+    if (emptyEl.parentNode) messagesEl.replaceChildren(topSpacerEl, bottomSpacerEl);
 
-    messages.forEach(msg => {
-        if (!msg || !msg.sender) return;
+    let total = 0;
+    for (const id of order) total += rowHeight(id);
+    const viewTop = stickToBottom ? Math.max(total - messagesEl.clientHeight, 0) : messagesEl.scrollTop;
+    const from = viewTop - OVERSCAN;
+    const to = viewTop + messagesEl.clientHeight + OVERSCAN;
 
-        const div = document.createElement('div');
-        const isSent = msg.sender.toLowerCase() === username;
-        div.className = `message ${isSent ? 'sent' : 'received'}`;
-
-        const time = msg.timestamp
-            ? new Date(msg.timestamp).toLocaleTimeString()
-            : '';
-
-        let statusHTML = '';
-        if (isSent) {
-            if (msg.status === 'read') statusHTML = '<span class="status read">Read</span>';
-            else if (msg.status === 'delivered') statusHTML = '<span class="status delivered">Delivered</span>';
-            else statusHTML = '<span class="status sent">Sent</span>';
+    let first = -1, last = order.length - 1, above = 0, offset = 0;
+    for (let i = 0; i < order.length; i++) {
+        const h = rowHeight(order[i]);
+        if (first < 0 && offset + h >= from) { first = i; above = offset; }
+        if (offset > to) { last = i - 1; break; }
+        offset += h;
+    }
+    if (first < 0) { first = order.length - 1; above = total - rowHeight(order[first]); }
+    last = Math.max(last, first);
+
+    const visible = new Set(order.slice(first, last + 1));
+    rowEls.forEach((row, id) => {
+        if (!visible.has(id)) { row.remove(); rowEls.delete(id); }
+    });
+
+    // Insert missing rows in order; rows already in place are not touched
+    let prev = topSpacerEl;
+    for (let i = first; i <= last; i++) {
+        const id = order[i];
+        let row = rowEls.get(id);
+        if (!row) {
+            row = messageRow(store.get(id));
+            rowEls.set(id, row);
         }
+        if (prev.nextSibling !== row) messagesEl.insertBefore(row, prev.nextSibling);
+        prev = row;
+    }
 
-        const text = msg.message || msg.plaintext || msg.content || '[Encrypted message]';
+    let below = 0;
+    for (let i = last + 1; i < order.length; i++) below += rowHeight(order[i]);
+    topSpacerEl.style.height = `${above}px`;
+    bottomSpacerEl.style.height = `${below}px`;
 
-        div.innerHTML = `
-            <div class="message-bubble">${text}</div>
-            <div class="message-time">${time} • ${msg.sender} ${statusHTML}</div>
-        `;
+    for (const [id, row] of rowEls) {
+        if (!heights.has(id)) {
+            heights.set(id, row.offsetHeight + parseFloat(getComputedStyle(row).marginBottom || 0));
+        }
+    }
+    if (stickToBottom) messagesEl.scrollTop = messagesEl.scrollHeight;
+}
 
-        messagesEl.appendChild(div);
+function scheduleRender() {
+    if (renderQueued) return;
+    renderQueued = true;
+    requestAnimationFrame(() => {
+        renderQueued = false;
+        renderMessages(false);
     });
-
-    messagesEl.scrollTop = messagesEl.scrollHeight;
 }
 
+messagesEl.addEventListener('scroll', () => {
+    if (!openChat) return;
+    scheduleRender();
+    if (messagesEl.scrollTop < OVERSCAN) loadOlderMessages();
+});
+
 // ----------------- Send Message -----------------
 async function sendMessage() {
     const message = messageInputEl.value.trim();
@@ -113,12 +390,16 @@ async function sendMessage() {
         const response = await fetch('/api/messages', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ recipient: currentUser.username, message })
+            body: JSON.stringify(currentUser.group_id
+                ? { group_id: currentUser.group_id, message }
+                : { recipient: currentUser.username, message })
         });
 
         if (response.ok) {
             messageInputEl.value = '';
-            loadMessages(currentUser.username);
+            if (typingActive) stopTyping();
+            stickNext = true;
+            requestSync(0);
         } else {
             const error = await response.json();
             alert(`Failed: ${error.error || 'Unknown error'}`);
@@ -132,80 +413,216 @@ async function sendMessage() {
     }
 }
 
-// ----------------- Typing -----------------
-messageInputEl.addEventListener('input', () => {
-    if (!currentUser) return;
-    notifyTyping('start');
-    clearTimeout(typingTimeout);
-    typingTimeout = setTimeout(() => notifyTyping('stop'), 1000);
-});
+// ----------------- File Transfers -----------------
+async function sendFile() {
+    const file = fileInputEl.files[0];
+    if (!file || !currentUser) return;
+
+    const form = new FormData();
+    form.append('recipient', currentUser.username);
+    form.append('file', file);
+    fileInputEl.value = '';
 
-async function notifyTyping(action) {
     try {
-        await fetch('/api/typing', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ recipient: currentUser.username, action })
-        });
+        const response = await fetch('/api/files', { method: 'POST', body: form });
+        if (!response.ok) {
+            const error = await response.json();
+            alert(`Failed: ${error.error || 'Unknown error'}`);
+        }
+        requestSync(0);
     } catch (err) {
-        console.error('Typing notification failed', err);
+        console.error('Error sending file:', err);
+        alert('Network error');
     }
 }
 
-async function fetchTyping() {
-    if (!currentUser) return;
+async function resumeTransfer(id) {
     try {
-        const res = await fetch('/api/get_typing');
-        const data = await res.json();
-        const typingUsers = data.typing || [];
-
-        let indicator = document.getElementById('typingIndicator');
-        if (!indicator) {
-            indicator = document.createElement('div');
-            indicator.id = 'typingIndicator';
-            indicator.style.padding = '0 20px 10px';
-            indicator.style.fontSize = '12px';
-            indicator.style.color = '#555';
-            messagesEl.parentNode.insertBefore(indicator, messagesEl.nextSibling);
+        await fetch(`/api/transfers/${id}/resume`, { method: 'POST' });
+        requestSync(0);
+    } catch (err) {
+        console.error('Error resuming transfer:', err);
+    }
+}
+
+function renderTransfers(list) {
+    transferListEl.innerHTML = '';
+    list.forEach(t => {
+        const div = document.createElement('div');
+        div.className = 'transfer-item';
+        const peer = t.direction === 'sent' ? `to ${t.recipient}` : `from ${t.sender}`;
+
+        const title = document.createElement('div');
+        title.textContent = `${t.name} ${peer} (${t.state})`;
+        div.appendChild(title);
+
+        const bar = document.createElement('progress');
+        bar.max = t.size || 1;
+        bar.value = t.bytes || 0;
+        div.appendChild(bar);
+
+        if (t.direction === 'received' && t.state === 'complete') {
+            const link = document.createElement('a');
+            link.href = `/api/files/${encodeURIComponent(t.name)}`;
+            link.textContent = 'Download';
+            div.appendChild(link);
+        } else if (t.direction === 'sent' && t.state === 'failed') {
+            const btn = document.createElement('button');
+            btn.textContent = 'Resume';
+            btn.onclick = () => resumeTransfer(t.id);
+            div.appendChild(btn);
         }
+        transferListEl.appendChild(div);
+    });
+}
 
-        indicator.textContent = typingUsers.includes(currentUser.username)
-            ? `${currentUser.username} is typing...`
-            : '';
-    } catch (err) {
-        console.error('Failed to fetch typing users', err);
+// ----------------- Typing -----------------
+// Only transitions are sent, with the next sync
+messageInputEl.addEventListener('input', () => {
+    if (!currentUser || currentUser.group_id) return;
+    if (!typingActive) {
+        typingActive = true;
+        pendingTyping = { recipient: currentUser.username, action: 'start' };
+        requestSync();
     }
+    clearTimeout(typingTimeout);
+    typingTimeout = setTimeout(stopTyping, 1000);
+});
+
+function stopTyping() {
+    clearTimeout(typingTimeout);
+    if (!typingActive) return;
+    typingActive = false;
+    pendingTyping = { recipient: currentUser.username, action: 'stop' };
+    requestSync();
+}
+
+function renderTyping() {
+    let indicator = document.getElementById('typingIndicator');
+    if (!indicator) {
+        indicator = document.createElement('div');
+        indicator.id = 'typingIndicator';
+        indicator.style.padding = '0 20px 10px';
+        indicator.style.fontSize = '12px';
+        indicator.style.color = '#555';
+        messagesEl.parentNode.insertBefore(indicator, messagesEl.nextSibling);
+    }
+
+    indicator.textContent = currentUser && !currentUser.group_id && typingUsers.includes(currentUser.username)
+        ? `${currentUser.username} is typing...`
+        : '';
 }
 
 // ----------------- Read Receipts -----------------
-async function markMessagesAsRead(messages) {
+// Called with new and changed messages only; each id is reported once, with the next sync
+function markMessagesAsRead(messages) {
+    const before = pendingRead.length;
     for (const msg of messages) {
-        if (msg.recipient && msg.recipient.toLowerCase() === username && msg.status !== 'read') {
-            try {
-                await fetch('/api/update_status', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ message_id: msg.id, status: 'read' })
-                });
-            } catch (err) {
-                console.error('Failed to update read status', err);
-            }
+        const toMe = msg.group_id
+            ? msg.sender.toLowerCase() !== username
+            : msg.recipient && msg.recipient.toLowerCase() === username;
+        if (toMe && msg.status !== 'read' && !markedRead.has(msg.id)) {
+            markedRead.add(msg.id);
+            pendingRead.push(msg.id);
         }
     }
+    if (pendingRead.length > before) requestSync();
 }
 
 // ----------------- Event Listeners -----------------
 sendBtnEl.addEventListener('click', sendMessage);
 messageInputEl.addEventListener('keypress', e => { if (e.key === 'Enter') sendMessage(); });
+fileBtnEl.addEventListener('click', () => fileInputEl.click());
+newGroupBtnEl.addEventListener('click', createGroup);
+fileInputEl.addEventListener('change', sendFile);
+
+// ----------------- Sync -----------------
+// One /api/sync request per poll for every panel; see api_sync in app.py
+const SYNC_INTERVAL = 2000;
+const SYNC_INTERVAL_TRANSFERRING = 1000;
+
+const versions = { presence: null, groups: null, typing: null, transfers: null };
+let typingUsers = [];
+let pendingRead = [];
+let pendingTyping = null;
+let syncing = false;
+let syncAgain = false;
+let syncTimer = null;
+let transferring = false;
+
+function applySection(name, key, render) {
+    return section => {
+        if (!section) return;
+        versions[name] = section.version;
+        if (key in section) render(section[key]);
+    };
+}
+
+const applyPresence = applySection('presence', 'users', renderUsers);
+const applyGroups = applySection('groups', 'groups', renderGroups);
+const applyTyping = applySection('typing', 'users', users => { typingUsers = users; renderTyping(); });
+const applyTransfers = applySection('transfers', 'transfers', list => {
+    transferring = list.some(t => t.state === 'active');
+    renderTransfers(list);
+});
+
+async function sync() {
+    if (syncing) {
+        syncAgain = true;
+        return;
+    }
+    syncing = true;
+    clearTimeout(syncTimer);
+
+    const body = { ...versions };
+    const key = currentUser ? chatKey(currentUser) : null;
+    if (currentUser) body.chat = chatCursor();
+    const read = pendingRead;
+    const typing = pendingTyping;
+    pendingRead = [];
+    pendingTyping = null;
+    if (read.length) body.read = read;
+    if (typing) body.typing_state = typing;
 
-// ----------------- Polling -----------------
-setInterval(updateOnlineUsers, 3000);
-setInterval(() => {
-    if (currentUser) {
-        loadMessages(currentUser.username);
-        fetchTyping();
+    try {
+        const response = await fetch('/api/sync', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+        applyPresence(data.presence);
+        applyGroups(data.groups);
+        applyTyping(data.typing);
+        applyTransfers(data.transfers);
+        // Dropped if the user switched chats meanwhile
+        if (data.chat && key === openChat) applyChat(data.chat);
+    } catch (err) {
+        console.error('Sync failed:', err);
+        // Retry the queued actions with the next sync
+        pendingRead = read.concat(pendingRead);
+        if (!pendingTyping) pendingTyping = typing;
+    } finally {
+        syncing = false;
+        if (syncAgain) {
+            syncAgain = false;
+            requestSync(0);
+        } else {
+            syncTimer = setTimeout(sync, transferring ? SYNC_INTERVAL_TRANSFERRING : SYNC_INTERVAL);
+        }
+    }
+}
+
+/** Sync soon, coalescing bursts of actions (typing, read marks) into one request. */
+function requestSync(delay = 250) {
+    if (syncing) {
+        syncAgain = true;
+        return;
     }
-}, 2000);
+    clearTimeout(syncTimer);
+    syncTimer = setTimeout(sync, delay);
+}
 
 // ----------------- Initial Load -----------------
-updateOnlineUsers();
+sync();
@@ -0,0 +1,16 @@
+import pytest
+
+from database import DatabaseManager
+
+
+@pytest.fixture
+def app_client(tmp_path, monkeypatch):
+    """A logged-in test client for "alice", with a fresh in-memory database."""
+    import app
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(app, "database", DatabaseManager(":memory:"))
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = "alice"
+    return client, app.database
@@ -0,0 +1,62 @@
+import pytest
+
+
+@pytest.fixture
+def conversation(app_client):
+    client, db = app_client
+    ids = {
+        "to_alice": db.save_message("bob", "alice", "to alice"),
+        "to_carol": db.save_message("bob", "carol", "to carol"),
+        "from_alice": db.save_message("alice", "bob", "from alice"),
+    }
+    db.create_group("g1", "G1", "bob", ["bob", "alice"])
+    db.create_group("g2", "G2", "bob", ["bob", "carol"])
+    ids["in_g1"] = db.save_group_message("bob", "g1", "hi g1", ["bob", "alice"])
+    ids["in_g2"] = db.save_group_message("bob", "g2", "hi g2", ["bob", "carol"])
+    return client, db, ids
+
+
+def _status(db, ids):
+    return {name: db.get_message(i)["status"] for name, i in ids.items()}
+
+
+def test_read_marks_only_the_users_own_messages(conversation):
+    client, db, ids = conversation
+
+    assert client.post("/api/sync", json={"read": list(ids.values()) + ["x", None]}).status_code == 200
+
+    assert _status(db, ids) == {"to_alice": "read", "to_carol": "sent", "from_alice": "sent",
+                                "in_g1": "read", "in_g2": "sent"}
+
+
+def test_update_status_checks_ownership(conversation):
+    client, db, ids = conversation
+
+    assert client.post("/api/update_status", json={"message_id": ids["to_carol"], "status": "read"}).status_code == 404
+    assert client.post("/api/update_status", json={"message_id": ids["to_alice"], "status": "read"}).status_code == 200
+    assert client.post("/api/update_status", json={"message_id": "1", "status": "read"}).status_code == 400
+    assert _status(db, ids)["to_alice"] == "read" and _status(db, ids)["to_carol"] == "sent"
+
+
+def test_chat_in_foreign_group_is_refused(conversation):
+    client, _, _ = conversation
+
+    assert client.post("/api/sync", json={"chat": {"group": "g2"}}).get_json() == {"chat": {"error": "Unknown group"}}
+    messages = client.post("/api/sync", json={"chat": {"group": "g1", "limit": 0}}).get_json()["chat"]["messages"]
+    assert [m["message"] for m in messages] == ["hi g1"]
+
+
+@pytest.mark.parametrize("body", [[1, 2], "sync", {"typing_state": "start"}, {"typing_state": [1]},
+                                  {"chat": "bob"}, {"chat": ["bob"]}])
+def test_malformed_sync_is_a_400(app_client, body):
+    client, _ = app_client
+
+    assert client.post("/api/sync", json=body).status_code == 400
+
+
+def test_bad_chat_cursor_is_ignored(conversation):
+    client, _, _ = conversation
+
+    reply = client.post("/api/sync", json={"chat": {"with": "bob", "limit": "x", "after": 5}})
+    assert reply.status_code == 200
+    assert len(reply.get_json()["chat"]["messages"]) == 2
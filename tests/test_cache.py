@@ -0,0 +1,87 @@
+from cache import MessageCache, conversation
+from database import DatabaseManager
+
+
+def _window(n, start=0):
+    return [{"id": i, "message": f"m{i}", "status": "sent"} for i in range(start, start + n)]
+
+
+def test_conversation_key_is_symmetric():
+    assert conversation("bob", "alice") == conversation("alice", "bob") == ("alice", "bob")
+
+
+def test_get_returns_a_copy():
+    cache = MessageCache()
+    cache.put(("ab", 50), _window(2), cache.token())
+
+    cache.get(("ab", 50))[0]["status"] = "read"
+
+    assert cache.get(("ab", 50))[0]["status"] == "sent"
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = MessageCache(max_entries=2)
+    for conv in ("a", "b"):
+        cache.put((conv, 50), _window(1), cache.token())
+    cache.get(("a", 50))
+    cache.put(("c", 50), _window(1), cache.token())
+
+    assert cache.get(("b", 50)) is None
+    assert cache.get(("a", 50)) and cache.get(("c", 50))
+
+
+def test_byte_bound():
+    one = MessageCache()
+    one.put(("a", 50), _window(10), one.token())
+    cache = MessageCache(max_bytes=one.size * 2 + 1)
+    for conv in "abc":
+        cache.put((conv, 50), _window(10), cache.token())
+
+    assert cache.stats()["entries"] == 2 and cache.size <= cache.max_bytes
+    cache.put(("huge", 50), _window(1000), cache.token())
+    assert cache.get(("huge", 50)) is None
+
+
+def test_write_between_read_and_put_is_not_cached():
+    cache = MessageCache()
+    token = cache.token()
+    cache.invalidate(("alice", "bob"))  # a write lands while the rows are read
+
+    cache.put((("alice", "bob"), 50), _window(1), token)
+
+    assert cache.get((("alice", "bob"), 50)) is None
+
+
+def test_invalidate_and_set_status():
+    cache = MessageCache()
+    ab, ac = ("alice", "bob"), ("alice", "carol")
+    cache.put((ab, 50), _window(2), cache.token())
+    cache.put((ab, 10), _window(2), cache.token())
+    cache.put((ac, 50), _window(2, start=5), cache.token())
+
+    cache.set_status(6, "read")
+    cache.invalidate(ab)
+
+    assert cache.get((ab, 50)) is None and cache.get((ab, 10)) is None
+    assert [m["status"] for m in cache.get((ac, 50))] == ["sent", "read"]
+
+
+def test_disabled_cache_stores_nothing():
+    cache = MessageCache(max_entries=0)
+    cache.put(("a", 50), _window(1), cache.token())
+
+    assert cache.get(("a", 50)) is None
+
+
+def test_database_reads_through_the_cache():
+    db = DatabaseManager(":memory:")
+    first = db.save_message("alice", "bob", "hi")
+    assert [m["message"] for m in db.get_messages("alice", "bob")] == ["hi"]
+
+    db.update_message_status(first, "read")
+    assert db.get_messages("bob", "alice")[0]["status"] == "read"
+    assert db.message_cache.hits == 1
+
+    db.save_message("bob", "alice", "hello")
+    assert [m["message"] for m in db.get_messages("alice", "bob")] == ["hi", "hello"]
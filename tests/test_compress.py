@@ -0,0 +1,106 @@
+import time
+import zlib
+
+import pytest
+
+import compress
+import e2e_encryption
+from database import DatabaseManager
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+TEXT = b"hey, are we still meeting at the office later today? let me know when you are free"
+
+
+def test_negotiate_prefers_our_order():
+    assert compress.negotiate(["zlib"]) == "zlib"
+    assert compress.negotiate(list(reversed(compress.CODECS))) == compress.CODECS[0]
+    assert compress.negotiate([]) is None and compress.negotiate(None) is None
+
+
+@pytest.mark.parametrize("codec", compress.CODECS)
+def test_round_trip_with_seed_dictionary(codec):
+    payload, label = compress.pack(TEXT, codec)
+
+    assert label == f"{codec}:{compress.SEED_ID}" and len(payload) < len(TEXT)
+    assert compress.unpack(payload, label, {}) == TEXT
+
+
+@pytest.mark.parametrize("codec", compress.CODECS)
+def test_round_trip_with_peer_dictionary(codec):
+    history = compress.History()
+    history.add(TEXT * 2)
+    dict_id, content = history.take()
+
+    payload, label = compress.pack(TEXT, codec, content, dict_id)
+
+    assert compress.unpack(payload, label, {dict_id: content}) == TEXT
+    with pytest.raises(compress.UnknownDictionary):
+        compress.unpack(payload, label, {})
+
+
+def test_short_and_incompressible_data_is_sent_as_is():
+    noise = bytes(range(256)) * 2
+
+    assert compress.pack(b"ok", "zlib") == (b"ok", None)
+    assert compress.pack(zlib.compress(noise, 9) + noise[:10], "zlib")[1] is None
+    assert compress.unpack(b"ok", None, {}) == b"ok"
+
+
+def test_large_messages_skip_the_dictionary():
+    data = TEXT * 100
+
+    assert compress.pack(data, "zlib")[1] == "zlib"
+
+
+def test_decompression_is_bounded(monkeypatch):
+    monkeypatch.setattr(compress, "MAX_OUTPUT", 1000)
+    payload, label = compress.pack(b"a" * 5000, "zlib")
+
+    with pytest.raises(ValueError):
+        compress.unpack(payload, label, {})
+
+
+def test_history_is_ready_once_half_new():
+    history = compress.History(size=1000)
+    history.add(b"x" * 400)
+    assert not history.ready()
+    history.add(b"y" * 100)
+    assert history.ready()
+    dict_id, content = history.take()
+    assert len(content) == 1000 and not history.ready()
+    assert dict_id == compress.dictionary_id(content)
+
+
+@pytest.mark.skipif("x25519" not in e2e_encryption.KEY_AGREEMENTS, reason="needs the cryptography package")
+def test_peers_trade_dictionaries_and_recover_from_a_lost_one(tmp_path):
+    net = SimulatedNetwork()
+    nodes = []
+    for ip, name in (("10.0.0.1", "alice"), ("10.0.0.2", "bob")):
+        node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(ip), keys_dir=str(tmp_path))
+        node.BROADCAST_INTERVAL = 0.1
+        node.set_username(name)
+        node.received = []
+        node.message_callbacks.append(node.received.append)
+        node.start()
+        nodes.append(node)
+    alice, bob = nodes
+    try:
+        deadline = time.monotonic() + 10
+        while bob.user_id not in alice.online_users:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        # Enough short messages for half a fresh dictionary
+        for i in range(compress.DICTIONARY_SIZE // 2 // 3000 + 1):
+            alice.send_message(bob.user_id, f"#{i} " + (TEXT.decode() + " ") * 36)
+        dict_id, _ = alice.dictionaries_out[bob.user_id]
+        assert dict_id in bob.dictionaries_in[alice.user_id]
+
+        bob.dictionaries_in.clear()  # as after a restart
+        alice.send_message(bob.user_id, "after the restart " + TEXT.decode())
+
+        assert [e["message"] for e in bob.received if e["type"] == "message"][-1].startswith("after the restart")
+    finally:
+        for node in nodes:
+            node.stop(wait=True)
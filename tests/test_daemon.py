@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+import time
+
+import pytest
+
+from network_daemon import NetworkClient, NetworkDaemon, RemoteError
+
+
+class FakeNetwork:
+    """The slice of NetworkManager the daemon drives."""
+
+    def __init__(self):
+        self.message_callbacks = []
+        self.running = False
+        self.username = None
+        self.user_id = "u-1"
+        self.sent = []
+
+    def set_username(self, username):
+        self.username = username
+
+    def start(self):
+        self.running = True
+
+    def get_online_users(self):
+        return [{"user_id": "u-2", "username": "bob"}]
+
+    def send_message(self, recipient_id, plaintext, message_id=None):
+        if recipient_id != "u-2":
+            raise ConnectionError(f"{recipient_id} is offline")
+        self.sent.append((recipient_id, plaintext, message_id))
+        return True
+
+    def send_file(self, recipient_id, path, transfer_id=None, on_progress=None):
+        size = os.path.getsize(path)
+        for done in (size // 2, size):
+            on_progress(done, size)
+        return transfer_id or "ab" * 16
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = NetworkDaemon(FakeNetwork(), tmp_path / "n.sock")
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(daemon.socket_path):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    yield daemon
+    daemon.stop()
+    thread.join(5)
+
+
+def test_calls_are_forwarded_to_the_network(daemon):
+    client = NetworkClient(daemon.socket_path, timeout=5)
+    assert not client.running
+
+    client.set_username("alice")
+    client.call("start", username="alice")
+    assert client.running
+    assert client.user_id == "u-1"
+    assert client.get_online_users() == [{"user_id": "u-2", "username": "bob"}]
+    assert client.send_message("u-2", "hi", "m-1") is True
+    assert daemon.network.sent == [("u-2", "hi", "m-1")]
+
+    with pytest.raises(RemoteError) as e:
+        client.call("start", username="mallory")
+    assert e.value.kind == "RuntimeError"
+
+
+def test_errors_come_back_with_their_kind(daemon):
+    client = NetworkClient(daemon.socket_path, timeout=5)
+    with pytest.raises(RemoteError) as e:
+        client.send_message("u-9", "hi")
+    assert (str(e.value), e.value.kind) == ("u-9 is offline", "ConnectionError")
+
+    # Only the listed methods and parameters reach the network
+    with pytest.raises(RemoteError, match="unknown method"):
+        client.call("stop")
+    with pytest.raises(RemoteError, match="unexpected parameters"):
+        client.call("get_online_users", path="/etc/passwd")
+    assert client.get_online_users()  # the connection is still in step
+
+
+def test_send_file_streams_progress(daemon, tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(bytes(1000))
+    progress = []
+
+    client = NetworkClient(daemon.socket_path, timeout=5)
+    assert client.send_file("u-2", path, "cd" * 16, lambda done, size: progress.append((done, size))) == "cd" * 16
+    assert progress == [(500, 1000), (1000, 1000)]
+
+
+def test_events_reach_subscribers_and_stuck_ones_are_dropped(daemon):
+    client = NetworkClient(daemon.socket_path, timeout=5)
+    events = queue.Queue()
+    client.message_callbacks.append(events.put)
+    client.subscribe()
+
+    deadline = time.monotonic() + 5
+    while not daemon._subscribers:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    for cb in daemon.network.message_callbacks:
+        cb({"type": "message", "message": "hi"})
+    assert events.get(timeout=5) == {"type": "message", "message": "hi"}
+    client.stop()
+
+    stuck = queue.Queue(maxsize=1)
+    daemon._subscribers.append(stuck)
+    daemon._publish({"type": "typing"})
+    daemon._publish({"type": "typing"})
+    assert stuck not in daemon._subscribers
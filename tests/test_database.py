@@ -0,0 +1,67 @@
+import sqlite3
+
+from database import DatabaseManager, new_message_id
+
+
+def _v3_database(path):
+    """A chat.db as schema version 3 left it: no uids, no peers table."""
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE users (username TEXT PRIMARY KEY, security_mode INTEGER DEFAULT 1,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT NOT NULL,
+                               recipient TEXT NOT NULL, message TEXT NOT NULL,
+                               is_encrypted INTEGER DEFAULT 0,
+                               timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                               status TEXT DEFAULT "sent", group_id TEXT, origin_id INTEGER);
+        CREATE TABLE groups (id TEXT PRIMARY KEY, name TEXT NOT NULL, created_by TEXT NOT NULL,
+                             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE group_members (group_id TEXT NOT NULL, username TEXT NOT NULL,
+                                    PRIMARY KEY (group_id, username));
+        CREATE TABLE message_receipts (message_id INTEGER NOT NULL, username TEXT NOT NULL,
+                                       status TEXT NOT NULL DEFAULT 'sent',
+                                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                       PRIMARY KEY (message_id, username));
+        INSERT INTO messages (sender, recipient, message, timestamp)
+            VALUES ('alice', 'bob', 'first', '2024-01-01 10:00:00'),
+                   ('bob', 'alice', 'second', '2024-01-01 10:00:05');
+        PRAGMA user_version = 3;
+    ''')
+    connection.commit()
+    connection.close()
+
+
+def test_migrates_v3_database(tmp_path):
+    path = tmp_path / "chat.db"
+    _v3_database(path)
+
+    db = DatabaseManager(path)
+
+    assert db.connection.execute("PRAGMA user_version").fetchone()[0] == DatabaseManager.SCHEMA_VERSION
+    messages = db.get_messages("alice", "bob")
+    assert [m["message"] for m in messages] == ["first", "second"]
+    # Backfilled uids keep the time order but are never shared with peers
+    assert messages[0]["uid"] < messages[1]["uid"]
+    assert all(m["uid"][14] == "0" for m in messages)
+    db.save_peer("bob", "b0b0b0b0", "10.0.0.2", 6668)
+    assert [p["username"] for p in db.get_known_peers()] == ["bob"]
+
+
+def test_migration_runs_once(tmp_path):
+    path = tmp_path / "chat.db"
+    _v3_database(path)
+    uids = [m["uid"] for m in DatabaseManager(path).get_messages("alice", "bob")]
+
+    assert [m["uid"] for m in DatabaseManager(path).get_messages("alice", "bob")] == uids
+
+
+def test_same_uid_saved_twice_is_stored_once():
+    db = DatabaseManager(":memory:")
+    uid = new_message_id()
+
+    first = db.save_message("alice", "bob", "hi", uid=uid)
+    again = db.save_message("alice", "bob", "hi", uid=uid)
+
+    assert again == first
+    assert [m["id"] for m in db.get_messages("alice", "bob")] == [first]
+    assert db.get_message_by_uid(uid)["id"] == first
@@ -0,0 +1,50 @@
+import json
+import time
+
+import pytest
+
+from database import DatabaseManager
+from network import NetworkManager, check_presence
+from transport import SimulatedNetwork
+
+PRESENCE = {"user_id": "b0b0b0b0", "username": "bob", "tcp_port": 6668, "proto": 2,
+            "codecs": ["zlib"], "public_key": ""}
+
+
+def test_valid_presence():
+    check_presence(PRESENCE)
+    check_presence({"user_id": "0ld0ld00", "username": "old"})  # protocol 1 beacon
+
+
+@pytest.mark.parametrize("change", [
+    {"user_id": None}, {"username": 7}, {"username": ""}, {"username": ["bob"]},
+    {"tcp_port": "6668"}, {"tcp_port": 70000}, {"tcp_port": True}, {"proto": "2"},
+    {"codecs": "zlib"}, {"codecs": [1]}, {"public_key": 1}, {"keys": ["x"]},
+    {"keys": {"ed25519": 1}},
+])
+def test_malformed_presence(change):
+    with pytest.raises(ValueError):
+        check_presence({**PRESENCE, **change})
+
+
+def test_listener_survives_bad_beacons(tmp_path):
+    net = SimulatedNetwork()
+    node = NetworkManager(DatabaseManager(":memory:"), transport=net.host("10.0.0.1"),
+                          keys_dir=str(tmp_path))
+    node.set_username("alice")
+    node.start()
+    sender = net.host("10.0.0.2").open_datagram()
+    try:
+        for junk in (b"\xff not json", b"[1, 2]", b'{"type": "discovery"}',
+                     json.dumps({"type": "discovery", **PRESENCE, "username": 5}).encode(),
+                     json.dumps({"type": "discovery", **PRESENCE, "keys": {"ed25519": "x"}}).encode()):
+            sender.sendto(junk, ("10.0.0.1", node.discovery_port))
+        sender.sendto(json.dumps({"type": "discovery", **PRESENCE}).encode(), ("10.0.0.1", node.discovery_port))
+
+        deadline = time.monotonic() + 5
+        while "b0b0b0b0" not in node.online_users:
+            assert time.monotonic() < deadline, "listener stopped"
+            time.sleep(0.05)
+    finally:
+        sender.close()
+        node.stop(wait=True)
@@ -0,0 +1,117 @@
+import os
+import time
+
+import pytest
+
+import file_transfer
+from database import DatabaseManager
+from e2e_encryption import encrypt_chunk
+from file_transfer import CHUNK_SIZE, IncomingTransfer, chunk_aad
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+TRANSFER_ID = bytes(range(16))
+KEY = bytes(32)
+
+
+def _incoming(tmp_path, size, chunk_size=1024):
+    manifest = {"name": "report.pdf", "size": size, "chunk_size": chunk_size}
+    return IncomingTransfer(tmp_path, TRANSFER_ID, manifest, KEY)
+
+
+def _chunk(index, data):
+    return encrypt_chunk(KEY, data, chunk_aad(TRANSFER_ID, index))
+
+
+def test_resumes_after_the_last_whole_chunk(tmp_path):
+    data = os.urandom(2500)
+    t = _incoming(tmp_path, len(data))
+    t.write(0, _chunk(0, data[:1024]))
+    t.write(1, _chunk(1, data[1024:2048]))
+    t.close()
+    with open(t.partial_path, "ab") as f:
+        f.write(b"torn")  # half a chunk from a write cut short
+
+    t = _incoming(tmp_path, len(data))
+    assert t.next_chunk == 2
+    assert t.bytes_done == 2048
+    t.write(2, _chunk(2, data[2048:]))
+    path = t.finish(3)
+
+    assert path == tmp_path / "report.pdf"
+    assert path.read_bytes() == data
+    assert not t.partial_path.exists()
+
+
+def test_chunks_must_arrive_in_order_under_their_own_index(tmp_path):
+    t = _incoming(tmp_path, 2048)
+    with pytest.raises(ValueError):
+        t.write(1, _chunk(1, bytes(1024)))
+    with pytest.raises(ValueError):
+        t.write(0, _chunk(1, bytes(1024)))  # replayed from another position
+    with pytest.raises(ValueError):
+        t.finish(2)
+    t.close()
+
+
+def test_interrupted_send_resumes_where_the_peer_stopped(tmp_path):
+    net = SimulatedNetwork()
+    nodes = []
+    for ip, name in (("10.0.0.1", "alice"), ("10.0.0.2", "bob")):
+        node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(ip),
+                              keys_dir=str(tmp_path), downloads_dir=str(tmp_path / name))
+        node.BROADCAST_INTERVAL = 0.1
+        node.set_username(name)
+        node.received = []
+        node.message_callbacks.append(node.received.append)
+        node.start()
+        nodes.append(node)
+    alice, bob = nodes
+    try:
+        deadline = time.monotonic() + 10
+        while bob.user_id not in alice.online_users:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        data = os.urandom(file_transfer.WINDOW * 2 * CHUNK_SIZE + 100)
+        path = tmp_path / "video.bin"
+        path.write_bytes(data)
+
+        def cut(done, size):
+            raise ConnectionError("link lost")
+
+        transfer_id = os.urandom(16).hex()
+        with pytest.raises(ConnectionError):
+            alice.send_file(bob.user_id, str(path), transfer_id, on_progress=cut)
+
+        deadline = time.monotonic() + 5
+        while not any(e["type"] == "file_failed" for e in bob.received):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        stored = next(e for e in bob.received if e["type"] == "file_failed")["bytes"]
+        assert 0 < stored < len(data)
+        bob.received.clear()
+
+        assert alice.send_file(bob.user_id, str(path), transfer_id) == transfer_id
+
+        accepted = next(e for e in bob.received if e["type"] == "file_progress")
+        assert accepted["bytes"] == stored  # picked up at the first missing chunk
+        assert (tmp_path / "bob" / "video.bin").read_bytes() == data
+        assert not any((tmp_path / "bob" / ".partial").iterdir())
+    finally:
+        for node in nodes:
+            node.stop()
+
+
+def test_resume_only_restarts_a_failed_transfer_once(app_client, monkeypatch):
+    import app
+
+    client, _ = app_client
+    monkeypatch.setattr(app, "transfers", {"t1": {"id": "t1", "direction": "sent", "state": "failed"}})
+    monkeypatch.setattr(app, "_sending", {"t1"})
+
+    assert client.post("/api/transfers/t1/resume").status_code == 409  # a sender is still on it
+    assert client.post("/api/transfers/t2/resume").status_code == 404
+    app.transfers["t1"]["state"] = "complete"
+    app._sending.clear()
+    assert client.post("/api/transfers/t1/resume").status_code == 409
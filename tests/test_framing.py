@@ -0,0 +1,64 @@
+import json
+import socket
+import time
+
+import pytest
+
+from framing import HEADER, FrameError, MAX_FRAME, read_packet
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def test_reads_legacy_packet(pair):
+    a, b = pair
+    packet = json.dumps({"type": "hello", "user_id": "abc"}).encode()
+    a.sendall(packet)
+
+    assert read_packet(b) == (packet, False)
+
+
+def test_reads_framed_packets(pair):
+    a, b = pair
+    packets = [json.dumps({"type": "ack", "n": n}).encode() for n in range(3)]
+    a.sendall(b"".join(HEADER.pack(len(p)) + p for p in packets))
+
+    assert [read_packet(b) for _ in packets] == [(p, True) for p in packets]
+
+
+def test_reads_frame_split_across_sends(pair):
+    a, b = pair
+    payload = b"x" * 100000
+    data = HEADER.pack(len(payload)) + payload
+    for i in range(0, len(data), 4096):
+        a.sendall(data[i:i + 4096])
+
+    assert read_packet(b) == (payload, True)
+
+
+def test_closed_connection(pair):
+    a, b = pair
+    a.close()
+
+    assert read_packet(b) == (None, None)
+
+
+def test_rejects_oversized_frame(pair):
+    a, b = pair
+    a.sendall(HEADER.pack(MAX_FRAME + 1))
+
+    with pytest.raises(FrameError):
+        read_packet(b)
+
+
+def test_incomplete_frame_times_out_at_deadline(pair):
+    a, b = pair
+    a.sendall(HEADER.pack(10) + b"abc")
+
+    with pytest.raises(socket.timeout):
+        read_packet(b, deadline=time.monotonic() + 0.2)
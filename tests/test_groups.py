@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+import e2e_encryption
+from database import DatabaseManager, new_message_id
+from framing import recv_json, send_json
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+MEMBERS = ["alice", "bob", "carol"]
+
+
+def _wait(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def lan(tmp_path):
+    if "x25519" not in e2e_encryption.KEY_AGREEMENTS:
+        pytest.skip("needs the cryptography package")
+    net = SimulatedNetwork()
+    nodes = {}
+    for i, name in enumerate(MEMBERS + ["dave"]):
+        node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(f"10.0.0.{i + 1}"),
+                              keys_dir=str(tmp_path))
+        node.BROADCAST_INTERVAL = 0.1
+        node.set_username(name)
+        node._sync_in_background = lambda user_id: None
+        node.start()
+        nodes[name] = node
+    _wait(lambda: all(len(n.online_users) == len(nodes) - 1 for n in nodes.values()))
+    yield net, nodes
+    for node in nodes.values():
+        node.stop()  # each test has its own simulated network, so nothing to wait for
+
+
+def _post(nodes, author, members, text, group_id="g1"):
+    uid = new_message_id()
+    nodes[author].database.save_group_message(author, group_id, text, members, uid=uid)
+    return uid, nodes[author].send_group_message(group_id, "G", members, uid, text)
+
+
+def _receipts(node, uid):
+    return next(m for m in node.database.get_group_messages("g1") if m["uid"] == uid)["receipts"]
+
+
+def test_group_message_reaches_members_and_receipts_come_back(lan):
+    _, nodes = lan
+    nodes["alice"].database.create_group("g1", "G", "alice", MEMBERS)
+
+    uid, delivery = _post(nodes, "alice", MEMBERS, "hello")
+
+    assert delivery == {"bob": None, "carol": None}
+    assert nodes["bob"].database.get_group("g1")["members"] == MEMBERS
+    _wait(lambda: _receipts(nodes["alice"], uid) == {"bob": "delivered", "carol": "delivered"})
+
+    nodes["carol"].send_status_update(nodes["alice"].user_id, uid, "read", group_id="g1")
+    assert _receipts(nodes["alice"], uid) == {"bob": "delivered", "carol": "read"}
+
+
+def test_receipt_without_mac_is_refused(lan):
+    net, nodes = lan
+    alice = nodes["alice"]
+    alice.database.create_group("g1", "G", "alice", MEMBERS)
+    uid, _ = _post(nodes, "alice", MEMBERS, "hello")
+
+    with net.host("10.0.0.66").open_connection(("10.0.0.1", alice.tcp_port), timeout=5) as sock:
+        send_json(sock, {"type": "status_update", "message_id": uid, "status": "read",
+                         "group_id": "g1", "username": "bob"})
+        assert recv_json(sock)["type"] == "error"
+    assert _receipts(alice, uid)["bob"] != "read"
+
+
+def test_only_the_creator_adds_members(lan):
+    _, nodes = lan
+    nodes["alice"].database.create_group("g1", "G", "alice", MEMBERS)
+    _post(nodes, "alice", MEMBERS, "hello")
+
+    nodes["carol"].database.create_group("g1", "G", "alice", MEMBERS + ["dave"])
+    _post(nodes, "carol", MEMBERS + ["dave"], "adding dave")
+
+    assert nodes["bob"].database.get_group("g1")["members"] == MEMBERS
+
+
+def test_non_member_cannot_post(lan):
+    _, nodes = lan
+    nodes["alice"].database.create_group("g1", "G", "alice", MEMBERS)
+    _post(nodes, "alice", MEMBERS, "hello")
+
+    _, delivery = _post(nodes, "dave", MEMBERS + ["dave"], "spam")
+
+    assert all("not a member" in error for error in delivery.values())
+    assert [m["message"] for m in nodes["bob"].database.get_group_messages("g1")] == ["hello"]
+
+
+def test_group_history_is_members_only(app_client):
+    client, db = app_client
+    db.create_group("g1", "G", "bob", ["alice", "bob"])
+    db.create_group("g2", "H", "bob", ["bob", "carol"])
+
+    assert client.get("/api/messages?group=g1").status_code == 200
+    assert client.get("/api/messages?group=g2").status_code == 404
@@ -0,0 +1,66 @@
+import logging
+
+import pytest
+
+from logs import AccessLog
+
+POLL = ("POST", "/api/sync")
+
+
+@pytest.fixture
+def lines():
+    logger = logging.getLogger("test.access")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger.addHandler(handler)
+    yield logger, records
+    logger.removeHandler(handler)
+
+
+def _polls(access, n, status=200):
+    for _ in range(n):
+        access.record("POST", "/api/sync", "/api/sync", status, 0.01)
+
+
+def test_sample_one_logs_every_poll(lines):
+    logger, records = lines
+    _polls(AccessLog([POLL], sample=1, logger=logger), 5)
+
+    assert len(records) == 5
+
+
+def test_sample_n_logs_first_of_every_n(lines):
+    logger, records = lines
+    _polls(AccessLog([POLL], sample=3, logger=logger), 7)
+
+    assert len(records) == 3  # the 1st, 4th and 7th
+    assert all("(sampled 1/3)" in r.getMessage() for r in records)
+
+
+def test_sample_zero_logs_no_polls(lines):
+    logger, records = lines
+    _polls(AccessLog([POLL], sample=0, logger=logger), 5)
+
+    assert records == []
+
+
+def test_other_routes_and_errors_are_always_logged(lines):
+    logger, records = lines
+    access = AccessLog([POLL], sample=1000, logger=logger)
+    access.record("GET", "/chat", "/chat", 200, 0.01)
+    _polls(access, 3, status=500)
+
+    assert [r.levelno for r in records] == [logging.INFO] + [logging.ERROR] * 3
+
+
+def test_polls_are_summarised(lines):
+    logger, records = lines
+    access = AccessLog([POLL], sample=0, logger=logger)
+    _polls(access, 4)
+    access._since -= access.SUMMARY_INTERVAL
+    _polls(access, 1)
+
+    assert [r.count for r in records] == [5]
@@ -0,0 +1,68 @@
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_renders_one_series_per_label_set():
+    sent = Counter("test_sent_total", "Packets sent", ["type"])
+    sent.labels("message").inc()
+    sent.labels("message").inc(2)
+    sent.labels('say "hi"\n').inc()
+
+    assert sent.render() == [
+        "# HELP test_sent_total Packets sent",
+        "# TYPE test_sent_total counter",
+        'test_sent_total{type="message"} 3',
+        'test_sent_total{type="say \\"hi\\"\\n"} 1',
+    ]
+
+
+def test_gauge_reads_functions_at_scrape_time():
+    depth = Gauge("test_depth", "Queue depth")
+    depth.inc(3)
+    depth.dec()
+    assert depth.render()[-1] == "test_depth 2"
+
+    items = [1, 2, 3, 4]
+    depth.set_function(lambda: len(items))
+    items.append(5)
+    assert depth.render()[-1] == "test_depth 5"
+
+    depth.set_function(lambda: 1 / 0)  # a broken callback must not break the scrape
+    assert depth.render()[-1] == "test_depth 0"
+
+
+def test_histogram_buckets_are_cumulative():
+    latency = Histogram("test_seconds", "Latency", ["route"], buckets=(1.0, 0.1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.labels("/api/users").observe(value)
+
+    assert latency.render()[2:] == [
+        'test_seconds_bucket{route="/api/users",le="0.1"} 2',
+        'test_seconds_bucket{route="/api/users",le="1"} 3',
+        'test_seconds_bucket{route="/api/users",le="+Inf"} 4',
+        'test_seconds_sum{route="/api/users"} 3.65',
+        'test_seconds_count{route="/api/users"} 4',
+    ]
+
+
+def test_registry_returns_the_metric_already_declared():
+    registry = Registry()
+    first = registry.register(Counter("test_total", "First"))
+    assert registry.register(Counter("test_total", "Again")) is first
+    first.inc()
+    assert registry.render() == "# HELP test_total First\n# TYPE test_total counter\ntest_total 1\n"
+
+
+def test_metrics_endpoint_needs_a_login_unless_public(app_client, monkeypatch):
+    import app
+
+    client, _ = app_client
+    client.get("/api/users")
+    response = client.get("/api/metrics")
+    assert response.content_type == metrics.CONTENT_TYPE
+    assert 'securelocal_http_requests_total{route="/api/users",method="GET",status="200"' in response.get_data(as_text=True)
+
+    anonymous = app.app.test_client()
+    assert anonymous.get("/api/metrics").status_code == 401
+    monkeypatch.setattr(app, "metrics_public", True)
+    assert anonymous.get("/api/metrics").status_code == 200
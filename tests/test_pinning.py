@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+import e2e_encryption
+from database import DatabaseManager
+from network import NetworkManager
+
+pytestmark = pytest.mark.skipif("x25519" not in e2e_encryption.KEY_AGREEMENTS,
+                                reason="needs the cryptography package")
+
+
+def _node(keys_dir, name, database=None):
+    node = NetworkManager(database or DatabaseManager(":memory:"), keys_dir=str(keys_dir))
+    node.set_username(name)
+    node.syncs = []
+    node._sync_in_background = node.syncs.append
+    return node
+
+
+@pytest.fixture
+def alice(tmp_path):
+    return _node(tmp_path / "alice", "alice")
+
+
+def test_first_key_is_pinned(alice, tmp_path):
+    bob = _node(tmp_path / "bob", "bob")
+
+    assert alice._record_peer(bob._presence(), "10.0.0.2")
+
+    pinned = alice.database.get_known_peers()[0]
+    assert pinned["username"] == "bob" and pinned["fingerprint"].startswith("ed25519:")
+
+
+def test_identity_survives_restart(tmp_path):
+    first, second = _node(tmp_path, "bob"), _node(tmp_path, "bob")
+
+    assert first.user_id != second.user_id
+    assert first.ec_public == second.ec_public
+
+
+def test_new_identity_key_is_refused_and_reported(alice, tmp_path):
+    alice._record_peer(_node(tmp_path / "bob", "bob")._presence(), "10.0.0.2")
+    impostor = _node(tmp_path / "impostor", "bob")
+    events = []
+    alice.message_callbacks.append(events.append)
+
+    assert not alice._record_peer(impostor._presence(), "10.0.0.66")
+
+    assert impostor.user_id not in alice.online_users
+    assert [c["ip"] for c in alice.get_key_conflicts()] == ["10.0.0.66"]
+    assert events == [{"type": "key_changed", "username": "bob", "ip": "10.0.0.66"}]
+
+
+def test_new_x25519_key_under_same_identity_is_flagged(alice, tmp_path):
+    bob = _node(tmp_path / "bob", "bob")
+    alice._record_peer(bob._presence(), "10.0.0.2")
+
+    # Same Ed25519 identity, validly signed, but a different agreement key
+    other = _node(tmp_path / "other", "other")
+    bob.ec_private = (other.ec_private[0], bob.ec_private[1])
+    bob.ec_public = {**bob.ec_public, "x25519": other.ec_public["x25519"]}
+
+    assert not alice._record_peer(bob._presence(), "10.0.0.2")
+    assert [c["username"] for c in alice.get_key_conflicts()] == ["bob"]
+
+
+def test_trusted_key_replaces_pin(alice, tmp_path):
+    alice._record_peer(_node(tmp_path / "bob", "bob")._presence(), "10.0.0.2")
+    reinstalled = _node(tmp_path / "reinstalled", "bob")
+    alice._record_peer(reinstalled._presence(), "10.0.0.3")
+
+    assert alice.trust_new_key("bob")
+    assert not alice.trust_new_key("bob")
+    assert alice._record_peer(reinstalled._presence(), "10.0.0.3")
+    assert alice.get_key_conflicts() == []
+
+
+def test_pins_are_loaded_before_any_beacon(tmp_path):
+    database = DatabaseManager(":memory:")
+    _node(tmp_path / "alice", "alice", database)._record_peer(
+        _node(tmp_path / "bob", "bob")._presence(), "10.0.0.2")
+
+    restarted = _node(tmp_path / "alice", "alice", database)
+    restarted._load_known_peers()
+
+    assert not restarted._record_peer(_node(tmp_path / "impostor", "bob")._presence(), "10.0.0.66")
+
+
+def test_sync_only_starts_with_verified_peers(alice, tmp_path):
+    bob = _node(tmp_path / "bob", "bob")
+    alice._record_peer(bob._presence(), "10.0.0.2")
+    assert alice.syncs == [bob.user_id]
+
+    unsigned = {**bob._presence(), "user_id": "0ld0ld00", "username": "carl"}
+    del unsigned["keys"], unsigned["signature"]
+    alice._record_peer(unsigned, "10.0.0.4")
+    assert alice.syncs == [bob.user_id]
+
+
+def test_probe_round_is_bounded_and_skips_live_peers(alice, tmp_path):
+    now = time.time()
+    for i in range(200):
+        alice._known_peers[f"peer{i}"] = {"username": f"peer{i}", "ip": f"10.0.{i // 250}.{i % 250}",
+                                          "tcp_port": 6668, "last_seen": now - i}
+    alice.online_users["live"] = {"username": "peer0", "last_seen": now}
+    probed = []
+
+    def probe(peer):
+        probed.append(peer["username"])
+        alice.running = False  # one round
+        return False
+
+    alice._probe = probe
+    alice.BROADCAST_INTERVAL = 0.1
+    alice.running = True
+    alice._probe_known_peers()
+
+    assert len(probed) == alice.PROBE_BATCH
+    assert "peer0" not in probed and "peer1" in probed
@@ -0,0 +1,96 @@
+import http.client
+import socket
+import threading
+
+import pytest
+
+from server import PooledWSGIServer
+
+
+def hello(environ, start_response):
+    body = environ["wsgi.input"].read(2) + b"hello"
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(app, **kwargs):
+        server = PooledWSGIServer("127.0.0.1", 0, app, **kwargs)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+        server.drain(timeout=1)
+
+
+def test_keep_alive_serves_several_requests_on_one_connection(serve):
+    server = serve(hello)
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+
+    # The app reads two bytes of the body; the rest must not spill into the next request
+    conn.request("POST", "/", body=b"..unread body")
+    first = conn.getresponse()
+    assert (first.status, first.read()) == (200, b"..hello")
+    sock = conn.sock
+
+    conn.request("GET", "/")
+    second = conn.getresponse()
+    assert (second.status, second.read()) == (200, b"hello")
+    assert conn.sock is sock
+    conn.close()
+
+
+def test_responses_without_a_length_close_the_connection(serve):
+    def stream(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        yield b"streamed"
+
+    server = serve(stream)
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    conn.request("GET", "/")
+    response = conn.getresponse()
+    assert response.getheader("Connection") == "close"
+    assert response.read() == b"streamed"
+    conn.close()
+
+
+def test_chunked_request_bodies_are_refused(serve):
+    server = serve(hello)
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n")
+        assert sock.recv(1024).startswith(b"HTTP/1.1 411")
+
+
+def test_full_queue_sheds_connections_with_503(serve):
+    entered, release = threading.Event(), threading.Event()
+
+    def slow(environ, start_response):
+        entered.set()
+        release.wait(5)
+        return hello(environ, start_response)
+
+    server = serve(slow, threads=1, queue_size=1)
+    busy = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    busy.request("GET", "/")
+    assert entered.wait(5)  # the only worker is taken
+
+    queued = socket.create_connection(("127.0.0.1", server.port))
+    shed = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        shed.settimeout(5)
+        assert shed.recv(1024).startswith(b"HTTP/1.1 503")
+        assert server.rejected == 1
+    finally:
+        release.set()
+        queued.close()
+        shed.close()
+
+    assert busy.getresponse().status == 200
+    busy.close()
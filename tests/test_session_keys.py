@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+import e2e_encryption
+from database import DatabaseManager
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+pytestmark = pytest.mark.skipif("x25519" not in e2e_encryption.KEY_AGREEMENTS,
+                                reason="needs the cryptography package")
+
+
+def _node(net, ip, name, keys_dir, monkeypatch, rsa_only=False):
+    node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(ip),
+                          keys_dir=str(keys_dir), downloads_dir=str(keys_dir))
+    node.BROADCAST_INTERVAL = 0.1
+    with monkeypatch.context() as m:
+        if rsa_only:
+            # A peer from before X25519: RSA keys and no "keys" in its beacon
+            m.setattr(e2e_encryption, "KEY_AGREEMENTS", ["rsa"])
+        node.set_username(name)
+    node.received = []
+    node.message_callbacks.append(node.received.append)
+    node.start()
+    return node
+
+
+def _wait(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def peers(tmp_path, monkeypatch):
+    net = SimulatedNetwork()
+    new = _node(net, "10.0.0.1", "alice", tmp_path, monkeypatch)
+    old = _node(net, "10.0.0.2", "carol", tmp_path, monkeypatch, rsa_only=True)
+    # alice makes RSA keys once carol's beacon shows she needs them
+    _wait(lambda: old.online_users.get(new.user_id, {}).get("public_key")
+          and new.online_users.get(old.user_id))
+    yield new, old
+    for node in (new, old):
+        node.stop(wait=True)
+
+
+def _delivered(node, text):
+    return [e["message"] for e in node.received if e["type"] == "message"] == [text]
+
+
+@pytest.mark.parametrize("direction", ["x25519_to_rsa", "rsa_to_x25519"])
+def test_session_key_between_x25519_and_rsa_peer(peers, direction):
+    new, old = peers
+    sender, recipient = (new, old) if direction == "x25519_to_rsa" else (old, new)
+
+    sender.send_message(recipient.user_id, "hello")
+
+    assert sender.sending_keys[recipient.user_id] == recipient.session_keys[sender.user_id]
+    assert recipient.key_owners[sender.user_id] == sender.username
+    _wait(lambda: _delivered(recipient, "hello"))
+
+
+def test_x25519_peer_refuses_rsa_key_from_x25519_peer(tmp_path, monkeypatch):
+    net = SimulatedNetwork()
+    a = _node(net, "10.0.0.1", "alice", tmp_path, monkeypatch)
+    b = _node(net, "10.0.0.2", "bob", tmp_path, monkeypatch)
+    try:
+        _wait(lambda: a.online_users.get(b.user_id) and b.online_users.get(a.user_id))
+        a._make_rsa_keys()
+        b.online_users[a.user_id]["keys"] = None  # as if b had never seen a's X25519 key
+        b.online_users[a.user_id]["public_key"] = a.public_key.decode()
+
+        with pytest.raises(ConnectionError):
+            b.send_message(a.user_id, "hello")
+        assert b.user_id not in a.session_keys
+    finally:
+        for node in (a, b):
+            node.stop(wait=True)
+
+
+def _identity(tmp_path, name):
+    node = NetworkManager(DatabaseManager(":memory:"), keys_dir=str(tmp_path))
+    node.set_username(name)
+    return node
+
+
+def test_presence_binds_x25519_key_to_identity(tmp_path):
+    carol, bob, mallory = (_identity(tmp_path, n) for n in ("carol", "bob", "mallory"))
+    spoofed = bob._presence()
+    spoofed["keys"] = {**spoofed["keys"], "x25519": mallory.ec_public["x25519"]}
+
+    with pytest.raises(ValueError):
+        carol._record_peer(spoofed, "10.0.0.66")
+    assert bob.user_id not in carol.online_users
+
+    assert carol._record_peer(bob._presence(), "10.0.0.2")
+    assert carol.online_users[bob.user_id]["keys"] == bob.ec_public
+
+
+def test_stale_presence_is_refused(tmp_path):
+    carol, bob = _identity(tmp_path, "carol"), _identity(tmp_path, "bob")
+    old = bob._presence()
+    carol._record_peer(bob._presence(), "10.0.0.2")
+
+    with pytest.raises(ValueError):
+        carol._record_peer(old, "10.0.0.66")
+    assert carol.online_users[bob.user_id]["ip"] == "10.0.0.2"
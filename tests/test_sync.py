@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+import e2e_encryption
+from database import DatabaseManager, new_message_id
+from network import NetworkManager
+from transport import SimulatedNetwork
+
+
+@pytest.fixture
+def db():
+    return DatabaseManager(":memory:")
+
+
+def test_sync_marks(db):
+    first = db.save_message("bob", "alice", "one")
+    db.save_message("bob", "alice", "two")
+    newest = db.get_message(db.save_message("bob", "alice", "three"))["uid"]
+    mine = [db.save_message("alice", "bob", text) for text in ("a", "b")]
+    db.update_message_status(mine[0], "read")
+
+    marks = db.get_sync_marks("alice", "bob")
+
+    assert marks == {"received": newest, "unread": db.get_message(mine[1])["uid"]}
+    assert db.get_message(first)["uid"] < newest
+
+
+def test_outgoing_since_mark_includes_unacknowledged(db):
+    ids = [db.save_message("alice", "bob", str(i)) for i in range(5)]
+    uids = [db.get_message(i)["uid"] for i in ids]
+    for i in ids[:3]:
+        db.update_message_status(i, "delivered")
+    db.update_message_status(ids[1], "sent")  # never acknowledged
+
+    outgoing, more = db.get_outgoing_since("alice", "bob", uids[2], limit=2)
+
+    assert [m["uid"] for m in outgoing] == [uids[1], uids[3]] and more
+
+
+def test_synced_messages_are_validated(db):
+    good, late, bad_time = new_message_id(), new_message_id(), new_message_id()
+    stored = db.save_synced_messages("bob", "alice", [
+        {"uid": good, "message": "hi", "timestamp": "2024-05-01 10:00:00"},
+        {"uid": late, "message": "tz", "timestamp": "2024-05-01T12:00:00+02:00"},
+        {"uid": bad_time, "message": "when?", "timestamp": "yesterday-ish"},
+        {"uid": new_message_id(), "message": {"not": "text"}, "timestamp": "2024-05-01 10:00:00"},
+        {"uid": "not-a-uid", "message": "x", "timestamp": "2024-05-01 10:00:00"},
+        "garbage",
+    ])
+
+    assert [m["uid"] for m in stored] == [good, late, bad_time]
+    assert db.get_message_by_uid(late)["timestamp"] == "2024-05-01 10:00:00"
+    assert len(db.get_messages("alice", "bob")) == 3  # every timestamp parses
+
+
+def test_synced_messages_skip_ones_we_hold(db):
+    uid = new_message_id()
+    db.save_message("bob", "alice", "hi", uid=uid)
+
+    assert db.save_synced_messages("bob", "alice", [{"uid": uid, "message": "hi", "timestamp": None}]) == []
+
+
+def test_status_changes_never_go_backwards(db):
+    msg = db.save_message("alice", "bob", "hi")
+    uid = db.get_message(msg)["uid"]
+    db.update_message_status(msg, "read")
+
+    assert db.apply_status_changes("alice", "bob", [[uid, "delivered"], [uid], "x", [{}, "read"]]) == 0
+    assert db.get_message(msg)["status"] == "read"
+
+
+@pytest.mark.skipif("x25519" not in e2e_encryption.KEY_AGREEMENTS, reason="needs the cryptography package")
+def test_reconnect_sync_exchanges_missed_messages(tmp_path):
+    net = SimulatedNetwork()
+    nodes = []
+    for ip, name in (("10.0.0.1", "alice"), ("10.0.0.2", "bob")):
+        node = NetworkManager(DatabaseManager(":memory:"), transport=net.host(ip), keys_dir=str(tmp_path))
+        node.BROADCAST_INTERVAL = 0.1
+        node.set_username(name)
+        node._sync_in_background = lambda user_id: None  # the test syncs by hand
+        nodes.append(node)
+    alice, bob = nodes
+    # Written while the other side was away
+    missed = [alice.database.save_message("alice", "bob", f"missed {i}") for i in range(3)]
+    bob.database.save_message("bob", "alice", "and one back")
+    for node in nodes:
+        node.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not (bob.user_id in alice.online_users and alice.user_id in bob.online_users):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        assert alice.sync_with(bob.user_id) == (1, 3)
+
+        assert [m["message"] for m in bob.database.get_messages("bob", "alice")] == \
+            ["missed 0", "missed 1", "missed 2", "and one back"]
+        assert {alice.database.get_message(i)["status"] for i in missed} == {"delivered"}
+        assert alice.sync_with(bob.user_id) == (0, 0)
+    finally:
+        for node in nodes:
+            node.stop(wait=True)
+
+
+def test_oversized_sync_batch_is_refused(tmp_path):
+    node = NetworkManager(DatabaseManager(":memory:"), keys_dir=str(tmp_path))
+    batch = {"messages": [{"uid": new_message_id(), "message": "x"}] * (node.SYNC_BATCH + 1), "statuses": []}
+
+    with pytest.raises(ValueError):
+        node._apply_sync_batch("bob", "b0b0b0b0", batch)
+    with pytest.raises(ValueError):
+        node._apply_sync_batch("bob", "b0b0b0b0", ["not", "a", "batch"])
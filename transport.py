@@ -0,0 +1,535 @@
+"""
+Transports - the sockets NetworkManager sends and receives through
+
+SocketTransport is the real network. SimulatedNetwork is an in-process
+network with configurable latency, jitter, packet loss, bandwidth and
+partitions; every virtual host gets its own SimulatedTransport from
+SimulatedNetwork.host(ip), so thousands of NetworkManagers can run in one
+process without touching a real interface (see simulate.py).
+
+The objects a transport hands out only need the subset of the socket API
+NetworkManager uses: sendto/recvfrom for datagrams, accept for listeners,
+send/sendall/recv/recv_into for streams, plus settimeout/setsockopt/close.
+"""
+
+import errno
+import heapq
+import ipaddress
+import itertools
+import logging
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from functools import partial
+
+log = logging.getLogger("securelocal.transport")
+
+# An IPv4 address on a local interface; netmask is None where it can't be read
+Interface = namedtuple("Interface", "name ip netmask")
+
+
+def broadcast_address(interface):
+    """The directed broadcast address of an interface's subnet, or None."""
+    if not interface.netmask:
+        return None
+    net = ipaddress.IPv4Network(f"{interface.ip}/{interface.netmask}", strict=False)
+    return str(net.broadcast_address) if net.prefixlen < 31 else None
+
+
+def interface_for(interfaces, ip):
+    """The local interface whose subnet contains `ip`, or None."""
+    addr = ipaddress.IPv4Address(ip)
+    for iface in interfaces:
+        if iface.netmask and addr in ipaddress.IPv4Network(f"{iface.ip}/{iface.netmask}", strict=False):
+            return iface
+    return None
+
+
+# Linux ioctls for reading interface state without netifaces
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+_IFF_UP = 0x1
+_IFF_LOOPBACK = 0x8
+_IFF_MULTICAST = 0x1000
+
+
+class SocketTransport:
+    """The real network, via the socket module."""
+
+    def local_ip(self):
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+            s.close()
+            return ip
+        except OSError:
+            return "127.0.0.1"
+
+    def interfaces(self):
+        """Usable IPv4 interfaces: up, multicast-capable and not loopback."""
+        if sys.platform.startswith("linux"):
+            try:
+                return self._linux_interfaces()
+            except (ImportError, OSError):
+                pass
+
+        # Elsewhere: every address the hostname resolves to, plus the routed one
+        ips = {self.local_ip()}
+        try:
+            ips.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET))
+        except OSError:
+            pass
+        return [Interface(f"if{i}", ip, None) for i, ip in enumerate(sorted(ips)) if not ip.startswith("127.")]
+
+    def _linux_interfaces(self):
+        import fcntl
+
+        found = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                req = struct.pack("256s", name.encode()[:15])
+                try:
+                    flags, = struct.unpack_from("H", fcntl.ioctl(s.fileno(), _SIOCGIFFLAGS, req), 16)
+                    ip = socket.inet_ntoa(fcntl.ioctl(s.fileno(), _SIOCGIFADDR, req)[20:24])
+                except OSError:
+                    continue  # no IPv4 address
+                if not flags & _IFF_UP or flags & _IFF_LOOPBACK or not flags & _IFF_MULTICAST:
+                    continue
+                try:
+                    netmask = socket.inet_ntoa(fcntl.ioctl(s.fileno(), _SIOCGIFNETMASK, req)[20:24])
+                except OSError:
+                    netmask = None
+                found.append(Interface(name, ip, netmask))
+        return found
+
+    def open_datagram(self, port=None, broadcast=False, timeout=None, multicast_interface=None):
+        """A UDP socket; with multicast_interface (an interface IP) multicast sends leave
+        through that interface with TTL 1, so beacons stay on the local segment."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if broadcast:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if multicast_interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(multicast_interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if port is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", port))
+        if timeout is not None:
+            sock.settimeout(timeout)
+        return sock
+
+    def join_multicast(self, sock, group, interface_ip):
+        """Join `group` on one interface; False if that interface can't (e.g. it went away)."""
+        mreq = socket.inet_aton(group) + socket.inet_aton(interface_ip)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            # EADDRINUSE: already a member on this interface
+            return e.errno == errno.EADDRINUSE
+        return True
+
+    def open_listener(self, port, backlog=5, timeout=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("0.0.0.0", port))
+        sock.listen(backlog)
+        if timeout is not None:
+            sock.settimeout(timeout)
+        return sock
+
+    def open_connection(self, address, timeout=None):
+        return socket.create_connection(address, timeout=timeout)
+
+
+# ------------------ Simulated network ------------------
+class SimulatedNetwork:
+    """In-process packet network shared by SimulatedTransport hosts.
+
+    latency/jitter are one-way seconds, loss is the chance a datagram is
+    dropped, bandwidth is each host's uplink in bytes/second (None for
+    unlimited). Randomness comes from `seed`, so runs are repeatable.
+    """
+
+    EPHEMERAL_PORTS = 40000
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, bandwidth=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.bandwidth = bandwidth
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._events = []               # heap of (deliver_at, seq, callback)
+        self._seq = itertools.count()
+        self._ports = itertools.count(self.EPHEMERAL_PORTS)
+
+        self._datagram_sockets = {}     # port -> {ip: _SimDatagramSocket}
+        self._memberships = {}          # multicast group -> set of member sockets
+        self._listeners = {}            # (ip, port) -> _SimListener
+        self._groups = {}               # ip -> partition group
+        self._uplink_free_at = {}       # ip -> monotonic time its link goes idle
+
+        self.stats = {
+            "datagrams_sent": 0,
+            "datagrams_delivered": 0,
+            "datagrams_dropped": 0,
+            "stream_bytes": 0,
+            "connections": 0,
+            "connections_failed": 0,
+        }
+
+        threading.Thread(target=self._run, name="simnet", daemon=True).start()
+
+    def host(self, ip):
+        return SimulatedTransport(self, ip)
+
+    # ------------------ Partitions ------------------
+    def partition(self, *groups):
+        """Split hosts into groups that can only reach members of their own group."""
+        with self._lock:
+            self._groups = {ip: i for i, group in enumerate(groups) for ip in group}
+
+    def heal(self):
+        with self._lock:
+            self._groups = {}
+
+    def _reachable(self, a, b):
+        ga, gb = self._groups.get(a), self._groups.get(b)
+        return ga is None or gb is None or ga == gb
+
+    # ------------------ Scheduling ------------------
+    def _transmit(self, src_ip, nbytes):
+        """Return when `nbytes` from `src_ip` finish going onto the wire (lock held)."""
+        now = time.monotonic()
+        if not self.bandwidth:
+            return now
+        start = max(now, self._uplink_free_at.get(src_ip, now))
+        done = start + nbytes / self.bandwidth
+        self._uplink_free_at[src_ip] = done
+        return done
+
+    def _propagation(self):
+        if self.jitter:
+            return self.latency + self._rng.uniform(0, self.jitter)
+        return self.latency
+
+    def _push(self, at, callback):
+        heapq.heappush(self._events, (at, next(self._seq), callback))
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._events:
+                        self._cond.wait()
+                        continue
+                    at = self._events[0][0]
+                    delay = at - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    _, _, callback = heapq.heappop(self._events)
+                    break
+            try:
+                callback()
+            except Exception as e:
+                log.exception("Simulated event failed: %s", e)
+
+    # ------------------ Datagrams ------------------
+    def _bind_datagram(self, sock, port):
+        with self._lock:
+            hosts = self._datagram_sockets.setdefault(port, {})
+            if sock.ip in hosts:
+                raise OSError(errno.EADDRINUSE, "Address already in use")
+            hosts[sock.ip] = sock
+
+    def _unbind_datagram(self, sock):
+        with self._lock:
+            hosts = self._datagram_sockets.get(sock.port, {})
+            if hosts.get(sock.ip) is sock:
+                del hosts[sock.ip]
+            for members in self._memberships.values():
+                members.discard(sock)
+
+    def _join(self, sock, group):
+        with self._lock:
+            self._memberships.setdefault(group, set()).add(sock)
+
+    def _send_datagram(self, sock, data, address):
+        host, port = address
+        data = bytes(data)
+        with self._lock:
+            self.stats["datagrams_sent"] += 1
+            hosts = self._datagram_sockets.get(port, {})
+            if host == "<broadcast>" or host.endswith(".255"):
+                # Broadcast loops back to the sender's own socket, like the real thing
+                targets = list(hosts.values())
+            elif ipaddress.IPv4Address(host).is_multicast:
+                targets = [s for s in self._memberships.get(host, ()) if s.port == port]
+            else:
+                target = hosts.get(sock.ip if host.startswith("127.") else host)
+                targets = [target] if target else []
+
+            sent_at = self._transmit(sock.ip, len(data))
+            for target in targets:
+                if not self._reachable(sock.ip, target.ip) or (
+                    self.loss and self._rng.random() < self.loss
+                ):
+                    self.stats["datagrams_dropped"] += 1
+                    continue
+                self.stats["datagrams_delivered"] += 1
+                self._push(sent_at + self._propagation(),
+                           partial(target._deliver, data, (sock.ip, sock.port)))
+        return len(data)
+
+    # ------------------ Streams ------------------
+    def _listen(self, listener):
+        with self._lock:
+            key = (listener.ip, listener.port)
+            if key in self._listeners:
+                raise OSError(errno.EADDRINUSE, "Address already in use")
+            self._listeners[key] = listener
+
+    def _unlisten(self, listener):
+        with self._lock:
+            if self._listeners.get((listener.ip, listener.port)) is listener:
+                del self._listeners[(listener.ip, listener.port)]
+
+    def _connect(self, src_ip, address, timeout):
+        host, port = address
+        if host.startswith("127."):
+            host = src_ip
+
+        with self._lock:
+            listener = self._listeners.get((host, port))
+            reachable = self._reachable(src_ip, host)
+            rtt = 2 * self._propagation()
+            if listener is None or not reachable or listener.full():
+                self.stats["connections_failed"] += 1
+            else:
+                self.stats["connections"] += 1
+
+        if not reachable:
+            # A partitioned SYN is never answered
+            time.sleep(timeout if timeout is not None else rtt)
+            raise socket.timeout("timed out")
+        time.sleep(rtt)
+        if listener is None or listener.full():
+            raise ConnectionRefusedError(errno.ECONNREFUSED, "Connection refused")
+
+        client = _SimStream(self, src_ip, next(self._ports), host)
+        server = _SimStream(self, host, port, src_ip)
+        client.peer, server.peer = server, client
+        client.settimeout(timeout)
+        listener._enqueue(server, (src_ip, client.port))
+        return client
+
+    def _send_stream(self, stream, callback, nbytes):
+        with self._lock:
+            self.stats["stream_bytes"] += nbytes
+            if not self._reachable(stream.ip, stream.peer.ip):
+                return  # lost in the partition; the peer just stops hearing from us
+            at = self._transmit(stream.ip, nbytes) + self._propagation()
+            # Streams are ordered: never overtake an earlier segment on this connection
+            at = max(at, stream._last_arrival)
+            stream._last_arrival = at
+            self._push(at, callback)
+
+
+class SimulatedTransport:
+    """One virtual host on a SimulatedNetwork."""
+
+    def __init__(self, network, ip):
+        self.network = network
+        self.ip = ip
+
+    def local_ip(self):
+        return self.ip
+
+    def interfaces(self):
+        return [Interface("sim0", self.ip, "255.0.0.0")]
+
+    def open_datagram(self, port=None, broadcast=False, timeout=None, multicast_interface=None):
+        sock = _SimDatagramSocket(self.network, self.ip)
+        if port is not None:
+            sock.bind(("", port))
+        sock.settimeout(timeout)
+        return sock
+
+    def join_multicast(self, sock, group, interface_ip):
+        self.network._join(sock, group)
+        return True
+
+    def open_listener(self, port, backlog=5, timeout=None):
+        listener = _SimListener(self.network, self.ip, port, backlog)
+        self.network._listen(listener)
+        listener.settimeout(timeout)
+        return listener
+
+    def open_connection(self, address, timeout=None):
+        return self.network._connect(self.ip, address, timeout)
+
+
+# ------------------ Simulated sockets ------------------
+class _SimSocket:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.timeout = None
+        self._closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def _wait(self, ready):
+        """Wait on self._cond (held) until ready() or the timeout expires."""
+        if not self._cond.wait_for(lambda: ready() or self._closed, self.timeout):
+            raise socket.timeout("timed out")
+        if self._closed and not ready():
+            raise OSError(errno.EBADF, "Bad file descriptor")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _SimDatagramSocket(_SimSocket):
+    def __init__(self, network, ip):
+        super().__init__()
+        self.network = network
+        self.ip = ip
+        self.port = None
+        self._queue = deque()
+
+    def bind(self, address):
+        self.port = address[1]
+        self.network._bind_datagram(self, self.port)
+
+    def sendto(self, data, address):
+        if self.port is None:
+            self.port = next(self.network._ports)
+        return self.network._send_datagram(self, data, address)
+
+    def _deliver(self, data, source):
+        with self._cond:
+            if not self._closed:
+                self._queue.append((data, source))
+                self._cond.notify()
+
+    def recvfrom(self, bufsize):
+        with self._cond:
+            self._wait(lambda: self._queue)
+            data, source = self._queue.popleft()
+        return data[:bufsize], source
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self.port is not None:
+            self.network._unbind_datagram(self)
+
+
+class _SimListener(_SimSocket):
+    def __init__(self, network, ip, port, backlog):
+        super().__init__()
+        self.network = network
+        self.ip = ip
+        self.port = port
+        self.backlog = backlog
+        self._pending = deque()
+
+    def full(self):
+        return len(self._pending) >= self.backlog
+
+    def _enqueue(self, stream, address):
+        with self._cond:
+            self._pending.append((stream, address))
+            self._cond.notify()
+
+    def accept(self):
+        with self._cond:
+            self._wait(lambda: self._pending)
+            return self._pending.popleft()
+
+    def close(self):
+        self.network._unlisten(self)
+        with self._cond:
+            self._closed = True
+            pending, self._pending = self._pending, deque()
+            self._cond.notify_all()
+        for stream, _ in pending:
+            stream.close()
+
+
+class _SimStream(_SimSocket):
+    def __init__(self, network, ip, port, remote_ip):
+        super().__init__()
+        self.network = network
+        self.ip = ip
+        self.port = port
+        self.remote_ip = remote_ip
+        self.peer = None
+        self._buffer = bytearray()
+        self._eof = False
+        self._last_arrival = 0.0
+
+    def getpeername(self):
+        return (self.peer.ip, self.peer.port)
+
+    def send(self, data):
+        if self._closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        if self.peer._closed:
+            raise ConnectionResetError(errno.ECONNRESET, "Connection reset by peer")
+        data = bytes(data)
+        self.network._send_stream(self, partial(self.peer._deliver, data), len(data))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def _deliver(self, data):
+        with self._cond:
+            self._buffer.extend(data)
+            self._cond.notify_all()
+
+    def _deliver_eof(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def recv(self, bufsize):
+        with self._cond:
+            self._wait(lambda: self._buffer or self._eof)
+            chunk = bytes(self._buffer[:bufsize])
+            del self._buffer[:bufsize]
+        return chunk
+
+    def recv_into(self, buffer, nbytes=0):
+        chunk = self.recv(nbytes or len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self.peer is not None:
+            self.network._send_stream(self, self.peer._deliver_eof, 0)